@@ -0,0 +1,116 @@
+"""Benchmarks of the train and serve hot paths.
+
+All cases run offline on mock data with a fixed `max_datetime`, so that the
+amount of work is identical between runs and machines.
+"""
+from __future__ import annotations
+
+import atexit
+import datetime
+import functools
+import os
+import pathlib
+import tempfile
+import typing
+
+from harness import benchmark
+
+#: The fixed end of the data window for all benchmarks
+MAX_DATETIME = datetime.datetime(2021, 11, 1, 9, 0)
+
+#: Scratch space for artifacts written by the benchmarks, removed when the process exits
+_SCRATCH_DIR = tempfile.TemporaryDirectory(prefix="topn-bench-")
+atexit.register(_SCRATCH_DIR.cleanup)
+_SCRATCH = pathlib.Path(_SCRATCH_DIR.name)
+
+
+@functools.lru_cache(maxsize=None)
+def _raw_interactions(window_hours: int) -> typing.Any:
+    from mock_loader import MockProfileLoader
+
+    loader = MockProfileLoader(max_datetime=MAX_DATETIME)
+    return loader._load_interactions(MAX_DATETIME - datetime.timedelta(hours=window_hours), MAX_DATETIME, 1000)
+
+
+@functools.lru_cache(maxsize=None)
+def _fitted_model() -> typing.Any:
+    from DemoUserEpisodes import DemoUserEpisodes
+    from mock_loader import MockProfileLoader
+
+    return DemoUserEpisodes(data_loader=MockProfileLoader(max_datetime=MAX_DATETIME)).fit()
+
+
+@functools.lru_cache(maxsize=None)
+def _artifact_path() -> pathlib.Path:
+    import joblib
+
+    path = _SCRATCH / "model.joblib"
+    joblib.dump(_fitted_model().to_trained(), path)
+    return path
+
+
+@benchmark("mock_generate", window_hours=[1, 6, 24])
+def mock_generate(window_hours: int) -> typing.Callable[[], typing.Any]:
+    from mock_loader import MockProfileLoader
+
+    loader = MockProfileLoader(max_datetime=MAX_DATETIME)
+    from_dt = MAX_DATETIME - datetime.timedelta(hours=window_hours)
+    return lambda: loader._load_interactions(from_dt, MAX_DATETIME, 1000)
+
+
+@benchmark("dtype_coercion", window_hours=[1, 24], profile=["default", "compact"])
+def dtype_coercion(window_hours: int, profile: str) -> typing.Callable[[], typing.Any]:
+    from abstract_loader import to_dtype_profile
+
+    raw = _raw_interactions(window_hours)
+    return lambda: to_dtype_profile(raw, profile)
+
+
+@benchmark("fit")
+def fit() -> typing.Callable[[], typing.Any]:
+    from DemoUserEpisodes import DemoUserEpisodes
+    from mock_loader import MockProfileLoader
+
+    model = DemoUserEpisodes(data_loader=MockProfileLoader(max_datetime=MAX_DATETIME))
+    return model.fit
+
+
+@benchmark("predict_single", n=[10, 100])
+def predict_single(n: int) -> typing.Callable[[], typing.Any]:
+    model = _fitted_model()
+    return lambda: model.predict(MAX_DATETIME, ["user_1"], n)
+
+
+@benchmark("predict_batch", anchors=[10, 100, 1000], n=[10, 100])
+def predict_batch(anchors: int, n: int) -> typing.Callable[[], typing.Any]:
+    model = _fitted_model()
+    from_ids = [f"user_{i}" for i in range(anchors)]
+    return lambda: model.predict(MAX_DATETIME, from_ids, n)
+
+
+@benchmark("artifact_dump")
+def artifact_dump() -> typing.Callable[[], typing.Any]:
+    import joblib
+
+    trained = _fitted_model().to_trained()
+    return lambda: joblib.dump(trained, _SCRATCH / "dump.joblib")
+
+
+@benchmark("artifact_load")
+def artifact_load() -> typing.Callable[[], typing.Any]:
+    import joblib
+
+    path = _artifact_path()
+    return lambda: joblib.load(path)
+
+
+@benchmark("endpoint", n=[10, 100])
+def endpoint(n: int) -> typing.Callable[[], typing.Any]:
+    # The app loads its model and replays its event log on import
+    os.environ.setdefault("MODEL_PATH", str(_artifact_path()))
+    os.environ.setdefault("EVENT_LOG_PATH", str(_SCRATCH / "events.log"))
+    import app
+
+    client = app.app.test_client()
+    payload = {"from_ids": "user_1", "n": str(n)}
+    return lambda: client.post("/api/v1/predict", json=payload)
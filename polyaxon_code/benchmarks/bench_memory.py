@@ -0,0 +1,106 @@
+"""Compare the memory of the interactions loaded in every dtype profile.
+
+For every window the mock interactions are loaded once per profile (see
+`const.get_dataframe_dtypes`), from the same seed. The table reports the size
+of the columns per interaction, the size of the vocabularies (the categories of
+the default profile and the `attrs` of the compact one), and the peak of the
+memory allocated while loading as traced by `tracemalloc`. Mock users have only
+a handful of interactions each, so the vocabularies weigh far more than they do
+for months of real interactions.
+
+Example:
+    python bench_memory.py --window-hours 24 168 --target 0.75
+
+The process exits with a non-zero status when the columns of the compact frame
+of a window are larger than `target` times those of the default frame.
+"""
+from __future__ import annotations
+
+import argparse
+import datetime
+import pathlib
+import random
+import sys
+import time
+import tracemalloc
+import typing
+
+_HERE = pathlib.Path(__file__).resolve().parent
+
+# The train code is a flat collection of modules
+sys.path[:0] = [str(_HERE.parent / "train")]
+
+import numpy  # noqa: E402
+import pandas  # noqa: E402
+
+from const import DTYPE_PROFILES  # noqa: E402
+from mock_loader import MockProfileLoader  # noqa: E402
+
+#: The fixed end of the data window, so runs are comparable
+MAX_DATETIME = datetime.datetime(2021, 11, 1, 9, 0)
+
+
+def measure(window_hours: int, profile: str, seed: int = 1234) -> dict[str, typing.Any]:
+    """Load a window of mock interactions in a profile and measure its memory."""
+    random.seed(seed)
+    numpy.random.seed(seed)
+    loader = MockProfileLoader(max_datetime=MAX_DATETIME)
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    interactions = loader.load_interactions(
+        from_offset=datetime.timedelta(hours=window_hours), num_records=None, dtype_profile=profile
+    )
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    columns = {}
+    vocabularies = sum(getattr(v, "nbytes", 0) for v in interactions.attrs.values())
+    for name, values in interactions.items():
+        if isinstance(values.dtype, pandas.CategoricalDtype):
+            columns[name] = values.cat.codes.nbytes
+            vocabularies += values.cat.categories.memory_usage(deep=True)
+        else:
+            columns[name] = values.memory_usage(index=False, deep=True)
+    return {
+        "rows": len(interactions),
+        "bytes": sum(columns.values()),
+        "columns": columns,
+        "vocabularies": vocabularies,
+        "peak": peak,
+        "seconds": seconds,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--window-hours", type=int, nargs="+", default=[6, 24])
+    parser.add_argument("--target", type=float, help="maximum size of the compact columns relative to the default ones")
+    args = parser.parse_args()
+
+    # Import the dependencies of the mock before measuring
+    measure(1, "default")
+
+    print(
+        f"{'window':>7} {'profile':<8} {'rows':>10} {'B/row':>7} {'vocab MB':>9} {'peak MB':>9} {'load s':>7}  columns"
+    )
+    failed = False
+    for window_hours in args.window_hours:
+        results = {profile: measure(window_hours, profile) for profile in DTYPE_PROFILES}
+        for profile, result in results.items():
+            rows = max(result["rows"], 1)
+            columns = " ".join(f"{name}={size / rows:.1f}" for name, size in result["columns"].items())
+            print(
+                f"{window_hours:>6}h {profile:<8} {result['rows']:>10} {result['bytes'] / rows:7.1f} "
+                f"{result['vocabularies'] / 2**20:9.2f} {result['peak'] / 2**20:9.2f} {result['seconds']:7.3f}  "
+                + columns
+            )
+        ratio = results["compact"]["bytes"] / max(results["default"]["bytes"], 1)
+        print(f"{window_hours:>6}h compact / default: {ratio:.2f}")
+        failed |= args.target is not None and ratio > args.target
+
+    if failed:
+        print(f"the compact profile exceeds {args.target:.2f} of the default profile", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,62 @@
+"""Benchmarks of the JSON and the binary (MessagePack) predict protocols.
+
+The `codec` cases time encoding a response and decoding it again without any
+model in the loop, the `roundtrip` cases time a whole request on the Flask test
+client, so the difference between the two is the cost of scoring.
+"""
+from __future__ import annotations
+
+import datetime
+import json
+import os
+import random
+import typing
+
+from bench_hot_paths import _SCRATCH, MAX_DATETIME, _artifact_path
+from harness import benchmark
+
+
+def _recommendations(anchors: int, n: int) -> list[dict[str, typing.Any]]:
+    created = datetime.datetime(2021, 11, 1, 9, 0, tzinfo=datetime.timezone.utc).isoformat()
+    return [
+        {
+            "from_key": f"user_{a}",
+            "from_key_type": "profile_id",
+            "to_key_type": "episode_id",
+            "scores": [random.random() for _ in range(n)],
+            "items": [f"item_{random.randrange(10000)}" for _ in range(n)],
+            "datetime_context": MAX_DATETIME.isoformat(),
+            "datetime_created": created,
+            "recommender": "DemoUserEpisodes",
+        }
+        for a in range(anchors)
+    ]
+
+
+@benchmark("codec", encoding=["json", "msgpack"], anchors=[1, 100, 1000], n=[10, 100])
+def codec(encoding: str, anchors: int, n: int) -> typing.Callable[[], typing.Any]:
+    import protocol
+
+    recommendations = _recommendations(anchors, n)
+    if encoding == "json":
+        return lambda: json.loads(json.dumps(recommendations))
+    return lambda: protocol.decode_recommendations(protocol.encode_recommendations(recommendations))
+
+
+@benchmark("roundtrip", encoding=["json", "msgpack"], anchors=[1, 100], n=[10, 100])
+def roundtrip(encoding: str, anchors: int, n: int) -> typing.Callable[[], typing.Any]:
+    # The app loads its model and replays its event log on import
+    os.environ.setdefault("MODEL_PATH", str(_artifact_path()))
+    os.environ.setdefault("EVENT_LOG_PATH", str(_SCRATCH / "events.log"))
+    import app
+    import protocol
+
+    client = app.app.test_client()
+    from_ids = [f"user_{a}" for a in range(anchors)]
+    if encoding == "json":
+        headers = {"Accept": "application/json"}
+        return lambda: client.post("/api/v1/predict", json={"from_ids": from_ids, "n": n}, headers=headers).get_json()
+
+    body = protocol.encode_request(from_ids, n)
+    headers = {"Content-Type": protocol.MSGPACK, "Accept": protocol.MSGPACK}
+    return lambda: protocol.decode_recommendations(client.post("/api/v1/predict", data=body, headers=headers).data)
@@ -0,0 +1,111 @@
+"""Measure the cold start of the serving app and the training entry point.
+
+Every measurement starts a fresh interpreter, imports the entry point with
+`-X importtime` and reports the median wall time together with a breakdown of
+the import time per top-level package. The breakdown sums the self time of all
+modules of a package, so the rows add up to the total import time. For the
+serving app the row of `app` itself includes loading the model, which is
+trained on mock data first.
+
+Example:
+    python bench_startup.py --entry serving --target 2.0
+    python bench_startup.py --entry train --repeat 5 --top 15
+
+The process exits with a non-zero status when the median cold start exceeds
+the target.
+"""
+from __future__ import annotations
+
+import argparse
+import atexit
+import collections
+import os
+import pathlib
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+_HERE = pathlib.Path(__file__).resolve().parent
+
+#: Working directory and module to import per entry point
+ENTRY_POINTS = {
+    "serving": (_HERE.parent / "flask_serving", "app"),
+    "train": (_HERE.parent / "train", "model"),
+}
+
+_IMPORTTIME = re.compile(r"^import time:\s+(\d+) \|\s+\d+ \| \s*(\S+)$")
+
+_TIMED_IMPORT = (
+    "import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)"
+)
+
+
+def _train_mock_model(path: pathlib.Path) -> None:
+    code = (
+        "import datetime, model; "
+        f"model.train(datetime.datetime(2021, 11, 1, 9, 0), {{}}, {str(path)!r})"
+    )
+    subprocess.run([sys.executable, "-c", code], cwd=ENTRY_POINTS["train"][0], check=True, capture_output=True)
+
+
+def measure(entry: str, env: dict[str, str]) -> tuple[float, dict[str, float]]:
+    """Import the entry point in a fresh interpreter.
+
+    Returns:
+        The wall time of the import in seconds and the import time (self) in
+        seconds per top-level package
+    """
+    cwd, module = ENTRY_POINTS[entry]
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _TIMED_IMPORT.format(module=module)],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    packages: dict[str, float] = collections.Counter()
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME.match(line)
+        if match:
+            packages[match.group(2).split(".")[0]] += int(match.group(1)) / 1e6
+    return float(result.stdout.strip().splitlines()[-1]), packages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entry", choices=sorted(ENTRY_POINTS), default="serving")
+    parser.add_argument("--repeat", type=int, default=5, help="number of fresh interpreters to start")
+    parser.add_argument("--top", type=int, default=10, help="number of packages in the breakdown")
+    parser.add_argument("--target", type=float, help="maximum median cold start in seconds")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if args.entry == "serving":
+        scratch = tempfile.TemporaryDirectory(prefix="topn-startup-")
+        atexit.register(scratch.cleanup)
+        model_path = pathlib.Path(scratch.name) / "model.joblib"
+        _train_mock_model(model_path)
+        env["MODEL_PATH"] = str(model_path)
+        env["EVENT_LOG_PATH"] = str(model_path.with_name("events.log"))
+
+    walls = []
+    breakdown: dict[str, list[float]] = collections.defaultdict(list)
+    for _ in range(args.repeat):
+        wall, packages = measure(args.entry, env)
+        walls.append(wall)
+        for package, seconds in packages.items():
+            breakdown[package].append(seconds)
+
+    median = statistics.median(walls)
+    print(f"cold start of {args.entry}: median {median:.3f}s over {args.repeat} runs (min {min(walls):.3f}s)")
+    print(f"{'package':<30} {'import (s)':>10}")
+    ranked = sorted(breakdown.items(), key=lambda item: statistics.median(item[1]), reverse=True)
+    for package, seconds in ranked[: args.top]:
+        print(f"{package:<30} {statistics.median(seconds):10.3f}")
+
+    if args.target is not None and median > args.target:
+        print(f"cold start {median:.3f}s exceeds the target of {args.target:.3f}s", file=sys.stderr)
+        sys.exit(1)
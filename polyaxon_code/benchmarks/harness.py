@@ -0,0 +1,186 @@
+"""A minimal, dependency-free harness for reproducible benchmarks.
+
+Benchmarks are registered with the `benchmark` decorator. The decorated function
+receives one combination of the given parameter grid, performs its (untimed)
+setup and returns the zero-argument callable that is timed.
+
+Functions:
+    benchmark: Register a benchmark case over a parameter grid
+    run: Run the registered benchmarks and collect their timings
+    compare: Compare results against a baseline and report regressions
+    load_results: Load previously stored results
+    save_results: Store results as JSON
+"""
+from __future__ import annotations
+
+import dataclasses
+import datetime
+import gc
+import itertools
+import json
+import pathlib
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import typing
+
+#: Seed used before the setup of every benchmark case
+SEED = 1234
+
+
+@dataclasses.dataclass
+class Case:
+    """A registered benchmark over a grid of parameters.
+
+    Attributes:
+        name   : The name of the benchmark
+        setup  : Returns the callable to time for one combination of parameters
+        params : The parameter grid, every combination is a separate case
+    """
+
+    name: str
+    setup: typing.Callable[..., typing.Callable[[], typing.Any]]
+    params: dict[str, list[typing.Any]]
+
+    def expand(self) -> typing.Iterator[tuple[str, dict[str, typing.Any]]]:
+        """Iterate over the (case id, parameters) of all parameter combinations."""
+        keys = list(self.params)
+        for values in itertools.product(*(self.params[k] for k in keys)):
+            kwargs = dict(zip(keys, values))
+            suffix = ",".join(f"{k}={v}" for k, v in kwargs.items())
+            yield (f"{self.name}[{suffix}]" if suffix else self.name), kwargs
+
+
+_REGISTRY: list[Case] = []
+
+
+def benchmark(name: str, **params: list[typing.Any]) -> typing.Callable[..., typing.Any]:
+    """Register the decorated setup function as a benchmark over the parameter grid."""
+
+    def decorator(setup: typing.Callable[..., typing.Callable[[], typing.Any]]) -> typing.Callable[..., typing.Any]:
+        _REGISTRY.append(Case(name=name, setup=setup, params=params))
+        return setup
+
+    return decorator
+
+
+def _seed() -> None:
+    random.seed(SEED)
+    try:
+        import numpy
+
+        numpy.random.seed(SEED)
+    except ImportError:
+        pass
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(pattern: str = "", repeat: int = 5, warmup: int = 1) -> dict[str, typing.Any]:
+    """Run all registered benchmarks whose id contains `pattern`.
+
+    Args:
+        pattern: Only run the cases of which the id contains this substring
+        repeat: The number of timed runs per case
+        warmup: The number of untimed runs per case
+
+    Returns:
+        A JSON-serializable dictionary with the machine details and the timings per case
+    """
+    results: dict[str, dict[str, typing.Any]] = {}
+    for case in _REGISTRY:
+        for case_id, kwargs in case.expand():
+            if pattern not in case_id:
+                continue
+            _seed()
+            func = case.setup(**kwargs)
+            for _ in range(warmup):
+                func()
+
+            timings = []
+            gc.collect()
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    func()
+                    timings.append(time.perf_counter() - start)
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+
+            results[case_id] = {
+                "median": statistics.median(timings),
+                "min": min(timings),
+                "mean": statistics.fmean(timings),
+                "stdev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+                "runs": timings,
+            }
+            print(f"{case_id:<60} median {results[case_id]['median'] * 1000:10.3f} ms", file=sys.stderr)
+
+    return {
+        "meta": {
+            "created": datetime.datetime.now(datetime.timezone.utc).astimezone().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "revision": _git_revision(),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(
+    results: dict[str, typing.Any], baseline: dict[str, typing.Any], threshold: float = 0.25
+) -> list[str]:
+    """Compare the median timings against a baseline.
+
+    Args:
+        results: The results of the current run
+        baseline: The stored results of a baseline run
+        threshold: The relative slow-down from which a case counts as a regression
+
+    Returns:
+        The ids of the cases that regressed
+    """
+    regressions = []
+    print(f"{'case':<60} {'baseline':>12} {'current':>12} {'change':>8}")
+    for case_id, current in results["results"].items():
+        reference = baseline["results"].get(case_id)
+        if reference is None:
+            print(f"{case_id:<60} {'-':>12} {current['median'] * 1000:10.3f}ms {'new':>8}")
+            continue
+        change = current["median"] / reference["median"] - 1
+        flag = " REGRESSION" if change > threshold else ""
+        print(
+            f"{case_id:<60} {reference['median'] * 1000:10.3f}ms {current['median'] * 1000:10.3f}ms "
+            f"{change:+8.1%}{flag}"
+        )
+        if change > threshold:
+            regressions.append(case_id)
+    return regressions
+
+
+def load_results(path: pathlib.Path) -> dict[str, typing.Any]:
+    """Load benchmark results stored by `save_results`."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_results(results: dict[str, typing.Any], path: pathlib.Path) -> None:
+    """Store benchmark results as JSON."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
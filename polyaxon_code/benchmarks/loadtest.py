@@ -0,0 +1,242 @@
+"""Open-loop load generator for the predict endpoint.
+
+Requests are issued at a fixed target rate, independent of how quickly the
+service responds, so that queueing in the service shows up in the measured
+latency. Anchors are drawn from a Zipfian popularity distribution over a
+fixed set of profiles, which mimics the skew of real traffic. The load is
+applied in steps of increasing concurrency and the latency percentiles,
+error rate and throughput of each step are reported.
+
+Example:
+    python loadtest.py --url http://127.0.0.1:8000/rewrite-services/v1/polyaxon/default/ml-serving/runs/0abc \\
+        --qps 200 --duration 30 --concurrency 1 4 16 --output report.json
+    python loadtest.py --compare baseline.json report.json
+"""
+from __future__ import annotations
+
+import argparse
+import bisect
+import concurrent.futures
+import datetime
+import http.client
+import itertools
+import json
+import pathlib
+import random
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+
+
+class ZipfAnchors:
+    """Draws profile ids with a Zipfian popularity: the k-th profile is drawn with probability ~ 1 / k^s."""
+
+    def __init__(self, profiles: int, exponent: float, seed: int = 0):
+        self._cumulative = list(itertools.accumulate(1 / k**exponent for k in range(1, profiles + 1)))
+        self._ids = [f"user_{i}" for i in range(profiles)]
+        self._random = random.Random(seed)
+        # Popularity should not follow the numbering of the profiles
+        self._random.shuffle(self._ids)
+
+    def draw(self) -> str:
+        """Draw a single profile id."""
+        rank = bisect.bisect_left(self._cumulative, self._random.random() * self._cumulative[-1])
+        return self._ids[rank]
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class Client:
+    """Sends predict requests on a keep-alive connection per thread."""
+
+    def __init__(self, url: str, timeout: float):
+        self.url = urllib.parse.urlsplit(url)
+        self.path = self.url.path.rstrip("/") + "/api/v1/predict"
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(
+                self.url.hostname, self.url.port, timeout=self.timeout
+            )
+        return connection
+
+    def _reset(self) -> None:
+        """Close the connection of this thread, the next request opens a new one."""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _post(self, body: str, headers: dict[str, str]) -> http.client.HTTPResponse:
+        connection = self._connection()
+        connection.request("POST", self.path, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        if response.getheader("Connection", "").lower() == "close":
+            self._reset()
+        return response
+
+    def predict(self, from_id: str, n: int) -> int:
+        """Request a top-n for a single anchor and return the HTTP status.
+
+        After a failure, e.g. a timeout halfway through a response, the connection is in an unknown state, so it is
+        replaced. A keep-alive connection the server closed in the meantime is retried once on a new connection.
+        """
+        body = json.dumps({"from_ids": from_id, "n": str(n)})
+        headers = {"Content-Type": "application/json"}
+        try:
+            return self._post(body, headers).status
+        except (http.client.RemoteDisconnected, ConnectionError):
+            self._reset()
+        except (OSError, http.client.HTTPException):
+            self._reset()
+            raise
+        try:
+            return self._post(body, headers).status
+        except (OSError, http.client.HTTPException):
+            self._reset()
+            raise
+
+
+def run_step(
+    client: Client, anchors: ZipfAnchors, qps: float, duration: float, concurrency: int, n: int
+) -> dict[str, typing.Any]:
+    """Apply the target rate for `duration` seconds with `concurrency` workers.
+
+    Latency is measured from the moment a request was scheduled to be sent, so
+    time spent waiting for a free worker is included (no coordinated omission).
+    """
+    latencies: list[float] = []
+    service_times: list[float] = []
+    errors: dict[str, int] = {}
+    lock = threading.Lock()
+
+    def send(scheduled: float, from_id: str) -> None:
+        started = time.perf_counter()
+        try:
+            status = client.predict(from_id, n)
+            error = None if status < 400 else f"http_{status}"
+        except (OSError, http.client.HTTPException) as e:
+            error = type(e).__name__
+        ended = time.perf_counter()
+        with lock:
+            if error is None:
+                latencies.append(ended - scheduled)
+                service_times.append(ended - started)
+            else:
+                errors[error] = errors.get(error, 0) + 1
+
+    total = int(qps * duration)
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        start = time.perf_counter()
+        for i in range(total):
+            scheduled = start + i / qps
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(send, scheduled, anchors.draw()))
+    elapsed = time.perf_counter() - start
+
+    # Count the requests that failed in an unexpected way too, rather than losing them in their futures
+    for future in futures:
+        exception = future.exception()
+        if exception is not None:
+            errors[type(exception).__name__] = errors.get(type(exception).__name__, 0) + 1
+
+    latencies.sort()
+    service_times.sort()
+    failed = sum(errors.values())
+    return {
+        "concurrency": concurrency,
+        "target_qps": qps,
+        "requests": total,
+        "throughput": len(latencies) / elapsed,
+        "error_rate": failed / total if total else 0.0,
+        "errors": errors,
+        "latency_ms": {
+            name: _percentile(latencies, q) * 1000
+            for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999), ("max", 1.0))
+        },
+        "service_time_ms": {
+            "p50": _percentile(service_times, 0.5) * 1000,
+            "p99": _percentile(service_times, 0.99) * 1000,
+        },
+    }
+
+
+def compare(baseline: dict[str, typing.Any], report: dict[str, typing.Any]) -> None:
+    """Print the change in throughput and tail latency per concurrency step."""
+    reference = {step["concurrency"]: step for step in baseline["steps"]}
+    print(f"{'concurrency':>11} {'throughput':>22} {'p50 ms':>20} {'p99 ms':>20} {'errors':>16}")
+    for step in report["steps"]:
+        old = reference.get(step["concurrency"])
+        if old is None:
+            continue
+        print(
+            f"{step['concurrency']:>11} "
+            f"{old['throughput']:9.1f} -> {step['throughput']:9.1f} "
+            f"{old['latency_ms']['p50']:8.2f} -> {step['latency_ms']['p50']:8.2f} "
+            f"{old['latency_ms']['p99']:8.2f} -> {step['latency_ms']['p99']:8.2f} "
+            f"{old['error_rate']:6.2%} -> {step['error_rate']:6.2%}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="base url of the service, e.g. the rewrite-service path of the run")
+    parser.add_argument("--qps", type=float, default=100, help="target requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per concurrency step")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--profiles", type=int, default=100_000, help="number of distinct profiles")
+    parser.add_argument("--zipf", type=float, default=1.1, help="exponent of the profile popularity")
+    parser.add_argument("-n", type=int, default=10, help="size of the requested top-n")
+    parser.add_argument("--timeout", type=float, default=60, help="request timeout, as gunicorn's -t")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=pathlib.Path, help="where to store the report as JSON")
+    parser.add_argument("--compare", type=pathlib.Path, nargs=2, metavar=("BASELINE", "REPORT"))
+    args = parser.parse_args()
+
+    if args.compare:
+        baseline, report = (json.loads(path.read_text()) for path in args.compare)
+        compare(baseline, report)
+        sys.exit(0)
+
+    if not args.url:
+        parser.error("--url is required to run a load test")
+
+    client = Client(args.url, args.timeout)
+    steps = []
+    for concurrency in args.concurrency:
+        anchors = ZipfAnchors(args.profiles, args.zipf, seed=args.seed)
+        step = run_step(client, anchors, args.qps, args.duration, concurrency, args.n)
+        steps.append(step)
+        print(
+            f"concurrency {concurrency:>3}: {step['throughput']:8.1f} req/s, "
+            f"p50 {step['latency_ms']['p50']:8.2f} ms, p99 {step['latency_ms']['p99']:8.2f} ms, "
+            f"errors {step['error_rate']:.2%}"
+        )
+
+    report = {
+        "meta": {
+            "created": datetime.datetime.now(datetime.timezone.utc).astimezone().isoformat(),
+            "url": args.url,
+            "qps": args.qps,
+            "duration": args.duration,
+            "profiles": args.profiles,
+            "zipf": args.zipf,
+            "n": args.n,
+        },
+        "steps": steps,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
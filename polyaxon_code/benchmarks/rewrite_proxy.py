@@ -0,0 +1,94 @@
+"""A local stand-in for the Polyaxon rewrite-service path of a service run.
+
+Polyaxon exposes services with `rewritePath: true` under
+`/rewrite-services/v1/polyaxon/<owner>/<project>/runs/<uuid>/<path>` and
+forwards them to `<path>` on the service. This proxy does the same for a
+locally started app, so that clients and load tests use the same URLs
+locally and against the cluster.
+
+Example:
+    (cd ../flask_serving && gunicorn -c gunicorn.conf.py --bind 127.0.0.1:8001 app:app) &
+    python rewrite_proxy.py --port 8000 --upstream http://127.0.0.1:8001
+"""
+from __future__ import annotations
+
+import argparse
+import http.client
+import http.server
+import re
+import threading
+import urllib.parse
+
+#: The prefix which Polyaxon strips from the path of rewritten service requests
+REWRITE_PATTERN = re.compile(r"^/rewrite-services/v1/polyaxon/[^/]+/[^/]+/runs/[0-9a-f]+(?P<path>/.*)?$")
+
+#: Hop-by-hop headers which are not forwarded
+_HOP_BY_HOP = {"connection", "keep-alive", "proxy-connection", "transfer-encoding", "te", "trailer", "upgrade"}
+
+
+class RewriteProxy(http.server.BaseHTTPRequestHandler):
+    """Forward rewrite-service requests to the upstream app with the prefix removed."""
+
+    protocol_version = "HTTP/1.1"
+    upstream: urllib.parse.SplitResult
+    _local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(
+                self.upstream.hostname, self.upstream.port, timeout=120
+            )
+        return connection
+
+    def _forward(self) -> None:
+        match = REWRITE_PATTERN.match(self.path)
+        if match is None:
+            self.send_error(404, "Not a rewrite-service path")
+            return
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        headers = {k: v for k, v in self.headers.items() if k.lower() not in _HOP_BY_HOP and k.lower() != "host"}
+        path = match.group("path") or "/"
+
+        try:
+            connection = self._connection()
+            try:
+                connection.request(self.command, path, body=body, headers=headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                # The upstream (e.g. a sync gunicorn worker) closed the connection, retry on a new one
+                connection.close()
+                connection.request(self.command, path, body=body, headers=headers)
+                response = connection.getresponse()
+            payload = response.read()
+        except OSError as e:
+            self._local.connection = None
+            self.send_error(502, f"Upstream unavailable: {e}")
+            return
+
+        self.send_response(response.status, response.reason)
+        for key, value in response.getheaders():
+            if key.lower() not in _HOP_BY_HOP and key.lower() != "content-length":
+                self.send_header(key, value)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _forward
+
+    def log_message(self, format: str, *args: object) -> None:
+        """Keep the proxy quiet, it is used for load tests."""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--upstream", default="http://127.0.0.1:8001", help="the locally running app")
+    args = parser.parse_args()
+
+    RewriteProxy.upstream = urllib.parse.urlsplit(args.upstream)
+    server = http.server.ThreadingHTTPServer((args.host, args.port), RewriteProxy)
+    print(f"Forwarding http://{args.host}:{args.port}/rewrite-services/v1/polyaxon/... to {args.upstream}")
+    server.serve_forever()
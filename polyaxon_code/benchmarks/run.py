@@ -0,0 +1,46 @@
+"""Run the benchmark suite and compare it against a stored baseline.
+
+Example:
+    python run.py --output results.json --baseline baseline.json --threshold 0.25
+    python run.py --output baseline.json  # store a new baseline
+
+The process exits with a non-zero status when a case is slower than the
+baseline by more than the threshold.
+"""
+from __future__ import annotations
+
+import argparse
+import pathlib
+import sys
+
+_HERE = pathlib.Path(__file__).resolve().parent
+
+# The train and serving code are flat collections of modules
+sys.path[:0] = [str(_HERE), str(_HERE.parent / "train"), str(_HERE.parent / "flask_serving")]
+
+import harness  # noqa: E402
+
+import bench_hot_paths  # noqa: E402,F401
+import bench_protocol  # noqa: E402,F401
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", "--filter", default="", help="only run cases of which the id contains this string")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs per case")
+    parser.add_argument("--output", type=pathlib.Path, help="where to store the results as JSON")
+    parser.add_argument("--baseline", type=pathlib.Path, help="results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative slow-down that fails the run")
+    args = parser.parse_args()
+
+    results = harness.run(args.filter, repeat=args.repeat, warmup=args.warmup)
+
+    if args.output:
+        harness.save_results(results, args.output)
+
+    if args.baseline:
+        regressions = harness.compare(results, harness.load_results(args.baseline), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}", file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,282 @@
+from __future__ import annotations
+
+import dataclasses
+import datetime
+import time
+import typing
+
+import numpy
+
+from abstract_top_n_model import ModelTypeEnum, TopNModel, TopNOutputKeys
+from ImplicitALS import ImplicitALS
+from instrumentation import get_registry, instrumented
+
+if typing.TYPE_CHECKING:
+    import scipy.sparse
+
+#: The candidate sources, in order of priority when the number of candidates is capped
+SOURCES = ("recent", "history", "popularity")
+
+
+@dataclasses.dataclass
+class PipelineStats:
+    """The cost of a prediction per stage.
+
+    Attributes:
+        seconds    : The latency of every stage, "candidates" and "rank"
+        candidates : The number of candidates of every anchor
+        sources    : The number of candidates per source, summed over the anchors
+    """
+
+    seconds: dict[str, float]
+    candidates: list[int]
+    sources: dict[str, int]
+
+
+class TwoStageRanker(TopNModel):
+    """Generate a few hundred candidates per anchor cheaply, then rank only those.
+
+    The candidate stage gathers, for all anchors at once, the item-to-item
+    neighbors of the items the anchor has interacted with recently (see
+    `TopNModel.recent_items`) and during training, followed by the most popular
+    items. The candidates are deduplicated, the items the anchor has already
+    interacted with are left out and at most `num_candidates` are kept, in that
+    order of sources. The ranking stage scores the candidates with the factors
+    of an `ImplicitALS` model in batches, a gather and a batched dot product
+    instead of a product with the whole catalog.
+
+    Anchors unknown to the factors are ranked with the mean factors of their
+    recent items, anchors without either get no recommendations. The latency of
+    both stages is instrumented as `TwoStageRanker.candidates` and
+    `TwoStageRanker.rank` and the candidates per source are counted in the
+    `two_stage_candidates` counter, use `predict_with_stats` to get them per call.
+
+    Hyperparameters:
+        num_candidates : The maximum number of candidates per anchor (300)
+        neighbors      : The number of neighbors per item (50)
+        seed_items     : The number of training items per anchor whose neighbors are candidates (20)
+        popular        : The number of most popular items that are candidates (100)
+        rank_batch_size: The number of anchors ranked at once (256)
+
+        All other hyperparameters are passed on to `ImplicitALS`.
+
+    Example:
+    >>> from mock_loader import MockProfileLoader
+    >>> m = TwoStageRanker(MockProfileLoader(max_datetime=datetime.datetime(2021,11,1,9,0)), {"window_hours": 2})
+    >>> m = m.fit()
+    >>> user = str(m.ranker.users[0])
+    >>> recs, stats = m.predict_with_stats(datetime.datetime.now(), from_ids=[user, 'unknown'], n=10)
+    >>> len(recs[0]['items']), len(recs[1]['items'])
+    (10, 0)
+    >>> recs[0]['scores'] == sorted(recs[0]['scores'], reverse=True)
+    True
+    >>> 10 <= stats.candidates[0] <= 300 and sorted(stats.seconds)
+    ['candidates', 'rank']
+    """
+
+    model_type = ModelTypeEnum.USER_TO_ITEM
+    output_to_field = TopNOutputKeys.EPISODE_ID
+
+    def fit(self) -> TopNModel:
+        """Factorize the interactions and precompute the neighbors and popularity of the items."""
+        self.ranker = ImplicitALS(self.data_loader, self.hyperparameters).fit()
+        return self._index_items()
+
+    def fit_matrix(
+        self, users: numpy.ndarray, items: numpy.ndarray, user_items: scipy.sparse.csr_matrix
+    ) -> TwoStageRanker:
+        """Factorize an encoded user-item matrix, see `ImplicitALS.fit_matrix`, and index the items."""
+        self.ranker = ImplicitALS(self.data_loader, self.hyperparameters).fit_matrix(users, items, user_items)
+        return self._index_items()
+
+    def _index_items(self) -> TwoStageRanker:
+        """Precompute the neighbors and popularity of the items of the fitted factors."""
+        items = self.ranker.item_factors
+
+        # Cosine neighbors of every item, in blocks to bound the size of the similarity matrix
+        k = min(self.hyperparameters.get("neighbors", 50), len(items) - 1)
+        normalized = items / numpy.maximum(numpy.linalg.norm(items, axis=1, keepdims=True), 1e-12)
+        self.neighbors = numpy.empty((len(items), k), dtype=numpy.int32)
+        for start in range(0, len(items), 1024):
+            similarity = normalized[start : start + 1024] @ normalized.T
+            block = numpy.arange(len(similarity))
+            similarity[block, block + start] = -numpy.inf
+            top = numpy.argpartition(-similarity, k - 1, axis=1)[:, :k] if k else similarity[:, :0].astype(int)
+            order = numpy.argsort(-numpy.take_along_axis(similarity, top, axis=1), axis=1, kind="stable")
+            self.neighbors[start : start + 1024] = numpy.take_along_axis(top, order, axis=1)
+
+        # The items with the most users in the training window
+        users_per_item = numpy.bincount(self.ranker.seen_indices, minlength=len(items))
+        popular = min(self.hyperparameters.get("popular", 100), len(items))
+        self.popular = numpy.argsort(-users_per_item, kind="stable")[:popular].astype(numpy.int32)
+        # A sorted lookup of the items, a dict would be many small objects copied by every forked worker
+        self.item_order = numpy.argsort(self.ranker.items, kind="stable").astype(numpy.int32)
+        return self
+
+    def known_anchors(self, from_ids: list[str]) -> list[bool]:
+        """See base class, anchors with factors or with recent items can be ranked."""
+        known = self.ranker.known_anchors(from_ids)
+        return [k or bool(recent) for k, recent in zip(known, self.recent_items(from_ids))]
+
+    def __setstate__(self, state: dict[str, typing.Any]) -> None:
+        """Unpickle models of before the sorted item lookup, which had a dict of item codes."""
+        if state.pop("item_codes", None) is not None:
+            state["item_order"] = numpy.argsort(state["ranker"].items, kind="stable").astype(numpy.int32)
+        self.__dict__.update(state)
+
+    def _recent_codes(self, from_ids: list[str]) -> numpy.ndarray:
+        """Return the codes of the recent items of every anchor, padded with -1, unknown items are left out."""
+        recent = self.recent_items(from_ids)
+        query = numpy.asarray([item for items in recent for item in items], dtype=str)
+        positions = numpy.searchsorted(self.ranker.items, query, sorter=self.item_order)
+        found = self.item_order[numpy.minimum(positions, len(self.item_order) - 1)]
+        known = self.ranker.items[found] == query
+
+        # Left-align the known items of every anchor in its row
+        rows = numpy.repeat(numpy.arange(len(from_ids)), [len(items) for items in recent])[known]
+        counts = numpy.bincount(rows, minlength=len(from_ids))
+        columns = numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        codes = numpy.full((len(from_ids), counts.max(initial=0)), -1, dtype=numpy.int32)
+        codes[rows, columns] = found[known]
+        return codes
+
+    def _seen_codes(self, rows: numpy.ndarray, known: numpy.ndarray, limit: int | None) -> numpy.ndarray:
+        """Return up to `limit` training items of every known anchor, padded with -1."""
+        starts, ends = self.ranker.seen_indptr[rows], self.ranker.seen_indptr[rows + 1]
+        lengths = numpy.where(known, ends - starts, 0)
+        width = int(lengths.max(initial=0)) if limit is None else min(int(lengths.max(initial=0)), limit)
+        offsets = numpy.arange(width)
+        positions = starts[:, None] + offsets[None, :]
+        valid = offsets[None, :] < lengths[:, None]
+        return numpy.where(valid, self.ranker.seen_indices[numpy.where(valid, positions, 0)], -1).astype(numpy.int32)
+
+    @instrumented("TwoStageRanker.candidates", rows=lambda result: int((result[0] >= 0).sum()))
+    def _candidates(
+        self, rows: numpy.ndarray, known: numpy.ndarray, recent: numpy.ndarray
+    ) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """Generate the candidates of all anchors.
+
+        Returns:
+            The candidate item codes and their source (an index into `SOURCES`), one row per anchor and padded with -1
+        """
+        anchors, k = len(rows), self.neighbors.shape[1]
+        seeds = self._seen_codes(rows, known, self.hyperparameters.get("seed_items", 20))
+        blocks = [
+            numpy.where(recent[:, :, None] >= 0, self.neighbors[recent], -1).reshape(anchors, recent.shape[1] * k),
+            numpy.where(seeds[:, :, None] >= 0, self.neighbors[seeds], -1).reshape(anchors, seeds.shape[1] * k),
+            numpy.broadcast_to(self.popular, (anchors, len(self.popular))),
+        ]
+        candidates = numpy.concatenate(blocks, axis=1)
+        sources = numpy.concatenate(
+            [numpy.full(block.shape[1], source, dtype=numpy.int8) for source, block in enumerate(blocks)]
+        )
+        sources = numpy.broadcast_to(sources, candidates.shape)
+
+        # Drop all but the first occurrence of every item, a stable sort keeps the first one in front
+        order = numpy.argsort(candidates, axis=1, kind="stable")
+        ordered = numpy.take_along_axis(candidates, order, axis=1)
+        duplicate = numpy.zeros(candidates.shape, dtype=bool)
+        numpy.put_along_axis(duplicate, order[:, 1:], ordered[:, 1:] == ordered[:, :-1], axis=1)
+
+        # Leave out the items the anchor has interacted with recently and, unless disabled, during training
+        interacted = recent
+        if self.hyperparameters.get("exclude_seen", True):
+            interacted = numpy.concatenate([self._seen_codes(rows, known, None), recent], axis=1)
+        anchor = numpy.arange(anchors)[:, None]
+        excluded = numpy.isin(
+            anchor * len(self.neighbors) + candidates,
+            numpy.broadcast_to(anchor, interacted.shape)[interacted >= 0] * len(self.neighbors)
+            + interacted[interacted >= 0],
+        )
+        valid = (candidates >= 0) & ~duplicate & ~excluded
+
+        # Keep the first `num_candidates` valid candidates of every anchor, moved to the front
+        width = min(self.hyperparameters.get("num_candidates", 300), candidates.shape[1])
+        keep = numpy.argsort(~valid, axis=1, kind="stable")[:, :width]
+        kept_valid = numpy.take_along_axis(valid, keep, axis=1)
+        return (
+            numpy.where(kept_valid, numpy.take_along_axis(candidates, keep, axis=1), -1),
+            numpy.where(kept_valid, numpy.take_along_axis(sources, keep, axis=1), -1),
+        )
+
+    @instrumented("TwoStageRanker.rank", rows=lambda result: len(result[0]))
+    def _rank(self, vectors: numpy.ndarray, candidates: numpy.ndarray, n: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """Score the candidates of every anchor and return the codes and scores of the top n, padded with -1."""
+        n = min(n, candidates.shape[1])
+        top_codes = numpy.full((len(candidates), n), -1, dtype=numpy.int32)
+        top_scores = numpy.full((len(candidates), n), -numpy.inf, dtype=numpy.float32)
+        batch_size = self.hyperparameters.get("rank_batch_size", 256)
+        for start in range(0, len(candidates), batch_size):
+            batch = candidates[start : start + batch_size]
+            scores = numpy.einsum(
+                "ij,ikj->ik", vectors[start : start + batch_size], self.ranker.item_factors[numpy.maximum(batch, 0)]
+            )
+            scores[batch < 0] = -numpy.inf
+            top = numpy.argpartition(-scores, n - 1, axis=1)[:, :n] if n else scores[:, :0].astype(int)
+            scores = numpy.take_along_axis(scores, top, axis=1)
+            order = numpy.argsort(-scores, axis=1, kind="stable")
+            top_codes[start : start + batch_size] = numpy.take_along_axis(batch, top, axis=1)[
+                numpy.arange(len(batch))[:, None], order
+            ]
+            top_scores[start : start + batch_size] = numpy.take_along_axis(scores, order, axis=1)
+        return top_codes, top_scores
+
+    def predict_with_stats(
+        self, timestamp: datetime.datetime, from_ids: list[str], n: int
+    ) -> tuple[list[dict[str, str | list[float] | list[str]]], PipelineStats]:
+        """Predict and return the latency and candidate counts of both stages as well."""
+        rows, known = self.ranker._rows(from_ids)
+        recent = self._recent_codes(from_ids)
+
+        started = time.perf_counter()
+        candidates, sources = self._candidates(rows, known, recent)
+        generated = time.perf_counter()
+
+        # Anchors without factors are folded in as the mean of the factors of their recent items
+        has_recent = (recent >= 0).any(axis=1)
+        folded = self.ranker.item_factors[numpy.maximum(recent, 0)] * (recent >= 0)[:, :, None]
+        folded = folded.sum(axis=1) / numpy.maximum((recent >= 0).sum(axis=1), 1)[:, None]
+        vectors = numpy.where(known[:, None], self.ranker.user_factors[rows], folded).astype(numpy.float32)
+        rankable = known | has_recent
+        candidates[~rankable] = -1
+        codes, scores = self._rank(vectors, candidates, n)
+        ranked = time.perf_counter()
+
+        counts = (candidates >= 0).sum(axis=1)
+        per_source = numpy.bincount(sources[candidates >= 0], minlength=len(SOURCES))
+        registry = get_registry()
+        for source, count in zip(SOURCES, per_source.tolist()):
+            registry.increment("two_stage_candidates", count, source=source)
+        stats = PipelineStats(
+            seconds={"candidates": generated - started, "rank": ranked - generated},
+            candidates=counts.tolist(),
+            sources=dict(zip(SOURCES, per_source.tolist())),
+        )
+
+        context = timestamp.isoformat()
+        creation_time = datetime.datetime.now(datetime.timezone.utc).astimezone().isoformat()
+        recommendations: list[dict[str, str | list[float] | list[str]]] = []
+        for a, anchor_codes, anchor_scores in zip(from_ids, codes, scores):
+            valid = anchor_codes >= 0
+            recommendations.append(
+                {
+                    "from_key": a,
+                    "from_key_type": self.output_from_field.value,
+                    "to_key_type": self.output_to_field.value,
+                    "scores": anchor_scores[valid].tolist(),
+                    "items": self.ranker.items[anchor_codes[valid]].tolist(),
+                    "datetime_context": context,
+                    "datetime_created": creation_time,
+                    "recommender": self.name,
+                }
+            )
+        return recommendations, stats
+
+    def predict(
+        self, timestamp: datetime.datetime, from_ids: list[str], n: int
+    ) -> list[dict[str, str | list[float] | list[str]]]:
+        """Generate the candidates of all anchors, then rank them.
+
+        See abstract class for interface information.
+        """
+        return self.predict_with_stats(timestamp, from_ids, n)[0]
@@ -1,32 +1,295 @@
+import gc
+import os
 from typing import Dict
 
 import joblib
 import numpy as np
-from flask import Flask, jsonify, make_response, request
+from flask import Flask, g, jsonify, make_response, request
 import datetime
+import itertools
+import time
 
 import abstract_top_n_model
+import DecayedPopularity
 import DemoUserEpisodes
+import ensemble
+import ImplicitALS
+import instrumentation
+import protocol
+import shadow
+import shedding
+import TwoStageRanker
+from event_log import EventLog, read_log
+from instrumentation import instrumented
+from recent_history import RecentHistory
+from profiler import SamplingProfiler
 
 def load_model(model_path: str):
-    model = open(model_path, "rb")
-    return joblib.load(model)
+    # Memory-map the large arrays of a model (e.g. the factors of ImplicitALS), so that
+    # the worker processes share them through the page cache instead of each holding a copy
+    return joblib.load(model_path, mmap_mode="r")
 
 
 app = Flask(__name__)
-ranker = load_model("./model.joblib")
+# An optional blend of several models, which then replaces the ranker
+blend = ensemble.from_environment(load_model)
+ranker = load_model(os.environ.get("MODEL_PATH", "./model.joblib")) if blend is None else None
+# An optional popularity model which answers for the profiles unknown to the ranker
+fallback = load_model(os.environ["FALLBACK_MODEL_PATH"]) if os.environ.get("FALLBACK_MODEL_PATH") else None
+# An optional candidate model, which serves an A/B share of the profiles and is compared with the live model
+shadow_scorer = shadow.from_environment(
+    load_model, fallback, live=lambda timestamp, from_ids, n: live_recommendations(timestamp, from_ids, n)[0]
+)
+shedder = shedding.LoadShedder(
+    default_deadline=float(os.environ.get("DEFAULT_DEADLINE_MS", "1000")) / 1000,
+    max_queue_time=float(os.environ.get("MAX_QUEUE_MS", "250")) / 1000,
+    reduced_n=int(os.environ.get("REDUCED_N", "10")),
+    has_fallback=fallback is not None,
+)
+# Recommendations precomputed by the training pipeline, so the cached mode can answer the most active profiles at once
+if os.environ.get("PRECOMPUTED_PATH"):
+    shedder.store(joblib.load(os.environ["PRECOMPUTED_PATH"]))
+# The latest items of every profile, ingested in real time and read by the models when predicting
+history = RecentHistory(
+    size=int(os.environ.get("RECENT_HISTORY_SIZE", "32")),
+    capacity=int(os.environ.get("RECENT_HISTORY_USERS", "100000")),
+)
+event_log_path = os.environ.get("EVENT_LOG_PATH", "./events.log")
+# Rebuild the history from the log, in chunks to bound the memory use
+replayed = read_log(event_log_path)
+while chunk := list(itertools.islice(replayed, 100_000)):
+    history.extend([user for _, user, _, _ in chunk], [item for _, _, item, _ in chunk])
+event_log = EventLog(event_log_path, max_bytes=int(float(os.environ.get("EVENT_LOG_MAX_MB", "256")) * 2**20))
+candidate = shadow_scorer.candidate if shadow_scorer is not None else None
+for trained in [ranker, fallback, candidate, *(blend.members if blend is not None else [])]:
+    if trained is not None:
+        trained.model.recent_history = history
+profiler = SamplingProfiler(
+    sample_rate=float(os.environ.get("PROFILE_SAMPLE_RATE", "0")),
+    interval=float(os.environ.get("PROFILE_INTERVAL_MS", "5")) / 1000,
+)
+# Keep the garbage collector away from everything loaded so far, the models in particular. Its passes write to the
+# object headers, which would make every worker forked from a preloading gunicorn master copy the pages of the models.
+if os.environ.get("FREEZE_PRELOADED", "1") == "1":
+    gc.freeze()
 
 
+@instrumented("serving.predict", rows=len)
 def predict(features: np.ndarray) -> Dict:
-    return ranker.model.predict(features[0], features[1], features[2])
+    if shadow_scorer is None:
+        return live_predict(features)
+
+    # Split the anchors into the candidate arm and the live arm, of which a share is compared in the background
+    timestamp, from_ids, n = features
+    treated, shadowed = shadow_scorer.split(from_ids)
+    live_ids = [a for a, t in zip(from_ids, treated) if not t]
+    candidate_ids = [a for a, t in zip(from_ids, treated) if t]
+    started = time.perf_counter()
+    live = live_predict([timestamp, live_ids, n]) if live_ids else []
+    live_seconds = time.perf_counter() - started
+    timings = g.get("timings", {})
+    if candidate_ids:
+        started = time.perf_counter()
+        candidate_recommendations = shadow_scorer.predict(timestamp, candidate_ids, n)
+        timings["candidate"] = time.perf_counter() - started
+    g.timings = timings
+    registry = instrumentation.get_registry()
+    registry.increment("ab_anchors", len(live_ids), arm="live")
+    registry.increment("ab_anchors", len(candidate_ids), arm="candidate")
+
+    # The live arm is predicted as one batch, the shadow worker times the live model on the shadowed anchors alone
+    shadowed_live = shadowed[~treated]
+    shadow_scorer.submit(
+        timestamp,
+        [a for a, s in zip(live_ids, shadowed_live) if s],
+        n,
+        [r for r, s in zip(live, shadowed_live) if s],
+        live_seconds / max(len(live_ids), 1),
+    )
+
+    live_recs, candidate_recs = iter(live), iter(candidate_recommendations if candidate_ids else [])
+    return [next(candidate_recs) if t else next(live_recs) for t in treated]
+
+
+def live_recommendations(timestamp: datetime.datetime, from_ids: list, n: int) -> tuple[list, Dict[str, float]]:
+    """Predict with the live model, the blend or the ranker with its fallback, and return the time per model."""
+    if blend is not None:
+        return blend.predict(timestamp, from_ids, n)
+
+    started = time.perf_counter()
+    if fallback is not None:
+        recommendations = fallback.model.predict_cold_start(ranker.model, timestamp, from_ids, n)
+    else:
+        recommendations = ranker.model.predict(timestamp, from_ids, n)
+    return recommendations, {type(ranker.model).__name__: time.perf_counter() - started}
+
+
+def live_predict(features: np.ndarray) -> Dict:
+    """Predict with the live model, recording the time per model for the Server-Timing header."""
+    recommendations, g.timings = live_recommendations(features[0], features[1], features[2])
+    return recommendations
+
+
+def degraded_predict(decision: shedding.Decision, features: list) -> Dict:
+    """Answer in the mode picked by the load shedder, caching the regular recommendations."""
+    started = time.perf_counter()
+    if decision.mode == shedding.CACHED:
+        recommendations = shedder.cached(features[1], features[2])
+        # The anchors may have been evicted since the decision
+        if recommendations is not None:
+            g.timings = {"cache": time.perf_counter() - started}
+            return recommendations
+    if decision.mode == shedding.FALLBACK:
+        recommendations = fallback.model.predict(features[0], features[1], features[2])
+        g.timings = {"fallback": time.perf_counter() - started}
+        return recommendations
+
+    recommendations = predict([features[0], features[1], decision.n])
+    if decision.mode == shedding.FULL:
+        shedder.store(recommendations)
+    return recommendations
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """Format latencies in seconds as a Server-Timing header, which browsers and proxies understand."""
+    return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in timings.items())
+
+
+def unsupported_media_type():
+    """Answer a binary request when msgpack is not installed."""
+    return make_response(jsonify({"error": f"{protocol.MSGPACK} is not supported, msgpack is not installed"}), 415)
 
 
 @app.route("/api/v1/predict", methods=["POST"])
 def get_prediction():
+    """Predict for a single anchor or a list of anchors.
+
+    Requests and responses are JSON by default, send `Content-Type` or `Accept`
+    `application/msgpack` to use the binary protocol (see `protocol.py`). Without
+    msgpack installed, binary requests get a 415 and responses are JSON.
+    """
     app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
-    request_data = request.json
-    features = [datetime.datetime.now(), [request_data["from_ids"]], int(request_data["n"])]
-    return make_response(jsonify(predict(features)))
+    if request.mimetype == protocol.MSGPACK and not protocol.available():
+        return unsupported_media_type()
+    if request.mimetype == protocol.MSGPACK:
+        request_data = protocol.decode_request(request.get_data())
+    else:
+        request_data = request.json
+    from_ids = request_data["from_ids"]
+    from_ids = [from_ids] if isinstance(from_ids, str) else list(from_ids)
+    features = [datetime.datetime.now(), from_ids, int(request_data["n"])]
+    binary = request.accept_mimetypes.best_match(protocol.media_types()) == protocol.MSGPACK
+    with shedder.admit(request.headers, from_ids, features[2]) as decision:
+        instrumentation.get_registry().increment("serving_degradation", mode=decision.mode)
+        if decision.mode == shedding.REJECTED:
+            response = make_response(jsonify({"error": "The latency budget of the request cannot be met"}), 503)
+            response.headers["Retry-After"] = "1"
+            response.headers["X-Degradation-Mode"] = decision.mode
+            return response
+
+        with profiler.maybe_profile(request.headers, "get_prediction"):
+            recommendations = degraded_predict(decision, features)
+            if binary:
+                response = app.response_class(
+                    protocol.encode_recommendations(recommendations), mimetype=protocol.MSGPACK
+                )
+            else:
+                response = make_response(jsonify(recommendations))
+    response.headers["Server-Timing"] = server_timing(g.timings)
+    response.headers["X-Degradation-Mode"] = decision.mode
+    return response
+
+
+@instrumented("serving.ingest", rows=len)
+def ingest(events: list) -> list:
+    event_log.append(events)
+    history.extend([user for _, user, _, _ in events], [item for _, _, item, _ in events])
+    return events
+
+
+@app.route("/api/v1/events", methods=["POST"])
+def post_events():
+    """Ingest a batch of events, in chronological order.
+
+    The body is `{"events": [{"timestamp": ..., "user": ..., "item": ..., "weight": ...}, ...]}`,
+    as JSON or MessagePack. The events are committed to the event log before the
+    request returns and are visible to the next prediction for the user that is
+    served by the same worker. Every worker keeps its own history, so only the
+    dispatcher, which sends the events and predictions of a user to one worker,
+    makes them visible to all predictions; the other workers only see them after
+    a restart replays the log.
+    """
+    if request.mimetype == protocol.MSGPACK and not protocol.available():
+        return unsupported_media_type()
+    if request.mimetype == protocol.MSGPACK:
+        request_data = protocol.decode_request(request.get_data())
+    else:
+        request_data = request.json
+    events = [
+        (str(event["timestamp"]), str(event["user"]), str(event["item"]), float(event.get("weight", 1.0)))
+        for event in request_data["events"]
+    ]
+    ingest(events)
+    return make_response(jsonify({"accepted": len(events)}), 202)
+
+
+@app.route("/admin/shadow", methods=["GET", "DELETE"])
+def shadow_stats():
+    """Return how the candidate model compares with the live model, use DELETE to start over."""
+    if shadow_scorer is None:
+        return make_response(jsonify({"error": "No candidate model is configured"}), 404)
+    if request.method == "DELETE":
+        shadow_scorer.reset()
+        return make_response("", 204)
+    return jsonify(shadow_scorer.stats())
+
+
+@app.route("/admin/profile", methods=["GET", "DELETE"])
+def profile():
+    """Return the sampled stacks of all profiled requests as folded (flamegraph) stacks.
+
+    Use DELETE to discard the samples collected so far.
+    """
+    if request.method == "DELETE":
+        profiler.reset()
+        return make_response("", 204)
+    response = app.response_class(profiler.render_folded(), mimetype="text/plain")
+    response.headers["X-Profiled-Requests"] = str(profiler.profiled_requests)
+    response.headers["X-Dropped-Samples"] = str(profiler.dropped_samples)
+    return response
+
+
+@app.route("/admin/memory", methods=["GET"])
+def memory():
+    """Return the memory of this worker and of its sibling workers, in bytes.
+
+    The uss of a worker is what it costs to add it, with a preloaded and frozen model it stays well below the size
+    of the model. Siblings are only listed when the kernel exposes the children of the parent process.
+    """
+    parent = os.getppid()
+    try:
+        with open(f"/proc/{parent}/task/{parent}/children") as children:
+            pids = [int(pid) for pid in children.read().split()]
+    except (OSError, ValueError):
+        pids = [os.getpid()]
+    workers = {str(pid): instrumentation.process_memory(pid) for pid in pids}
+    return jsonify(
+        {
+            "pid": os.getpid(),
+            "parent": {str(parent): instrumentation.process_memory(parent)},
+            "workers": workers,
+            "total_pss": sum(w.get("pss", 0) for w in workers.values()),
+            "gc_frozen_objects": gc.get_freeze_count(),
+        }
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Expose the instrumented latency and throughput in the Prometheus text format."""
+    return app.response_class(
+        instrumentation.get_registry().render_prometheus(), mimetype="text/plain; version=0.0.4"
+    )
 
 
 @app.route("/", methods=["GET"])
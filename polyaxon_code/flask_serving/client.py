@@ -0,0 +1,73 @@
+"""A client of the predict API that speaks JSON or the binary protocol.
+
+Example:
+    client = PredictClient("http://localhost:5000", binary=True)
+    recommendations = client.predict(["user_1", "user_2"], n=10)
+"""
+from __future__ import annotations
+
+import http.client
+import json
+import typing
+import urllib.parse
+
+import protocol
+
+
+class PredictClient:
+    """Sends predict requests on a keep-alive connection.
+
+    Attributes:
+        binary  : Whether to use the binary protocol, otherwise JSON
+        timeout : The timeout of a request in seconds
+    """
+
+    def __init__(self, url: str, binary: bool = True, timeout: float = 10.0):
+        self.url = urllib.parse.urlsplit(url)
+        self.path = self.url.path.rstrip("/") + "/api/v1/predict"
+        self.binary = binary
+        self.timeout = timeout
+        self._connection: http.client.HTTPConnection | None = None
+
+    def _request(self, body: bytes, headers: dict[str, str]) -> http.client.HTTPResponse:
+        if self._connection is None:
+            self._connection = http.client.HTTPConnection(self.url.hostname, self.url.port, timeout=self.timeout)
+        try:
+            self._connection.request("POST", self.path, body=body, headers=headers)
+            return self._connection.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionError):
+            # The server closed the idle keep-alive connection, retry once on a new one
+            self._connection.close()
+            self._connection.request("POST", self.path, body=body, headers=headers)
+            return self._connection.getresponse()
+
+    def predict(self, from_ids: list[str], n: int) -> list[dict[str, typing.Any]]:
+        """Request the top-n of every anchor.
+
+        Returns:
+            The recommendations in the format of `TopNModel.predict`, with the
+            scores as a float32 array when using the binary protocol
+
+        Raises:
+            http.client.HTTPException: The server did not respond with 200 OK
+        """
+        if self.binary:
+            body = protocol.encode_request(from_ids, n)
+            headers = {"Content-Type": protocol.MSGPACK, "Accept": protocol.MSGPACK}
+        else:
+            body = json.dumps({"from_ids": list(from_ids), "n": n}).encode()
+            headers = {"Content-Type": "application/json", "Accept": "application/json"}
+
+        response = self._request(body, headers)
+        payload = response.read()
+        if response.getheader("Connection", "").lower() == "close":
+            self._connection.close()
+        if response.status != 200:
+            raise http.client.HTTPException(f"{response.status} {response.reason}: {payload[:200]!r}")
+        return protocol.decode_recommendations(payload) if self.binary else json.loads(payload)
+
+    def close(self) -> None:
+        """Close the connection."""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
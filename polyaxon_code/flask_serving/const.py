@@ -9,17 +9,23 @@ Functions:
     get_location: The location for running the Vertex AI models
     get_remote_pipeline_folder: Path to the folder for storing models remotely
     set_google_project: Set the name of the GCP project used
+
+Note:
+    The Google Cloud libraries are only imported by the functions that need
+    them, because importing them takes seconds and most callers (e.g. the
+    serving app) only need `get_dataframe_dtypes`.
 """
 from __future__ import annotations
 
 import pathlib
 import typing
 
-import cloudpathlib
-import google.cloud.storage as storage
 import numpy
 import pandas
 
+if typing.TYPE_CHECKING:
+    import cloudpathlib
+
 
 #: The Google Cloud Platform project to run remote operations in
 _GOOGLE_PROJECT: str = ""
@@ -32,8 +38,26 @@ def get_container_image_uri() -> cloudpathlib.AnyPath:
     )
 
 
-def get_dataframe_dtypes() -> dict[str, typing.Any]:
-    """Return the dataframe data types in which to cast data."""
+#: The dtype profiles in which interactions can be loaded
+DTYPE_PROFILES = ("default", "compact")
+
+
+def get_dataframe_dtypes(profile: str = "default") -> dict[str, typing.Any]:
+    """Return the dataframe data types in which to cast data.
+
+    Args:
+        profile: "default" for tz-aware timestamps, categorical users and items and
+                 float64 weights. "compact" for int32 epoch seconds, int32 codes into
+                 the vocabularies in `DataFrame.attrs["users"]` and `attrs["items"]` and
+                 float32 weights. The columns take 16 bytes per row against 20 for the
+                 default profile: the timestamps and weights halve, but the int32 codes
+                 are wider than the int8 or int16 codes of categoricals with fewer than
+                 32768 categories, see `benchmarks/bench_memory.py`.
+    """
+    assert profile in DTYPE_PROFILES, ValueError(f"Unknown dtype profile {profile}, use one of {DTYPE_PROFILES}")
+    if profile == "compact":
+        # Epoch seconds fit an int32 until 2038-01-19
+        return {"timestamp": numpy.int32, "user": numpy.int32, "item": numpy.int32, "weight": numpy.float32}
     return {
         "timestamp": pandas.DatetimeTZDtype("ns", "Europe/Amsterdam"),
         "user": pandas.CategoricalDtype(),
@@ -76,6 +100,9 @@ def set_google_project(project_id: str) -> None:
     assert _GOOGLE_PROJECT == "", TypeError("The Google project can only be set once!")
     _GOOGLE_PROJECT = project_id
 
+    import cloudpathlib
+    import google.cloud.storage as storage
+
     # Initialize the CloudPathlib library.
     client = storage.Client(project=project_id)
     cloudpathlib.GSClient(storage_client=client).set_as_default_client()
@@ -93,6 +120,8 @@ def get_location() -> str:
 
 def get_remote_pipeline_folder() -> cloudpathlib.AnyPath:
     """Return the remote folder in which trained pipelines can be stored."""
+    import cloudpathlib
+
     project = get_google_project()
     return cloudpathlib.CloudPath(f"gs://re-{project}/trained_pipelines")
 
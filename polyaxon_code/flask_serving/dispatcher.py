@@ -0,0 +1,436 @@
+"""Route predict requests to serving workers by consistent hashing of the anchors.
+
+Every gunicorn worker has its own memory, so per-anchor caches and state are
+repeated in every worker and each of them only sees a fraction of the requests
+of an anchor. The dispatcher runs in front of a set of single-worker app
+processes (shards) and always sends an anchor to the same shard, so the caches
+of a shard stay hot for its slice of the anchors.
+
+Anchors are placed on a hash ring on which every shard owns many virtual nodes.
+Adding or removing a shard only moves the anchors of the ring segments it gains
+or loses, about `1 / shards` of them, instead of reshuffling all anchors.
+Requests for anchors of several shards are split, sent concurrently and merged
+in the original order. Both JSON and the binary protocol are supported.
+Ingested events are routed by their user in the same way, so the recent
+history of a user is kept by the shard that answers its predictions.
+
+Endpoints besides the predict API:
+    GET    /admin/shards        : The load and ring share per shard
+    POST   /admin/shards        : Add a shard, `{"url": ...}` or spawn a new worker process
+    DELETE /admin/shards/<name> : Remove a shard, stopping its worker process if it was spawned
+Other requests are forwarded to the first shard.
+
+Example:
+    python dispatcher.py --workers 4 --port 8000
+    python dispatcher.py --upstream http://127.0.0.1:8001 http://127.0.0.1:8002
+"""
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import dataclasses
+import http.client
+import http.server
+import json
+import logging
+import os
+import pathlib
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+
+import numpy
+import pandas
+
+import protocol
+
+#: Hop-by-hop headers which are not forwarded
+_HOP_BY_HOP = {"connection", "keep-alive", "proxy-connection", "transfer-encoding", "te", "trailer", "upgrade"}
+
+_SHARD_PATH = re.compile(r"^/admin/shards(?:/(?P<name>[^/]+))?/?$")
+
+
+def _hash(keys: list[str]) -> numpy.ndarray:
+    """Hash strings to uint64, stable across processes and Python versions."""
+    return pandas.util.hash_array(numpy.asarray(keys, dtype=object))
+
+
+class HashRing:
+    """A consistent hash ring with `replicas` virtual nodes per node."""
+
+    def __init__(self, nodes: typing.Iterable[str] = (), replicas: int = 128):
+        self.replicas = replicas
+        # Replaced as a whole, so concurrent lookups always see a consistent ring
+        self._ring: tuple[numpy.ndarray, numpy.ndarray] = (numpy.empty(0, numpy.uint64), numpy.empty(0, object))
+        # Serializes the changes, which read the ring before replacing it
+        self._lock = threading.Lock()
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self) -> list[str]:
+        """The nodes on the ring."""
+        return sorted(set(self._ring[1].tolist()))
+
+    def add(self, node: str) -> None:
+        """Place the virtual nodes of a node on the ring."""
+        added = _hash([f"{node}#{i}" for i in range(self.replicas)])
+        with self._lock:
+            positions, owners = self._ring
+            positions = numpy.concatenate([positions, added])
+            owners = numpy.concatenate([owners, numpy.full(self.replicas, node, dtype=object)])
+            order = numpy.argsort(positions, kind="stable")
+            self._ring = positions[order], owners[order]
+
+    def remove(self, node: str) -> None:
+        """Remove the virtual nodes of a node, its keys move to the next nodes on the ring."""
+        with self._lock:
+            positions, owners = self._ring
+            keep = owners != node
+            self._ring = positions[keep], owners[keep]
+
+    def lookup(self, keys: list[str]) -> numpy.ndarray:
+        """Return the node of every key: the owner of the first virtual node at or after its hash."""
+        positions, owners = self._ring
+        assert len(positions), ValueError("The hash ring is empty")
+        return owners[numpy.searchsorted(positions, _hash(keys)) % len(positions)]
+
+    def shares(self) -> dict[str, float]:
+        """Return the fraction of the hash space owned by every node."""
+        positions, owners = self._ring
+        if not len(positions):
+            return {}
+        # A virtual node owns the segment since the previous one, the first also owns the wrap-around
+        segments = numpy.diff(positions.astype(numpy.float64), prepend=positions[-1].astype(numpy.float64) - 2.0**64)
+        return (pandas.Series(segments / 2.0**64).groupby(owners).sum()).to_dict()
+
+
+@dataclasses.dataclass
+class Shard:
+    """A serving worker and its load.
+
+    Attributes:
+        name     : The name of the shard on the hash ring
+        url      : The address of the worker
+        process  : The worker process, None when it was started elsewhere
+        requests : The number of (sub)requests sent to the shard
+        anchors  : The number of anchors sent to the shard
+        errors   : The number of failed or error responses
+        seconds  : The total time spent waiting for the shard
+    """
+
+    name: str
+    url: urllib.parse.SplitResult
+    process: subprocess.Popen | None = None
+    requests: int = 0
+    anchors: int = 0
+    errors: int = 0
+    seconds: float = 0.0
+
+    def stats(self, share: float) -> dict[str, typing.Any]:
+        """Return the load of the shard as a JSON-serializable dictionary."""
+        return {
+            "url": self.url.geturl(),
+            "spawned": self.process is not None,
+            "ring_share": share,
+            "requests": self.requests,
+            "anchors": self.anchors,
+            "errors": self.errors,
+            "mean_latency_ms": 1000 * self.seconds / self.requests if self.requests else None,
+        }
+
+
+class Dispatcher:
+    """Keeps the shards and the hash ring, and forwards requests to the shards."""
+
+    def __init__(self, replicas: int = 128, max_workers: int = 32):
+        self.ring = HashRing(replicas=replicas)
+        self.shards: dict[str, Shard] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="dispatch")
+        self._counter = 0
+
+    def add(self, url: str | None = None) -> Shard:
+        """Add a shard for a running worker, or spawn a new worker process when `url` is None."""
+        with self._lock:
+            name = f"shard-{self._counter}"
+            self._counter += 1
+        process = None
+        if url is None:
+            url, process = self._spawn(name)
+        shard = Shard(name=name, url=urllib.parse.urlsplit(url), process=process)
+        self.shards[name] = shard
+        self.ring.add(name)
+        logging.info(f"Added {name} at {url}")
+        return shard
+
+    def remove(self, name: str) -> None:
+        """Take a shard off the ring and stop its worker process, if it was spawned."""
+        self.ring.remove(name)
+        shard = self.shards.pop(name)
+        if shard.process is not None:
+            shard.process.terminate()
+            shard.process.wait(timeout=30)
+        logging.info(f"Removed {name}")
+
+    @staticmethod
+    def _spawn(name: str, timeout: float = 120) -> tuple[str, subprocess.Popen]:
+        """Start a single-worker app process on a free local port and wait until it accepts connections.
+
+        Every shard gets an event log of its own, `EVENT_LOG_PATH` with the name
+        of the shard added, so shards do not replay each other's events.
+        """
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        event_log = pathlib.Path(os.environ.get("EVENT_LOG_PATH", "events.log")).resolve()
+        event_log = event_log.with_name(f"{event_log.stem}-{name}{event_log.suffix}")
+        process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "--workers", "1", "-t", "60", "--bind", f"127.0.0.1:{port}", "app:app"],
+            cwd=pathlib.Path(__file__).resolve().parent,
+            env={**os.environ, "EVENT_LOG_PATH": str(event_log)},
+        )
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            assert process.poll() is None, RuntimeError(f"Worker on port {port} exited with {process.returncode}")
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                return f"http://127.0.0.1:{port}", process
+            except OSError:
+                time.sleep(0.2)
+        process.terminate()
+        raise TimeoutError(f"Worker on port {port} did not start within {timeout} seconds")
+
+    def close(self) -> None:
+        """Stop all spawned worker processes."""
+        for name in list(self.shards):
+            self.remove(name)
+
+    def _connection(self, shard: Shard) -> http.client.HTTPConnection:
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+        if shard.name not in connections:
+            connections[shard.name] = http.client.HTTPConnection(shard.url.hostname, shard.url.port, timeout=120)
+        return connections[shard.name]
+
+    def forward(
+        self, shard: Shard, method: str, path: str, body: bytes, headers: dict[str, str], anchors: int = 0
+    ) -> tuple[int, str, list[tuple[str, str]], bytes]:
+        """Send a request to a shard on a keep-alive connection of the current thread.
+
+        Returns:
+            The status, reason, headers and body of the response
+        """
+        started = time.perf_counter()
+        connection = self._connection(shard)
+        try:
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                # The worker closed the idle connection, retry on a new one
+                connection.close()
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+            result = response.status, response.reason, response.getheaders(), response.read()
+        except (OSError, http.client.HTTPException) as e:
+            # The state of the connection is unknown after a failure, the next request opens a new one
+            connection.close()
+            result = 502, "Bad Gateway", [], f"Shard {shard.name} unavailable: {e}".encode()
+
+        with self._lock:
+            shard.requests += 1
+            shard.anchors += anchors
+            shard.errors += result[0] >= 400
+            shard.seconds += time.perf_counter() - started
+        return result
+
+    def forward_to(
+        self, name: str, method: str, path: str, body: bytes, headers: dict[str, str], anchors: int = 0
+    ) -> tuple[int, str, list[tuple[str, str]], bytes]:
+        """Send a request to the shard `name`, see `forward`, the shard may have been removed since the lookup."""
+        shard = self.shards.get(name)
+        if shard is None:
+            return 503, "Service Unavailable", [("Retry-After", "1")], f"Shard {name} was removed".encode()
+        return self.forward(shard, method, path, body, headers, anchors)
+
+    def predict(
+        self, path: str, body: bytes, headers: dict[str, str]
+    ) -> tuple[int, str, list[tuple[str, str]], bytes]:
+        """Route the anchors of a predict request to their shards and merge the responses."""
+        binary = headers.get("Content-Type", "").split(";")[0].strip() == protocol.MSGPACK
+        if binary and not protocol.available():
+            return _unsupported_media_type()
+        request = protocol.decode_request(body) if binary else json.loads(body)
+        from_ids = request["from_ids"]
+        from_ids = [from_ids] if isinstance(from_ids, str) else list(from_ids)
+        if not from_ids:
+            # No shard to ask, and so no response to take the protocol from
+            if protocol.available() and protocol.MSGPACK in headers.get("Accept", ""):
+                return 200, "OK", [("Content-Type", protocol.MSGPACK)], protocol.encode_recommendations([])
+            return 200, "OK", [("Content-Type", "application/json")], b"[]"
+
+        owners = self.ring.lookup(from_ids)
+        groups = pandas.Series(numpy.arange(len(from_ids))).groupby(owners, sort=False).indices
+        if len(groups) == 1:
+            # The common case of a single anchor, or anchors of a single shard, is forwarded as is
+            (name,) = groups
+            status, reason, response_headers, payload = self.forward_to(
+                name, "POST", path, body, headers, anchors=len(from_ids)
+            )
+            return status, reason, response_headers + [("X-Shard", name)], payload
+
+        def send(name: str, indices: numpy.ndarray) -> tuple[int, str, list[tuple[str, str]], bytes]:
+            anchors = [from_ids[i] for i in indices]
+            if binary:
+                sub_body = protocol.encode_request(anchors, request["n"])
+            else:
+                sub_body = json.dumps({**request, "from_ids": anchors}).encode()
+            return self.forward_to(name, "POST", path, sub_body, headers, anchors=len(anchors))
+
+        futures = {name: self._pool.submit(send, name, indices) for name, indices in groups.items()}
+        responses = {name: future.result() for name, future in futures.items()}
+        for status, reason, response_headers, payload in responses.values():
+            if status != 200:
+                return status, reason, response_headers, payload
+
+        # Put the recommendations back in the order of the anchors of the request
+        binary_response = _is_msgpack(next(iter(responses.values()))[2])
+        decode = protocol.decode_recommendations if binary_response else json.loads
+        merged: list[typing.Any] = [None] * len(from_ids)
+        for name, indices in groups.items():
+            for i, recommendation in zip(indices, decode(responses[name][3])):
+                merged[i] = recommendation
+        if binary_response:
+            content_type, payload = protocol.MSGPACK, protocol.encode_recommendations(merged)
+        else:
+            content_type, payload = "application/json", json.dumps(merged).encode()
+        return 200, "OK", [("Content-Type", content_type), ("X-Shard", ",".join(groups))], payload
+
+    def ingest(
+        self, path: str, body: bytes, headers: dict[str, str]
+    ) -> tuple[int, str, list[tuple[str, str]], bytes]:
+        """Route ingested events to the shard of their user, which keeps the recent history of the user."""
+        binary = headers.get("Content-Type", "").split(";")[0].strip() == protocol.MSGPACK
+        if binary and not protocol.available():
+            return _unsupported_media_type()
+        events = (protocol.decode_request(body) if binary else json.loads(body))["events"]
+        owners = self.ring.lookup([str(event["user"]) for event in events]) if events else []
+        groups = pandas.Series(numpy.arange(len(events)), dtype=numpy.int64).groupby(owners, sort=False).indices
+        # Events are forwarded as JSON, they are small compared to predictions
+        headers = {**headers, "Content-Type": "application/json"}
+
+        def send(name: str, indices: numpy.ndarray) -> tuple[int, str, list[tuple[str, str]], bytes]:
+            sub_body = json.dumps({"events": [events[i] for i in indices]}).encode()
+            return self.forward_to(name, "POST", path, sub_body, headers, anchors=len(indices))
+
+        futures = [self._pool.submit(send, name, indices) for name, indices in groups.items()]
+        for status, reason, response_headers, payload in (future.result() for future in futures):
+            if status != 202:
+                return status, reason, response_headers, payload
+        payload = json.dumps({"accepted": len(events)}).encode()
+        return 202, "Accepted", [("Content-Type", "application/json")], payload
+
+    def stats(self) -> dict[str, dict[str, typing.Any]]:
+        """Return the load and ring share of every shard."""
+        shares = self.ring.shares()
+        return {name: shard.stats(shares.get(name, 0.0)) for name, shard in self.shards.items()}
+
+
+def _is_msgpack(headers: list[tuple[str, str]]) -> bool:
+    return any(k.lower() == "content-type" and v.split(";")[0].strip() == protocol.MSGPACK for k, v in headers)
+
+
+def _unsupported_media_type() -> tuple[int, str, list[tuple[str, str]], bytes]:
+    payload = json.dumps({"error": f"{protocol.MSGPACK} is not supported, msgpack is not installed"}).encode()
+    return 415, "Unsupported Media Type", [("Content-Type", "application/json")], payload
+
+
+class DispatchHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the predict API and the shard administration on top of a `Dispatcher`."""
+
+    protocol_version = "HTTP/1.1"
+    dispatcher: Dispatcher
+
+    def _respond(self, status: int, reason: str, headers: list[tuple[str, str]], payload: bytes) -> None:
+        self.send_response(status, reason)
+        for key, value in headers:
+            if key.lower() not in _HOP_BY_HOP and key.lower() != "content-length":
+                self.send_header(key, value)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _json(self, status: int, content: typing.Any) -> None:
+        headers = [("Content-Type", "application/json")]
+        self._respond(status, http.HTTPStatus(status).phrase, headers, json.dumps(content).encode())
+
+    def _admin(self, match: re.Match, body: bytes) -> None:
+        if self.command == "GET":
+            self._json(200, self.dispatcher.stats())
+        elif self.command == "POST":
+            shard = self.dispatcher.add(json.loads(body or b"{}").get("url"))
+            self._json(201, {shard.name: shard.stats(self.dispatcher.ring.shares()[shard.name])})
+        elif self.command == "DELETE" and match.group("name") in self.dispatcher.shards:
+            self.dispatcher.remove(match.group("name"))
+            self._respond(204, "No Content", [], b"")
+        else:
+            self._json(404, {"error": f"No shard {match.group('name')}"})
+
+    def _handle(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        # The length is set per forwarded request, as requests over several shards are split
+        headers = {
+            k: v for k, v in self.headers.items() if k.lower() not in _HOP_BY_HOP | {"host", "content-length"}
+        }
+        path = urllib.parse.urlsplit(self.path).path
+
+        match = _SHARD_PATH.match(path)
+        if match is not None:
+            self._admin(match, body)
+        elif not self.dispatcher.shards:
+            self._json(503, {"error": "There are no shards"})
+        elif self.command == "POST" and path.rstrip("/") == "/api/v1/predict":
+            self._respond(*self.dispatcher.predict(self.path, body, headers))
+        elif self.command == "POST" and path.rstrip("/") == "/api/v1/events":
+            self._respond(*self.dispatcher.ingest(self.path, body, headers))
+        else:
+            shard = self.dispatcher.shards[self.dispatcher.ring.nodes[0]]
+            self._respond(*self.dispatcher.forward(shard, self.command, self.path, body, headers))
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, format: str, *args: object) -> None:
+        """Keep the dispatcher quiet, the workers log their own requests."""
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=0, help="the number of worker processes to spawn")
+    parser.add_argument("--upstream", nargs="*", default=[], help="the addresses of already running workers")
+    parser.add_argument("--replicas", type=int, default=128, help="the number of virtual nodes per shard")
+    args = parser.parse_args()
+
+    dispatcher = Dispatcher(replicas=args.replicas)
+    for url in args.upstream:
+        dispatcher.add(url)
+    for _ in range(args.workers):
+        dispatcher.add()
+
+    DispatchHandler.dispatcher = dispatcher
+    server = http.server.ThreadingHTTPServer((args.host, args.port), DispatchHandler)
+    logging.info(f"Dispatching http://{args.host}:{args.port} over {len(dispatcher.shards)} shards")
+    try:
+        server.serve_forever()
+    finally:
+        dispatcher.close()
@@ -0,0 +1,153 @@
+"""Serve several trained top-n models as a single blended ranking.
+
+Every member model scores the request concurrently on a thread pool, which
+pays off for models that spend their time in NumPy and release the GIL. The
+top lists of the members are merged with vectorized weighted-score or
+reciprocal-rank blending, and the latency of every member is reported.
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import datetime
+import os
+import time
+import typing
+
+import numpy
+import pandas
+
+from abstract_top_n_model import TrainedTopNModel
+
+#: The constant of reciprocal rank fusion, dampens the advantage of the very first ranks
+RRF_K = 60
+
+
+class Ensemble:
+    """Blend the top-n lists of several trained models.
+
+    Attributes:
+        names    : The unique name of every member, used in latency breakdowns
+        members  : The trained models
+        weights  : The weight of every member in the blend
+        blending : "weighted" to sum min-max normalized scores, "rank" for reciprocal rank fusion
+        depth    : The factor of n that every member returns as candidates for the blend
+    """
+
+    def __init__(
+        self,
+        members: list[TrainedTopNModel],
+        weights: list[float] | None = None,
+        blending: str = "weighted",
+        depth: int = 2,
+    ):
+        assert members, ValueError("An ensemble needs at least one model")
+        assert blending in ("weighted", "rank"), ValueError(f"Unknown blending {blending}")
+        self.members = members
+        self.weights = weights or [1.0] * len(members)
+        self.blending = blending
+        self.depth = depth
+
+        self.names = []
+        for i, member in enumerate(members):
+            name = type(member.model).__name__
+            self.names.append(name if name not in self.names else f"{name}-{i}")
+        self._pool = concurrent.futures.ThreadPoolExecutor(len(members), thread_name_prefix="ensemble")
+
+    @classmethod
+    def from_spec(
+        cls, spec: str, load: typing.Callable[[str], TrainedTopNModel], blending: str = "weighted"
+    ) -> Ensemble:
+        """Load an ensemble from a spec like `model.joblib:0.7,popularity.joblib:0.3`, weights default to 1."""
+        paths, weights = [], []
+        for member in spec.split(","):
+            path, separator, weight = member.strip().rpartition(":")
+            if not separator:
+                path, weight = weight, "1"
+            paths.append(path)
+            weights.append(float(weight))
+        return cls([load(path) for path in paths], weights, blending)
+
+    def _score(
+        self, member: TrainedTopNModel, timestamp: datetime.datetime, from_ids: list[str], n: int
+    ) -> tuple[list[dict[str, typing.Any]], float]:
+        started = time.perf_counter()
+        recommendations = member.model.predict(timestamp, from_ids, n)
+        return recommendations, time.perf_counter() - started
+
+    def predict(
+        self, timestamp: datetime.datetime, from_ids: list[str], n: int
+    ) -> tuple[list[dict[str, str | list[float] | list[str]]], dict[str, float]]:
+        """Score the anchors on all members concurrently and blend the results.
+
+        Returns:
+            The blended recommendations in the format of `TopNModel.predict` and
+            the latency in seconds per member and of the blend itself
+        """
+        futures = [self._pool.submit(self._score, m, timestamp, from_ids, n * self.depth) for m in self.members]
+        results = [future.result() for future in futures]
+        timings = {name: seconds for name, (_, seconds) in zip(self.names, results)}
+
+        started = time.perf_counter()
+        blended = self._blend([recommendations for recommendations, _ in results], len(from_ids), n)
+        timings["blend"] = time.perf_counter() - started
+
+        creation_time = datetime.datetime.now(datetime.timezone.utc).astimezone().isoformat()
+        first = self.members[0]
+        return [
+            {
+                "from_key": a,
+                "from_key_type": first.input_type.value,
+                "to_key_type": first.output_type.value,
+                "scores": scores,
+                "items": items,
+                "datetime_context": timestamp.isoformat(),
+                "datetime_created": creation_time,
+                "recommender": "ensemble",
+            }
+            for a, (items, scores) in zip(from_ids, blended)
+        ], timings
+
+    def _contributions(self, recommendations: list[dict[str, typing.Any]], weight: float) -> pandas.DataFrame:
+        """Flatten the top lists of one member into weighted (anchor, item, score) rows."""
+        lengths = numpy.fromiter((len(r["items"]) for r in recommendations), dtype=numpy.int64)
+        anchors = numpy.repeat(numpy.arange(len(recommendations)), lengths)
+        items = numpy.fromiter((i for r in recommendations for i in r["items"]), dtype=object, count=lengths.sum())
+
+        if self.blending == "rank":
+            ranks = numpy.arange(len(items)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+            scores = weight / (RRF_K + ranks + 1)
+        else:
+            raw = numpy.fromiter(
+                (s for r in recommendations for s in r["scores"]), dtype=numpy.float64, count=lengths.sum()
+            )
+            frame = pandas.DataFrame({"anchor": anchors, "score": raw})
+            low = frame.groupby("anchor")["score"].transform("min").to_numpy()
+            high = frame.groupby("anchor")["score"].transform("max").to_numpy()
+            spread = numpy.where(high > low, high - low, 1.0)
+            scores = weight * numpy.where(high > low, (raw - low) / spread, 1.0)
+        return pandas.DataFrame({"anchor": anchors, "item": items, "score": scores})
+
+    def _blend(
+        self, member_recommendations: list[list[dict[str, typing.Any]]], n_anchors: int, n: int
+    ) -> list[tuple[list[str], list[float]]]:
+        """Sum the contributions per (anchor, item) and keep the n best items per anchor."""
+        rows = pandas.concat(
+            [self._contributions(r, w) for r, w in zip(member_recommendations, self.weights)], ignore_index=True
+        )
+        summed = rows.groupby(["anchor", "item"], sort=False)["score"].sum().reset_index()
+        summed = summed.sort_values(["anchor", "score"], ascending=[True, False], kind="stable")
+        summed = summed[summed.groupby("anchor").cumcount() < n]
+
+        anchors = summed["anchor"].to_numpy()
+        bounds = numpy.searchsorted(anchors, numpy.arange(n_anchors + 1))
+        items = summed["item"].tolist()
+        scores = summed["score"].tolist()
+        return [(items[bounds[a] : bounds[a + 1]], scores[bounds[a] : bounds[a + 1]]) for a in range(n_anchors)]
+
+
+def from_environment(load: typing.Callable[[str], typing.Any]) -> Ensemble | None:
+    """Create the ensemble configured by `ENSEMBLE_MODELS` and `ENSEMBLE_BLENDING`, if any."""
+    spec = os.environ.get("ENSEMBLE_MODELS")
+    if not spec:
+        return None
+    return Ensemble.from_spec(spec, load, blending=os.environ.get("ENSEMBLE_BLENDING", "weighted"))
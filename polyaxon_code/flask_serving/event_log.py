@@ -0,0 +1,170 @@
+"""An append-only log of ingested events with group commit.
+
+Request threads hand their events to a single writer thread and wait until
+they are durable. The writer drains everything that queued up while it was
+busy and commits it with one write and one fsync, so the cost of an fsync is
+shared by all concurrent requests instead of paid by each of them.
+
+Events are stored as JSON lines of `[timestamp, user, item, weight]`. The
+writer thread is started on first use in every process, so a log opened before
+gunicorn forks its workers (`--preload`) works in each of them.
+
+With `max_bytes`, a log that grows past it is rotated: it becomes `<path>.1`,
+replacing the previous one, and a new file is started. Only the last
+`2 * max_bytes` of events are kept, which bounds the disk use and the replay
+on startup. The workers that share a log rotate it under a file lock and
+reopen it when another worker rotated it.
+"""
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+import pathlib
+import threading
+import typing
+
+
+class _Pending:
+    """A batch of encoded events waiting for the writer."""
+
+    __slots__ = ("payload", "committed", "error")
+
+    def __init__(self, payload: bytes):
+        self.payload = payload
+        self.committed = threading.Event()
+        self.error: Exception | None = None
+
+
+class EventLog:
+    """Appends batches of events to a file from a background writer thread.
+
+    Attributes:
+        path      : The file the events are appended to
+        commits   : The number of group commits, i.e. fsyncs
+        batches   : The number of batches committed
+        max_bytes : The size past which the log is rotated, None to never rotate it
+    """
+
+    def __init__(self, path: pathlib.Path, sync: bool = True, max_bytes: int | None = None):
+        assert max_bytes is None or max_bytes > 0, ValueError("The maximum size of the log should be positive")
+        self.path = pathlib.Path(path)
+        self.sync = sync
+        self.max_bytes = max_bytes
+        self.commits = 0
+        self.batches = 0
+        self._file = open(self.path, "ab")
+        self._pending: list[_Pending] = []
+        self._condition = threading.Condition()
+        self._closed = False
+        self._writer: threading.Thread | None = None
+        self._writer_pid: int | None = None
+
+    def _ensure_writer(self) -> None:
+        """Start the writer thread of this process, threads do not survive a fork, or restart it when it died."""
+        if self._writer_pid != os.getpid():
+            self._pending = []
+        if self._writer_pid != os.getpid() or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._write_loop, name="event-log", daemon=True)
+            self._writer_pid = os.getpid()
+            self._writer.start()
+
+    def append(self, events: typing.Iterable[tuple[str, str, str, float]]) -> None:
+        """Append a batch of `(timestamp, user, item, weight)` events and wait until they are committed.
+
+        Raises:
+            OSError: The commit failed, e.g. because the disk is full
+        """
+        pending = _Pending(b"".join(json.dumps(list(event)).encode() + b"\n" for event in events))
+        with self._condition:
+            assert not self._closed, ValueError(f"The event log {self.path} is closed")
+            self._ensure_writer()
+            self._pending.append(pending)
+            self._condition.notify()
+        pending.committed.wait()
+        if pending.error is not None:
+            raise OSError(f"Could not commit events to {self.path}") from pending.error
+
+    def _write_loop(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                group, self._pending = self._pending, []
+
+            error = None
+            try:
+                if self.max_bytes is not None:
+                    self._follow_rotation()
+                self._file.write(b"".join(pending.payload for pending in group))
+                self._file.flush()
+                if self.sync:
+                    os.fsync(self._file.fileno())
+                if self.max_bytes is not None and self._file.tell() > self.max_bytes:
+                    self._rotate()
+            except Exception as e:
+                # Any error goes to the waiting requests, the writer keeps serving the next batches
+                error = e
+            self.commits += 1
+            self.batches += len(group)
+            for pending in group:
+                pending.error = error
+                pending.committed.set()
+
+    def _is_current(self) -> bool:
+        """Whether the open file is still the one at `path`, another worker may have rotated it."""
+        try:
+            return os.stat(self.path).st_ino == os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _reopen(self) -> None:
+        """Open the file at `path` and only then close the previous one, which is kept when the open fails."""
+        previous, self._file = self._file, open(self.path, "ab")
+        previous.close()
+
+    def _follow_rotation(self) -> None:
+        if not self._is_current():
+            self._reopen()
+
+    def _rotate(self) -> None:
+        """Move the log to `<path>.1` and start a new one, unless another worker did already."""
+        with open(f"{self.path}.lock", "ab") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self._is_current():
+                os.replace(self.path, rotated_path(self.path))
+            self._reopen()
+
+    def close(self) -> None:
+        """Commit the pending events and close the file."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._writer is not None and self._writer_pid == os.getpid():
+            self._writer.join()
+        self._file.close()
+
+
+def rotated_path(path: pathlib.Path) -> pathlib.Path:
+    """The file a log is moved to when it is rotated."""
+    return pathlib.Path(f"{path}.1")
+
+
+def read_log(path: pathlib.Path) -> typing.Iterator[tuple[str, str, str, float]]:
+    """Iterate over the events of a log that may have been rotated, oldest first."""
+    for segment in [rotated_path(path), pathlib.Path(path)]:
+        if segment.exists():
+            yield from read_events(segment)
+
+
+def read_events(path: pathlib.Path) -> typing.Iterator[tuple[str, str, str, float]]:
+    """Iterate over the events of a log, skipping a torn last line."""
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                timestamp, user, item, weight = json.loads(line)
+            except ValueError:
+                continue
+            yield timestamp, user, item, weight
@@ -0,0 +1,342 @@
+"""Lightweight latency and throughput instrumentation for the train and serve hot paths.
+
+Instrumented calls record a latency histogram, the number of rows handled,
+the peak resident set size of the process and (optionally) the bytes
+allocated during the call. Events which are not calls, such as the outcome of
+a request, are counted with labelled counters. When instrumentation is
+disabled, which is the default, a wrapped call costs a single attribute lookup.
+
+Instrumentation is switched on with the `TOPN_INSTRUMENTATION=1` environment
+variable or by calling `enable()`. Allocation tracing uses `tracemalloc`, which
+is considerably slower, and is therefore only switched on when explicitly
+requested (`TOPN_TRACE_ALLOCATIONS=1` or `enable(trace_allocations=True)`).
+
+Functions:
+    enable: Start recording instrumented calls
+    disable: Stop recording instrumented calls
+    get_registry: Return the process-wide registry of recorded calls
+    rss_bytes: Return the current resident set size of this process
+    peak_rss_bytes: Return the peak resident set size of this process
+    process_memory: Return the resident, proportional and unique set size of a process
+    instrumented: Decorator which records every call to the wrapped function
+"""
+from __future__ import annotations
+
+import bisect
+import functools
+import os
+import sys
+import threading
+import time
+import typing
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None  # type: ignore
+
+#: Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS: tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0,
+)
+
+
+def rss_bytes() -> int:
+    """Return the current resident set size of this process in bytes, 0 when unknown."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def peak_rss_bytes() -> int:
+    """Return the peak resident set size of this process in bytes."""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def process_memory(pid: int | str = "self") -> dict[str, int]:
+    """Return the memory of a process in bytes, read from `/proc/<pid>/smaps_rollup` (Linux 4.14 and later).
+
+    The unique set size (uss) counts the pages only this process maps, which is
+    what it costs to add the process, e.g. another gunicorn worker. The
+    proportional set size (pss) splits every shared page evenly between the
+    processes that map it, so the pss of all workers adds up to their total
+    memory. Returns an empty dict when the memory cannot be read.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as rollup:
+            lines = rollup.readlines()
+    except OSError:
+        return {}
+    fields = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        parts = value.split()
+        if len(parts) == 2 and parts[1] == "kB":
+            fields[name] = int(parts[0]) * 1024
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "uss": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+        "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+    }
+
+
+class CallStats:
+    """Aggregated measurements of a single instrumented call site."""
+
+    __slots__ = ("buckets", "counts", "calls", "seconds", "rows", "peak_rss", "allocated", "last_rows_per_second")
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.peak_rss = 0
+        self.allocated = 0
+        self.last_rows_per_second = 0.0
+
+    def observe(self, seconds: float, rows: int | None, allocated: int | None) -> None:
+        """Add the measurements of a single call."""
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.calls += 1
+        self.seconds += seconds
+        if rows is not None:
+            self.rows += rows
+            self.last_rows_per_second = rows / seconds if seconds > 0 else 0.0
+        if allocated is not None:
+            self.allocated += allocated
+        self.peak_rss = max(self.peak_rss, peak_rss_bytes())
+
+    def quantile(self, q: float) -> float:
+        """Estimate a latency quantile by interpolating within the histogram buckets."""
+        if self.calls == 0:
+            return 0.0
+        target = q * self.calls
+        cumulative = 0
+        lower = 0.0
+        for upper, count in zip(self.buckets, self.counts):
+            if count and cumulative + count >= target:
+                return lower + (upper - lower) * (target - cumulative) / count
+            cumulative += count
+            lower = upper
+        # Everything above the largest bucket is reported as that bucket
+        return self.buckets[-1]
+
+
+class Registry:
+    """Thread-safe collection of the statistics of all instrumented calls.
+
+    Attributes:
+        enabled           : Whether instrumented calls are recorded at all
+        trace_allocations : Whether to measure allocations using tracemalloc
+    """
+
+    def __init__(self, enabled: bool = False, trace_allocations: bool = False):
+        self.enabled = enabled
+        self.trace_allocations = trace_allocations
+        self._stats: dict[str, CallStats] = {}
+        self._counters: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float, rows: int | None = None, allocated: int | None = None) -> None:
+        """Record the measurements of a single call of `name`."""
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = CallStats()
+            stats.observe(seconds, rows, allocated)
+
+    def increment(self, name: str, amount: float = 1, **labels: str) -> None:
+        """Add to the counter `name` with the given labels, does nothing when disabled.
+
+        Example:
+            registry.increment("serving_degradation", mode="fallback")
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def call(
+        self,
+        name: str,
+        func: typing.Callable[..., typing.Any],
+        rows: typing.Callable[[typing.Any], int] | None,
+        args: tuple[typing.Any, ...],
+        kwargs: dict[str, typing.Any],
+    ) -> typing.Any:
+        """Call `func` and record its latency, throughput and allocations under `name`."""
+        tracing = self.trace_allocations
+        if tracing:
+            import tracemalloc
+
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+
+        # Nested instrumented calls reset the peak as well, so this is an estimate
+        allocated = max(tracemalloc.get_traced_memory()[1] - before, 0) if tracing else None
+        self.observe(name, seconds, rows(result) if rows is not None else None, allocated)
+        return result
+
+    def reset(self) -> None:
+        """Forget all recorded calls and counters."""
+        with self._lock:
+            self._stats.clear()
+            self._counters.clear()
+
+    def snapshot(self) -> dict[str, CallStats]:
+        """Return a copy of the statistics per call site."""
+        with self._lock:
+            return dict(self._stats)
+
+    def counters(self) -> dict[tuple[str, tuple[tuple[str, str], ...]], float]:
+        """Return a copy of the counters, keyed by name and sorted (label, value) pairs."""
+        with self._lock:
+            return dict(self._counters)
+
+    def as_metrics(self) -> dict[str, float]:
+        """Return the recorded statistics as flat metrics, e.g. for `polyaxon.tracking.log_metrics`."""
+        metrics: dict[str, float] = {}
+        for name, stats in self.snapshot().items():
+            key = name.replace(".", "_").lower()
+            metrics[f"{key}_calls"] = stats.calls
+            metrics[f"{key}_seconds_total"] = stats.seconds
+            metrics[f"{key}_seconds_p50"] = stats.quantile(0.5)
+            metrics[f"{key}_seconds_p99"] = stats.quantile(0.99)
+            metrics[f"{key}_peak_rss_mb"] = stats.peak_rss / 2**20
+            if stats.rows:
+                metrics[f"{key}_rows_per_second"] = stats.rows / stats.seconds if stats.seconds > 0 else 0.0
+            if stats.allocated:
+                metrics[f"{key}_allocated_mb_per_call"] = stats.allocated / stats.calls / 2**20
+        for (name, labels), value in self.counters().items():
+            metrics["_".join([name, *(v for _, v in labels)]).replace(".", "_").lower()] = value
+        return metrics
+
+    def render_prometheus(self) -> str:
+        """Render the recorded statistics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP topn_call_duration_seconds Latency of instrumented calls.",
+            "# TYPE topn_call_duration_seconds histogram",
+        ]
+        for name, stats in snapshot.items():
+            cumulative = 0
+            for upper, count in zip(stats.buckets, stats.counts):
+                cumulative += count
+                lines.append(f'topn_call_duration_seconds_bucket{{call="{name}",le="{upper}"}} {cumulative}')
+            lines.append(f'topn_call_duration_seconds_bucket{{call="{name}",le="+Inf"}} {stats.calls}')
+            lines.append(f'topn_call_duration_seconds_sum{{call="{name}"}} {stats.seconds}')
+            lines.append(f'topn_call_duration_seconds_count{{call="{name}"}} {stats.calls}')
+
+        gauges = [
+            ("topn_call_rows_total", "counter", "Rows handled by instrumented calls.", lambda s: s.rows),
+            (
+                "topn_call_rows_per_second",
+                "gauge",
+                "Throughput of the most recent instrumented call.",
+                lambda s: s.last_rows_per_second,
+            ),
+            (
+                "topn_call_allocated_bytes_total",
+                "counter",
+                "Bytes allocated during instrumented calls.",
+                lambda s: s.allocated,
+            ),
+            (
+                "topn_call_peak_rss_bytes",
+                "gauge",
+                "Peak resident set size after instrumented calls.",
+                lambda s: s.peak_rss,
+            ),
+        ]
+        for metric, kind, description, value in gauges:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, stats in snapshot.items():
+                lines.append(f'{metric}{{call="{name}"}} {value(stats)}')
+
+        counters = self.counters()
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE topn_{name}_total counter")
+            for (counter, labels), value in counters.items():
+                if counter == name:
+                    label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                    lines.append(f"topn_{name}_total{{{label_text}}} {value}")
+
+        memory = process_memory()
+        if memory:
+            lines.append("# HELP topn_process_memory_bytes Memory of this process by kind (rss, pss, uss, shared).")
+            lines.append("# TYPE topn_process_memory_bytes gauge")
+            for kind, value in memory.items():
+                lines.append(f'topn_process_memory_bytes{{kind="{kind}",pid="{os.getpid()}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+_REGISTRY = Registry(
+    enabled=os.environ.get("TOPN_INSTRUMENTATION", "0") == "1",
+    trace_allocations=os.environ.get("TOPN_TRACE_ALLOCATIONS", "0") == "1",
+)
+
+
+def get_registry() -> Registry:
+    """Return the process-wide registry of instrumented calls."""
+    return _REGISTRY
+
+
+def enable(trace_allocations: bool | None = None) -> None:
+    """Start recording instrumented calls.
+
+    Args:
+        trace_allocations: Also measure allocations per call, leaves the current
+                           setting untouched when None.
+    """
+    _REGISTRY.enabled = True
+    if trace_allocations is not None:
+        _REGISTRY.trace_allocations = trace_allocations
+
+
+def disable() -> None:
+    """Stop recording instrumented calls."""
+    _REGISTRY.enabled = False
+
+
+def instrumented(
+    name: str | None = None,
+    rows: typing.Callable[[typing.Any], int] | None = None,
+) -> typing.Callable[[typing.Callable[..., typing.Any]], typing.Callable[..., typing.Any]]:
+    """Record the latency and throughput of every call to the decorated function.
+
+    Args:
+        name: The name under which calls are recorded, defaults to the qualified
+              name of the function.
+        rows: Function which derives the number of rows handled from the result
+              of a call, used to compute the throughput.
+    """
+
+    def decorator(func: typing.Callable[..., typing.Any]) -> typing.Callable[..., typing.Any]:
+        call_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            if not _REGISTRY.enabled:
+                return func(*args, **kwargs)
+            return _REGISTRY.call(call_name, func, rows, args, kwargs)
+
+        wrapper.__instrumented__ = True  # type: ignore
+        return wrapper
+
+    return decorator
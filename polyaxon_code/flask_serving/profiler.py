@@ -0,0 +1,114 @@
+"""An opt-in statistical profiler for selected serving requests.
+
+A single background thread periodically samples the Python stacks of all
+threads that are currently handling a profiled request. The samples are
+aggregated as "folded" stacks (`frame;frame;frame count`), which can be
+rendered by flamegraph.pl, speedscope and most other flamegraph tools.
+
+Requests are profiled when they carry the `X-Profile: 1` header or when they
+are picked by the sampling rate. When neither applies, selecting a request
+costs a header lookup and a float comparison.
+"""
+from __future__ import annotations
+
+import collections
+import contextlib
+import random
+import sys
+import threading
+import time
+import types
+import typing
+
+#: The header used to request a profile of a single request
+PROFILE_HEADER = "X-Profile"
+
+
+def _fold(frame: types.FrameType | None) -> str:
+    """Fold a stack into a single `outer;...;inner` line."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """Collects folded stack samples of the threads handling profiled requests.
+
+    Attributes:
+        sample_rate : The fraction of requests profiled without the header
+        interval    : The number of seconds between two samples
+        max_stacks  : The maximum number of distinct stacks kept in memory
+    """
+
+    def __init__(self, sample_rate: float = 0.0, interval: float = 0.005, max_stacks: int = 10_000):
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.profiled_requests = 0
+        self.dropped_samples = 0
+        self._stacks: collections.Counter[str] = collections.Counter()
+        self._active: dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._sampler: threading.Thread | None = None
+
+    def selected(self, headers: typing.Mapping[str, str]) -> bool:
+        """Return whether the request with the given headers should be profiled."""
+        if headers.get(PROFILE_HEADER) == "1":
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    @contextlib.contextmanager
+    def profile(self, label: str) -> typing.Iterator[None]:
+        """Sample the calling thread while the context is active, with `label` as the root frame."""
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._active[thread_id] = label
+            self.profiled_requests += 1
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+                self._sampler.start()
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._active[thread_id]
+
+    def maybe_profile(self, headers: typing.Mapping[str, str], label: str) -> typing.ContextManager[None]:
+        """Profile the calling thread when the request is selected, otherwise do nothing."""
+        if self.selected(headers):
+            return self.profile(label)
+        return contextlib.nullcontext()
+
+    def _sample(self) -> None:
+        while True:
+            with self._lock:
+                if not self._active:
+                    # Stop sampling, the next profiled request starts a new sampler
+                    self._sampler = None
+                    return
+                active = dict(self._active)
+
+            frames = sys._current_frames()
+            samples = [f"{label};{_fold(frames.get(thread_id))}" for thread_id, label in active.items()]
+            with self._lock:
+                for stack in samples:
+                    if stack in self._stacks or len(self._stacks) < self.max_stacks:
+                        self._stacks[stack] += 1
+                    else:
+                        self.dropped_samples += 1
+            time.sleep(self.interval)
+
+    def render_folded(self) -> str:
+        """Return all samples as folded stacks, one `stack count` pair per line."""
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+    def reset(self) -> None:
+        """Forget all collected samples."""
+        with self._lock:
+            self._stacks.clear()
+            self.profiled_requests = 0
+            self.dropped_samples = 0
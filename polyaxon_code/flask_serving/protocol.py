@@ -0,0 +1,94 @@
+"""A compact binary encoding of predict requests and responses.
+
+JSON spends most of its time on the per-element encoding of long item and
+score lists. The binary protocol uses MessagePack and lays the response out in
+columns: the items of all anchors are a single flat string array, their
+boundaries are an int32 offset buffer and the scores are a raw float32 buffer,
+so encoding and decoding the numbers is a single copy.
+
+Request:  {"from_ids": [str, ...], "n": int}
+Response: {"offsets": int32 bytes, "items": [str, ...], "scores": float32 bytes,
+           "<field>": [value per anchor, ...] for every other recommendation field}
+
+MessagePack is an optional dependency, it is only imported once a client asks
+for the binary protocol. Without it servers only offer JSON, see `available`.
+"""
+from __future__ import annotations
+
+import functools
+import importlib.util
+import typing
+
+import numpy
+
+#: The media type of the binary protocol, used in Content-Type and Accept headers
+MSGPACK = "application/msgpack"
+
+
+@functools.lru_cache(maxsize=None)
+def available() -> bool:
+    """Whether msgpack is installed, without importing it."""
+    return importlib.util.find_spec("msgpack") is not None
+
+
+def media_types() -> list[str]:
+    """The media types a server can answer in, JSON first."""
+    return ["application/json", MSGPACK] if available() else ["application/json"]
+
+
+def _msgpack() -> typing.Any:
+    try:
+        import msgpack
+    except ImportError as e:
+        raise ImportError(f"The {MSGPACK} protocol requires msgpack, install it with `pip install msgpack`") from e
+    return msgpack
+
+
+def encode_request(from_ids: list[str], n: int) -> bytes:
+    """Encode a predict request for a batch of anchors."""
+    return _msgpack().packb({"from_ids": list(from_ids), "n": int(n)})
+
+
+def decode_request(payload: bytes) -> dict[str, typing.Any]:
+    """Decode a predict request into the same dictionary as its JSON counterpart."""
+    return _msgpack().unpackb(payload, raw=False)
+
+
+def encode_recommendations(recommendations: list[dict[str, typing.Any]]) -> bytes:
+    """Encode the output of `TopNModel.predict` into columns."""
+    lengths = numpy.fromiter((len(r["items"]) for r in recommendations), dtype=numpy.int32, count=len(recommendations))
+    offsets = numpy.zeros(len(recommendations) + 1, dtype=numpy.int32)
+    numpy.cumsum(lengths, out=offsets[1:])
+    scores = numpy.fromiter(
+        (s for r in recommendations for s in r["scores"]), dtype=numpy.float32, count=int(offsets[-1])
+    )
+
+    columns: dict[str, typing.Any] = {
+        "offsets": offsets.tobytes(),
+        "items": [i for r in recommendations for i in r["items"]],
+        "scores": scores.tobytes(),
+    }
+    for field in recommendations[0] if recommendations else ():
+        if field not in columns:
+            columns[field] = [r[field] for r in recommendations]
+    return _msgpack().packb(columns)
+
+
+def decode_recommendations(payload: bytes) -> list[dict[str, typing.Any]]:
+    """Decode a binary response into the format of `TopNModel.predict`.
+
+    The scores of every anchor are a read-only float32 view on the payload
+    instead of a list of floats.
+    """
+    columns = _msgpack().unpackb(payload, raw=False)
+    offsets = numpy.frombuffer(columns.pop("offsets"), dtype=numpy.int32)
+    items = columns.pop("items")
+    scores = numpy.frombuffer(columns.pop("scores"), dtype=numpy.float32)
+    return [
+        {
+            **{field: values[a] for field, values in columns.items()},
+            "items": items[start:end],
+            "scores": scores[start:end],
+        }
+        for a, (start, end) in enumerate(zip(offsets[:-1].tolist(), offsets[1:].tolist()))
+    ]
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import threading
+import typing
+
+import numpy
+
+
+class RecentHistory:
+    """The last `size` items of every user, kept in preallocated ring buffers.
+
+    Items are stored as int32 codes into a vocabulary in one `(capacity, size)`
+    array, with a row per user, so an event costs a few bytes and reading the
+    history of a batch of users is a single gather. When all rows are taken,
+    the user that was least recently active is evicted. The vocabulary is
+    compacted to the items still in a row whenever it has doubled, so it does
+    not grow with every item ever ingested.
+
+    Models read the history of their anchors through `TopNModel.recent_items`,
+    e.g. to leave out the items a user has just watched.
+
+    Example:
+    >>> history = RecentHistory(size=3, capacity=2)
+    >>> history.extend(["a", "a", "b", "a", "a"], ["i1", "i2", "i1", "i3", "i4"])
+    >>> history.recent_items(["a", "b", "c"])
+    [['i4', 'i3', 'i2'], ['i1'], []]
+    >>> history.extend(["c"], ["i9"])  # evicts one of the least recently active users
+    >>> history.recent_items(["a", "b", "c"])
+    [[], ['i1'], ['i9']]
+    """
+
+    def __init__(self, size: int = 32, capacity: int = 100_000, min_compaction: int = 65_536):
+        assert size > 0 and capacity > 0, ValueError("The size and capacity should be positive")
+        self.size = size
+        self.capacity = capacity
+        self._codes = numpy.full((capacity, size), -1, dtype=numpy.int32)
+        # The number of events written to every row, the next one goes to `count % size`
+        self._counts = numpy.zeros(capacity, dtype=numpy.int64)
+        # The sequence number of the latest event of every row, used to evict the least recently active user
+        self._last_active = numpy.zeros(capacity, dtype=numpy.int64)
+        self._rows: dict[str, int] = {}
+        self._owners: list[str | None] = [None] * capacity
+        self._vocabulary: dict[str, int] = {}
+        self._items: list[str] = []
+        # The vocabulary size at which it is compacted next
+        self._min_compaction = min_compaction
+        self._compact_at = min_compaction
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _reserve(self, users: list[str]) -> dict[str, int]:
+        """Assign a row to every user of a batch at once, evicting only users outside the batch.
+
+        Args:
+            users: The distinct users of the batch, at most `capacity` of them
+
+        Returns:
+            The row of every user
+        """
+        rows = {u: self._rows[u] for u in users if u in self._rows}
+        new = [u for u in users if u not in rows]
+        free = list(range(len(self._rows), min(len(self._rows) + len(new), self.capacity)))
+        evicted = len(new) - len(free)
+        if evicted > 0:
+            # The least recently active rows, the first rows first among equals, except the rows of the batch
+            age = self._last_active * self.capacity + numpy.arange(self.capacity)
+            age[list(rows.values()) + free] = numpy.iinfo(numpy.int64).max
+            victims = numpy.argpartition(age, evicted - 1)[:evicted]
+            victims = victims[numpy.argsort(age[victims])].tolist()
+            for row in victims:
+                del self._rows[self._owners[row]]
+            self._codes[victims] = -1
+            self._counts[victims] = 0
+            free += victims
+        for user, row in zip(new, free):
+            self._rows[user] = rows[user] = row
+            self._owners[row] = user
+        return rows
+
+    def _code(self, item: str) -> int:
+        code = self._vocabulary.get(item)
+        if code is None:
+            code = self._vocabulary[item] = len(self._items)
+            self._items.append(item)
+        return code
+
+    def extend(self, users: typing.Sequence[str], items: typing.Sequence[str]) -> None:
+        """Append a batch of events, in chronological order."""
+        if not len(users):
+            return
+        with self._lock:
+            self._sequence += 1
+            # A batch with more users than rows only keeps the most recently active ones, as eviction would
+            distinct = list(dict.fromkeys(reversed(users)))
+            if len(distinct) > self.capacity:
+                kept = set(distinct[: self.capacity])
+                users, items = zip(*((u, i) for u, i in zip(users, items) if u in kept))
+            assigned = self._reserve(list(dict.fromkeys(users)))
+            rows = numpy.fromiter((assigned[u] for u in users), dtype=numpy.int64, count=len(users))
+            codes = numpy.fromiter((self._code(i) for i in items), dtype=numpy.int32, count=len(items))
+            self._last_active[rows] = self._sequence
+
+            # Number the events of every row within the batch, keeping only the last `size` of them
+            order = numpy.argsort(rows, kind="stable")
+            sorted_rows = rows[order]
+            starts = numpy.flatnonzero(numpy.r_[True, sorted_rows[1:] != sorted_rows[:-1]])
+            lengths = numpy.diff(numpy.r_[starts, len(rows)])
+            rank = numpy.arange(len(rows)) - numpy.repeat(starts, lengths)
+            keep = rank >= numpy.repeat(lengths, lengths) - self.size
+
+            unique_rows = sorted_rows[starts]
+            positions = (self._counts[sorted_rows] + rank) % self.size
+            self._codes[sorted_rows[keep], positions[keep]] = codes[order][keep]
+            self._counts[unique_rows] += lengths
+            if len(self._items) > self._compact_at:
+                self._compact()
+
+    def _compact(self) -> None:
+        """Drop the items no row holds anymore from the vocabulary and renumber the codes."""
+        used = numpy.unique(self._codes[self._codes >= 0])
+        renumber = numpy.full(len(self._items), -1, dtype=numpy.int32)
+        renumber[used] = numpy.arange(len(used), dtype=numpy.int32)
+        held = self._codes >= 0
+        self._codes[held] = renumber[self._codes[held]]
+        # A new list, readers keep the one that matches the codes they gathered
+        self._items = [self._items[code] for code in used.tolist()]
+        self._vocabulary = {item: code for code, item in enumerate(self._items)}
+        self._compact_at = max(2 * len(self._items), self._min_compaction)
+
+    def recent_codes(self, users: typing.Sequence[str]) -> tuple[numpy.ndarray, list[str]]:
+        """Return the item codes of the users, most recent first and padded with -1, and the vocabulary."""
+        with self._lock:
+            rows = numpy.fromiter((self._rows.get(u, -1) for u in users), dtype=numpy.int64, count=len(users))
+            known = rows >= 0
+            counts = numpy.where(known, self._counts[rows], 0)
+            # Walk back from the latest position of every ring
+            offsets = (counts[:, None] - 1 - numpy.arange(self.size)[None, :]) % self.size
+            codes = self._codes[rows[:, None], offsets]
+            codes[~known] = -1
+            codes[numpy.arange(self.size)[None, :] >= counts[:, None]] = -1
+            return codes, self._items
+
+    def recent_items(self, users: typing.Sequence[str]) -> list[list[str]]:
+        """Return the recent items of every user, most recent first."""
+        codes, items = self.recent_codes(users)
+        return [[items[c] for c in row if c >= 0] for row in codes.tolist()]
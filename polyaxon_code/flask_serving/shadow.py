@@ -0,0 +1,269 @@
+"""Compare a candidate model with the live model on real traffic, off the hot path.
+
+Every anchor is hashed, with a salt, to a fixed point in [0, 1), so a profile
+always lands in the same arm:
+
+    [0, ab_share)                        : served by the candidate (the A/B split)
+    [ab_share, ab_share + shadow_share)  : served by the live model and scored by the candidate in the background
+    the rest                             : served by the live model only
+
+Shadow scoring happens on a small pool of worker threads behind a bounded
+queue. The request only hashes its anchors and enqueues the live
+recommendations, when the queue is full the job is dropped and counted rather
+than slowing the request down. The workers record how much the candidate agrees
+with the live model (overlap@n and agreement on the first item) and how much
+slower or faster it is per anchor. The request predicts its live arm as one
+batch, so with a `live` predict function the workers time the live model
+again on the shadowed anchors alone, so both models are timed on batches of
+the same size without a second model call on the request path. Both arms
+answer the anchors a model has never seen with the popularity fallback, when
+there is one.
+
+The workers are threads of the serving process, so the Python parts of
+candidate scoring hold the GIL and delay the requests. The share of shadowed
+anchors (`SHADOW_SHARE`) therefore defaults to a small 1%, and every worker
+sleeps after a job so it runs at most `duty_cycle` of the time, which caps the
+CPU taken from the requests when the load grows. A candidate that needs more
+should be scored in a separate process, e.g. a replica of the app that serves
+the candidate to a mirror of the traffic.
+"""
+from __future__ import annotations
+
+import collections
+import datetime
+import os
+import queue
+import threading
+import time
+import typing
+
+import numpy
+import pandas
+
+import instrumentation
+from abstract_top_n_model import TrainedTopNModel
+
+
+def hash_unit(from_ids: list[str], salt: str) -> numpy.ndarray:
+    """Hash every anchor to a fixed point in [0, 1), a different salt reshuffles the anchors."""
+    keys = numpy.asarray([f"{salt}:{a}" for a in from_ids], dtype=object)
+    return pandas.util.hash_array(keys) / numpy.float64(2**64)
+
+
+class ShadowScorer:
+    """Route anchors to a candidate model and compare it with the live model in the background.
+
+    Attributes:
+        candidate    : The trained model under evaluation
+        ab_share     : The share of anchors served by the candidate
+        shadow_share : The share of anchors shadow-scored by the candidate
+        salt         : Salt of the anchor hash, change it to draw new arms
+        workers      : The number of shadow scoring threads
+        queue_size   : The number of shadow jobs that can wait, more are dropped
+        window       : The number of most recent anchors the agreement metrics are computed over
+        duty_cycle   : The fraction of the time a worker may spend scoring, it sleeps the rest
+        fallback     : The popularity model for the anchors the candidate has never seen, like the live model's
+        live         : Predicts with the live model, to time it on the shadowed anchors in the background
+    """
+
+    def __init__(
+        self,
+        candidate: TrainedTopNModel,
+        ab_share: float = 0.0,
+        shadow_share: float = 0.01,
+        salt: str = "candidate",
+        workers: int = 1,
+        queue_size: int = 64,
+        window: int = 10_000,
+        duty_cycle: float = 0.25,
+        fallback: TrainedTopNModel | None = None,
+        live: typing.Callable[[datetime.datetime, list[str], int], list[dict[str, typing.Any]]] | None = None,
+    ):
+        assert 0 <= ab_share and 0 <= shadow_share and ab_share + shadow_share <= 1, ValueError(
+            "The A/B and shadow shares should be fractions that add up to at most 1"
+        )
+        assert workers > 0, ValueError("Shadow scoring needs at least one worker")
+        assert 0 < duty_cycle <= 1, ValueError("The duty cycle should be a fraction larger than 0")
+        self.candidate = candidate
+        self.duty_cycle = duty_cycle
+        self.fallback = fallback
+        self.live = live
+        self.ab_share = ab_share
+        self.shadow_share = shadow_share
+        self.salt = salt
+        self.workers = workers
+        self.queue_size = queue_size
+        self.window = window
+        self._lock = threading.Lock()
+        self._queue: queue.Queue[tuple[typing.Any, ...]] = queue.Queue(queue_size)
+        self._pid: int | None = None
+        self.reset()
+
+    def split(self, from_ids: list[str]) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """Return for every anchor whether it is served by the candidate and whether it is shadow-scored."""
+        unit = hash_unit(from_ids, self.salt)
+        return unit < self.ab_share, (unit >= self.ab_share) & (unit < self.ab_share + self.shadow_share)
+
+    def predict(
+        self, timestamp: datetime.datetime, from_ids: list[str], n: int
+    ) -> list[dict[str, str | list[float] | list[str]]]:
+        """Predict with the candidate, and the fallback for the anchors it has never seen."""
+        if self.fallback is not None:
+            return self.fallback.model.predict_cold_start(self.candidate.model, timestamp, from_ids, n)
+        return self.candidate.model.predict(timestamp, from_ids, n)
+
+    def _ensure_workers(self) -> None:
+        """Start the workers of this process, threads do not survive a fork."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.queue_size)
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f"shadow-{i}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(
+        self,
+        timestamp: datetime.datetime,
+        from_ids: list[str],
+        n: int,
+        recommendations: list[dict[str, typing.Any]],
+        seconds: float,
+    ) -> bool:
+        """Queue the live recommendations of shadowed anchors for comparison, without waiting.
+
+        Args:
+            timestamp: The timestamp of the request
+            from_ids: The shadowed anchors
+            n: The number of recommendations of the request
+            recommendations: The live recommendations of the shadowed anchors
+            seconds: The live latency per anchor of the request, used unless the live model is timed again
+
+        Returns:
+            Whether the job was queued, it is dropped when the queue is full
+        """
+        if not from_ids:
+            return False
+        self._ensure_workers()
+        try:
+            self._queue.put_nowait((timestamp, from_ids, n, recommendations, seconds))
+        except queue.Full:
+            self._count("dropped")
+            return False
+        self._count("submitted")
+        return True
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self._outcomes[outcome] += 1
+        instrumentation.get_registry().increment("shadow_jobs", outcome=outcome)
+
+    def _work(self) -> None:
+        while True:
+            timestamp, from_ids, n, live, live_seconds = self._queue.get()
+            try:
+                started = time.perf_counter()
+                shadow = self.predict(timestamp, from_ids, n)
+                seconds = time.perf_counter() - started
+                live_elapsed = 0.0
+                if self.live is not None:
+                    started = time.perf_counter()
+                    self.live(timestamp, from_ids, n)
+                    live_elapsed = time.perf_counter() - started
+                    live_seconds = live_elapsed / len(from_ids)
+            except Exception:
+                self._count("failed")
+                continue
+            self._record(live, shadow, n, live_seconds, seconds / len(from_ids))
+            self._count("completed")
+            # Leave the GIL to the requests for the rest of the cycle
+            time.sleep((seconds + live_elapsed) * (1 / self.duty_cycle - 1))
+
+    def _record(
+        self,
+        live: list[dict[str, typing.Any]],
+        shadow: list[dict[str, typing.Any]],
+        n: int,
+        live_seconds: float,
+        seconds: float,
+    ) -> None:
+        """Add the agreement of every anchor and the latency delta per anchor to the window."""
+        overlaps = []
+        first = []
+        for live_rec, shadow_rec in zip(live, shadow):
+            live_items, shadow_items = live_rec["items"][:n], shadow_rec["items"][:n]
+            overlaps.append(len(set(live_items) & set(shadow_items)) / n if n else 1.0)
+            if live_items and shadow_items:
+                first.append(live_items[0] == shadow_items[0])
+        registry = instrumentation.get_registry()
+        if registry.enabled:
+            registry.observe("shadow.live", live_seconds, rows=len(live))
+            registry.observe("shadow.candidate", seconds, rows=len(shadow))
+        with self._lock:
+            self._overlaps.extend(overlaps)
+            self._first.extend(first)
+            self._deltas.append(seconds - live_seconds)
+            self._live_seconds.append(live_seconds)
+            self._candidate_seconds.append(seconds)
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Return the outcome counts and the agreement and latency over the window."""
+        with self._lock:
+            overlaps = numpy.asarray(self._overlaps, dtype=numpy.float64)
+            first = numpy.asarray(self._first, dtype=bool)
+            deltas = numpy.asarray(self._deltas, dtype=numpy.float64)
+            live = numpy.asarray(self._live_seconds, dtype=numpy.float64)
+            candidate = numpy.asarray(self._candidate_seconds, dtype=numpy.float64)
+            outcomes = dict(self._outcomes)
+
+        def percentiles(values: numpy.ndarray, scale: float = 1.0) -> dict[str, float | None]:
+            if not len(values):
+                return {"mean": None, "p50": None, "p90": None, "p99": None}
+            p50, p90, p99 = numpy.percentile(values, [50, 90, 99]) * scale
+            return {"mean": float(values.mean() * scale), "p50": float(p50), "p90": float(p90), "p99": float(p99)}
+
+        return {
+            "candidate": type(self.candidate.model).__name__,
+            "ab_share": self.ab_share,
+            "shadow_share": self.shadow_share,
+            "queued": self._queue.qsize(),
+            "jobs": outcomes,
+            "anchors": len(overlaps),
+            "overlap_at_n": percentiles(overlaps),
+            "first_item_agreement": float(first.mean()) if len(first) else None,
+            "live_ms_per_anchor": percentiles(live, 1000),
+            "candidate_ms_per_anchor": percentiles(candidate, 1000),
+            "delta_ms_per_anchor": percentiles(deltas, 1000),
+        }
+
+    def reset(self) -> None:
+        """Forget the recorded outcomes and metrics."""
+        with self._lock:
+            self._outcomes = collections.Counter({"submitted": 0, "dropped": 0, "completed": 0, "failed": 0})
+            self._overlaps: collections.deque[float] = collections.deque(maxlen=self.window)
+            self._first: collections.deque[bool] = collections.deque(maxlen=self.window)
+            self._deltas: collections.deque[float] = collections.deque(maxlen=self.window)
+            self._live_seconds: collections.deque[float] = collections.deque(maxlen=self.window)
+            self._candidate_seconds: collections.deque[float] = collections.deque(maxlen=self.window)
+
+
+def from_environment(
+    load: typing.Callable[[str], TrainedTopNModel],
+    fallback: TrainedTopNModel | None = None,
+    live: typing.Callable[[datetime.datetime, list[str], int], list[dict[str, typing.Any]]] | None = None,
+) -> ShadowScorer | None:
+    """Create the shadow scorer of `CANDIDATE_MODEL_PATH`, if any, configured by the environment."""
+    path = os.environ.get("CANDIDATE_MODEL_PATH")
+    if not path:
+        return None
+    return ShadowScorer(
+        load(path),
+        ab_share=float(os.environ.get("AB_SHARE", "0")),
+        shadow_share=float(os.environ.get("SHADOW_SHARE", "0.01")),
+        salt=os.environ.get("SPLIT_SALT", "candidate"),
+        workers=int(os.environ.get("SHADOW_WORKERS", "1")),
+        queue_size=int(os.environ.get("SHADOW_QUEUE_SIZE", "64")),
+        duty_cycle=float(os.environ.get("SHADOW_DUTY_CYCLE", "0.25")),
+        fallback=fallback,
+        live=live,
+    )
@@ -0,0 +1,182 @@
+"""Deadline-aware admission and graceful degradation of predict requests.
+
+Every request gets a latency budget, from the `X-Request-Deadline-Ms` header or
+a default. Time the request spent queued before it reached the app is taken off
+the budget when a proxy sets `X-Request-Start`. The shedder keeps an
+exponentially weighted moving average of the latency per anchor of every mode,
+and picks the best mode that is expected to finish within the remaining budget:
+
+    full      : the regular prediction
+    reduced_n : the regular prediction with a smaller n
+    cached    : the most recent regular prediction of every anchor
+    fallback  : the popularity fallback model
+    rejected  : 503, when the budget is already spent or the request queued too long
+
+Overload is detected by the time requests queue before they reach the app,
+which also works with sync workers that only ever have one request in flight:
+when it exceeds `max_queue_time` the listen backlog is growing faster than the
+workers drain it, and requests are rejected until it shrinks again. Without
+`X-Request-Start` only expired requests are rejected.
+
+When no mode is expected to fit, the cheapest available one is used anyway.
+The estimate of a mode that is skipped relaxes a little with every skip, so it
+is tried again once the load subsides.
+"""
+from __future__ import annotations
+
+import collections
+import contextlib
+import dataclasses
+import threading
+import time
+import typing
+
+FULL = "full"
+REDUCED_N = "reduced_n"
+CACHED = "cached"
+FALLBACK = "fallback"
+REJECTED = "rejected"
+
+
+def parse_request_start(value: str | None, now: float) -> float | None:
+    """Parse `X-Request-Start` as set by e.g. nginx (`t=1636534800.123`) or Heroku (milliseconds) into seconds.
+
+    Returns None when the header is missing, malformed or in the future.
+    """
+    if not value:
+        return None
+    try:
+        started = float(value.strip().removeprefix("t="))
+    except ValueError:
+        return None
+    # Seconds, milliseconds or microseconds since the epoch
+    while started > now * 10:
+        started /= 1000
+    return started if started <= now else None
+
+
+@dataclasses.dataclass
+class Decision:
+    """The mode in which to answer a request.
+
+    Attributes:
+        mode      : One of full, reduced_n, cached, fallback or rejected
+        n         : The number of recommendations to produce per anchor
+        remaining : The remaining latency budget in seconds at admission
+    """
+
+    mode: str
+    n: int
+    remaining: float
+
+
+class LoadShedder:
+    """Admits requests by deadline and queue time and tracks the latency per mode.
+
+    Attributes:
+        default_deadline : The latency budget in seconds of requests without a deadline header
+        max_queue_time   : The seconds a request may queue before the app, above which it is rejected
+        reduced_n        : The n used in reduced_n mode
+        smoothing        : The weight of the newest observation in the moving averages
+        recovery         : The fraction by which the estimate of a skipped mode relaxes
+        has_fallback     : Whether the fallback mode is available
+    """
+
+    def __init__(
+        self,
+        default_deadline: float = 0.5,
+        max_queue_time: float = 0.25,
+        reduced_n: int = 10,
+        cache_size: int = 10_000,
+        smoothing: float = 0.2,
+        recovery: float = 0.01,
+        has_fallback: bool = False,
+    ):
+        self.default_deadline = default_deadline
+        self.max_queue_time = max_queue_time
+        self.reduced_n = reduced_n
+        self.smoothing = smoothing
+        self.recovery = recovery
+        self.has_fallback = has_fallback
+        # Seconds per anchor of every mode, unknown modes are assumed to fit until measured
+        self.latency: dict[str, float] = {}
+        self._cache: collections.OrderedDict[str, dict[str, typing.Any]] = collections.OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def queued(headers: typing.Mapping[str, str], now: float | None = None) -> float:
+        """Return the seconds a request queued before it reached the app, 0 without `X-Request-Start`."""
+        now = time.time() if now is None else now
+        started = parse_request_start(headers.get("X-Request-Start"), now)
+        return now - started if started is not None else 0.0
+
+    def remaining(self, headers: typing.Mapping[str, str], now: float | None = None) -> float:
+        """Return the remaining latency budget in seconds of a request."""
+        now = time.time() if now is None else now
+        deadline_ms = headers.get("X-Request-Deadline-Ms")
+        try:
+            budget = float(deadline_ms) / 1000 if deadline_ms else self.default_deadline
+        except ValueError:
+            budget = self.default_deadline
+        return budget - self.queued(headers, now)
+
+    def _fits(self, mode: str, anchors: int, remaining: float) -> bool:
+        with self._lock:
+            estimate = self.latency.get(mode, 0.0)
+            if estimate * anchors <= remaining:
+                return True
+            self.latency[mode] = estimate * (1 - self.recovery)
+            return False
+
+    def decide(self, remaining: float, from_ids: list[str], n: int, queued: float = 0.0) -> Decision:
+        """Pick the best mode expected to finish within the remaining budget."""
+        anchors = len(from_ids)
+        if remaining <= 0 or queued > self.max_queue_time:
+            return Decision(REJECTED, n, remaining)
+        if self._fits(FULL, anchors, remaining):
+            return Decision(FULL, n, remaining)
+        if n > self.reduced_n and self._fits(REDUCED_N, anchors, remaining):
+            return Decision(REDUCED_N, self.reduced_n, remaining)
+        if self.cached(from_ids, n) is not None:
+            return Decision(CACHED, n, remaining)
+        if self.has_fallback:
+            return Decision(FALLBACK, n, remaining)
+        return Decision(REDUCED_N, min(n, self.reduced_n), remaining)
+
+    @contextlib.contextmanager
+    def admit(self, headers: typing.Mapping[str, str], from_ids: list[str], n: int) -> typing.Iterator[Decision]:
+        """Decide how to answer a request and time it.
+
+        The latency of the request is added to the moving average of its mode,
+        unless it was rejected.
+        """
+        started = time.perf_counter()
+        now = time.time()
+        decision = self.decide(self.remaining(headers, now), from_ids, n, self.queued(headers, now))
+        try:
+            yield decision
+        finally:
+            seconds = time.perf_counter() - started
+            with self._lock:
+                if decision.mode != REJECTED and from_ids:
+                    per_anchor = seconds / len(from_ids)
+                    previous = self.latency.get(decision.mode, per_anchor)
+                    self.latency[decision.mode] = previous + self.smoothing * (per_anchor - previous)
+
+    def store(self, recommendations: list[dict[str, typing.Any]]) -> None:
+        """Remember the most recent regular recommendations of every anchor."""
+        with self._lock:
+            for recommendation in recommendations:
+                self._cache[recommendation["from_key"]] = recommendation
+                self._cache.move_to_end(recommendation["from_key"])
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def cached(self, from_ids: list[str], n: int) -> list[dict[str, typing.Any]] | None:
+        """Return the cached recommendations of all anchors cut to n, or None unless all anchors are cached."""
+        with self._lock:
+            hits = [self._cache.get(a) for a in from_ids]
+        if not from_ids or any(hit is None or len(hit["items"]) < n for hit in hits):
+            return None
+        return [{**hit, "items": hit["items"][:n], "scores": hit["scores"][:n]} for hit in hits]
@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import datetime
+import typing
+
+import numpy
+import pandas
+
+from abstract_top_n_model import ModelTypeEnum, TopNModel, TopNOutputKeys
+
+#: Hash keys (exactly 16 characters) of the rows of the count-min sketch
+_ROW_KEYS = tuple(f"topn-cms-row-{row:03d}" for row in range(64))
+
+
+class DecayedPopularity(TopNModel):
+    """Rank items by their exponentially time-decayed popularity.
+
+    The model is updated in a single pass over the interactions, in chunks of
+    `chunk_hours`, and keeps its state in bounded memory regardless of the size
+    of the catalog: a count-min sketch of `depth` x `width` decayed counts and
+    the `capacity` items with the highest estimated counts (the heavy hitters).
+    Decay uses forward decay relative to a landmark time, so counts never need
+    to be decayed in place. Predictions are the same precomputed ranking for
+    every anchor, which makes the model a cheap fallback for unknown profiles.
+
+    Hyperparameters:
+        window_hours    : The number of hours of interactions to fit on (24)
+        chunk_hours     : The number of hours of interactions loaded at once (6)
+        half_life_hours : The number of hours after which an interaction counts half (6)
+        width           : The number of counters per row of the sketch (2**16)
+        depth           : The number of rows of the sketch (4)
+        capacity        : The number of heavy hitters to keep, and so the maximum n (1000)
+        num_records     : Passed on to `load_interactions` per chunk (None)
+
+    Example:
+    >>> from mock_loader import MockProfileLoader
+    >>> m = DecayedPopularity(MockProfileLoader(max_datetime=datetime.datetime(2021,11,1,9,0)), {"window_hours": 2})
+    >>> m = m.fit()
+    >>> recs = m.predict(datetime.datetime.now(), from_ids=['a','b'], n=10)
+    >>> recs[0]['items'] == recs[1]['items'] and len(recs[0]['items']) == 10
+    True
+    >>> recs[0]['scores'] == sorted(recs[0]['scores'], reverse=True)
+    True
+    """
+
+    model_type = ModelTypeEnum.USER_TO_ITEM
+    output_to_field = TopNOutputKeys.EPISODE_ID
+
+    def fit(self) -> TopNModel:
+        """Stream the interactions of the training window through the sketch."""
+        width = self.hyperparameters.get("width", 2**16)
+        depth = self.hyperparameters.get("depth", 4)
+        assert 0 < depth <= len(_ROW_KEYS), ValueError(f"The depth should be between 1 and {len(_ROW_KEYS)}")
+
+        until_dt = self.data_loader.max_datetime or datetime.datetime.now()
+        from_dt = until_dt - datetime.timedelta(hours=self.hyperparameters.get("window_hours", 24))
+        chunk = datetime.timedelta(hours=self.hyperparameters.get("chunk_hours", 6))
+
+        self.landmark = from_dt.timestamp()
+        self.sketch = numpy.zeros((depth, width), dtype=numpy.float64)
+        self.heavy_items = numpy.empty(0, dtype=object)
+        self.heavy_counts = numpy.empty(0, dtype=numpy.float64)
+
+        start = from_dt
+        while start < until_dt:
+            end = min(start + chunk, until_dt)
+            self._update(
+                self.data_loader.load_interactions(
+                    from_dt=start, until_dt=end, num_records=self.hyperparameters.get("num_records")
+                )
+            )
+            start = end
+
+        self._precompute(until_dt)
+        return self
+
+    def partial_fit(self, interactions: pandas.DataFrame) -> TopNModel:
+        """Add the new interactions to the sketch, the model is naturally incremental."""
+        self._update(interactions)
+        self._precompute(self.data_loader.max_datetime or datetime.datetime.now())
+        return self
+
+    def _row_indices(self, items: numpy.ndarray) -> numpy.ndarray:
+        """Hash the items to one counter per row of the sketch, as a (depth, len(items)) array."""
+        depth, width = self.sketch.shape
+        return numpy.stack(
+            [pandas.util.hash_array(items, hash_key=_ROW_KEYS[row]) % numpy.uint64(width) for row in range(depth)]
+        ).astype(numpy.intp)
+
+    def _update(self, interactions: pandas.DataFrame) -> None:
+        """Add a chunk of interactions to the sketch and refresh the heavy hitters."""
+        if interactions.empty:
+            return
+
+        half_life = self.hyperparameters.get("half_life_hours", 6) * 3600
+        seconds = interactions["timestamp"].astype("int64").to_numpy() / 1e9
+
+        # Keep the forward-decay multipliers within a comfortable floating point range
+        exponent = (seconds.max() - self.landmark) / half_life
+        if exponent > 512:
+            shift = (exponent - 64) * half_life
+            scale = numpy.exp2(-shift / half_life)
+            self.sketch *= scale
+            self.heavy_counts *= scale
+            self.landmark += shift
+
+        weights = interactions["weight"].to_numpy(dtype=numpy.float64) * numpy.exp2(
+            (seconds - self.landmark) / half_life
+        )
+
+        # Aggregate per item first, so every counter is updated once per chunk
+        codes, uniques = pandas.factorize(interactions["item"])
+        items = numpy.asarray(uniques, dtype=object)
+        totals = numpy.bincount(codes, weights=weights, minlength=len(items))
+        width = self.sketch.shape[1]
+        for row, indices in enumerate(self._row_indices(items)):
+            self.sketch[row] += numpy.bincount(indices, weights=totals, minlength=width)
+
+        # Re-estimate the previous heavy hitters together with the items of this chunk
+        candidates = pandas.unique(numpy.concatenate([self.heavy_items, items]))
+        indices = self._row_indices(candidates)
+        estimates = self.sketch[numpy.arange(len(indices))[:, None], indices].min(axis=0)
+
+        capacity = self.hyperparameters.get("capacity", 1000)
+        if len(candidates) > capacity:
+            keep = numpy.argpartition(-estimates, capacity - 1)[:capacity]
+            candidates, estimates = candidates[keep], estimates[keep]
+        self.heavy_items, self.heavy_counts = candidates, estimates
+
+    def _precompute(self, until_dt: datetime.datetime) -> None:
+        """Precompute the ranking, with the counts decayed to the end of the training data."""
+        half_life = self.hyperparameters.get("half_life_hours", 6) * 3600
+        order = numpy.argsort(-self.heavy_counts, kind="stable")
+        decay = numpy.exp2(-(until_dt.timestamp() - self.landmark) / half_life)
+        self.top_items: list[str] = [str(item) for item in self.heavy_items[order]]
+        self.top_scores: list[float] = (self.heavy_counts[order] * decay).tolist()
+
+    def predict(
+        self, timestamp: datetime.datetime, from_ids: list[str], n: int
+    ) -> list[dict[str, str | list[float] | list[str]]]:
+        """Return the precomputed popularity ranking for every anchor, without its recent items.
+
+        See abstract class for interface information.
+        """
+        context = timestamp.isoformat()
+        creation_time = datetime.datetime.now(datetime.timezone.utc).astimezone().isoformat()
+        recommendations = []
+        for a, recent in zip(from_ids, self.recent_items(from_ids)):
+            # Slice per anchor, so the recommendations do not share lists a caller may change
+            ranked = self.top_items[:n], self.top_scores[:n]
+            if recent:
+                # Leave out the items the anchor has just interacted with
+                candidates = range(min(n + len(recent), len(self.top_items)))
+                keep = [i for i in candidates if self.top_items[i] not in recent][:n]
+                ranked = [self.top_items[i] for i in keep], [self.top_scores[i] for i in keep]
+            recommendations.append(
+                {
+                    "from_key": a,
+                    "from_key_type": self.output_from_field.value,
+                    "to_key_type": self.output_to_field.value,
+                    "scores": ranked[1],
+                    "items": ranked[0],
+                    "datetime_context": context,
+                    "datetime_created": creation_time,
+                    "recommender": self.name,
+                }
+            )
+        return recommendations
+
+    def predict_cold_start(
+        self, primary: TopNModel, timestamp: datetime.datetime, from_ids: list[str], n: int
+    ) -> list[dict[str, str | list[float] | list[str]]]:
+        """Predict with `primary`, using the popularity ranking for the anchors it has never seen.
+
+        The order of the recommendations follows the order of `from_ids`.
+        """
+        known = primary.known_anchors(from_ids)
+        known_ids = [a for a, k in zip(from_ids, known) if k]
+        unknown_ids = [a for a, k in zip(from_ids, known) if not k]
+        primary_recs: typing.Iterator[dict[str, typing.Any]] = iter(
+            primary.predict(timestamp, known_ids, n) if known_ids else []
+        )
+        fallback_recs = iter(self.predict(timestamp, unknown_ids, n))
+        return [next(primary_recs) if k else next(fallback_recs) for k in known]
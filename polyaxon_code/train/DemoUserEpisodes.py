@@ -1,7 +1,11 @@
 from __future__ import annotations
 
 import datetime
-import random
+import os
+import typing
+
+import numpy
+import pandas
 
 from abstract_top_n_model import ModelTypeEnum, TopNModel, TopNOutputKeys
 
@@ -9,6 +13,10 @@ from abstract_top_n_model import ModelTypeEnum, TopNModel, TopNOutputKeys
 class DemoUserEpisodes(TopNModel):
     """Demonstration implementation of a EPISODES mode.
 
+    The demo ranks any anchor, so it keeps the default `known_anchors` and a
+    popularity fallback (`DecayedPopularity.predict_cold_start`) never answers
+    for it; the fallback only applies to `ImplicitALS` and `TwoStageRanker`.
+
     Example:
     >>> from ..data_loaders import MockProfileLoader
     >>> m = DemoUserEpisodes(data_loader = MockProfileLoader(max_datetime=datetime.datetime(2021,11,1,9,0)))
@@ -34,8 +42,41 @@ class DemoUserEpisodes(TopNModel):
     output_to_field = TopNOutputKeys.EPISODE_ID
 
     def fit(self) -> TopNModel:
-        """For the demo, fit only entails setting a mock space of 'known_items'."""
-        self.known_items = {f"i-{i}" for i in range(100_000)}
+        """For the demo, fit only entails setting a mock space of 'known_items'.
+
+        The items are one flat string array rather than a set of string objects, so a preloaded model shares its
+        pages with forked workers instead of being copied by their reference counting and garbage collection.
+        """
+        self.known_items = numpy.char.add("i-", numpy.arange(100_000).astype(str))
+        return self
+
+    @property
+    def rng(self) -> numpy.random.Generator:
+        """The random generator of this process.
+
+        It is created lazily in every process, so gunicorn workers forked from a preloaded model do not all inherit the
+        state of the master and draw the same recommendations.
+        """
+        if getattr(self, "_rng_pid", None) != os.getpid():
+            self._rng = numpy.random.default_rng()
+            self._rng_pid = os.getpid()
+        return self._rng
+
+    def __getstate__(self) -> dict[str, typing.Any]:
+        """Pickle the model without the random generator, which belongs to the process."""
+        state = super().__getstate__()
+        state.pop("_rng", None)
+        state.pop("_rng_pid", None)
+        return state
+
+    def __setstate__(self, state: dict[str, typing.Any]) -> None:
+        """Unpickle models of before the known items were an array, in which they were a set."""
+        if isinstance(state.get("known_items"), (set, frozenset)):
+            state["known_items"] = numpy.asarray(sorted(state["known_items"]), dtype=str)
+        self.__dict__.update(state)
+
+    def partial_fit(self, interactions: pandas.DataFrame) -> TopNModel:
+        """For the demo, the mock space of 'known_items' does not depend on the data, so nothing changes."""
         return self
 
     def predict(
@@ -43,16 +84,19 @@ class DemoUserEpisodes(TopNModel):
     ) -> list[dict[str, str | list[float] | list[str]]]:
         """Generate predictions based on the `fit` self.known items, the white and blacklist.
 
-        Predictions are based on random betavariate scores.
+        Predictions are based on random betavariate scores, the recent items of an anchor are left out.
 
         See abstract class for interface information.
         """
         recommendations: list[dict[str, str | list[float] | list[str]]] = []
 
-        for a in from_ids:
+        for a, recent in zip(from_ids, self.recent_items(from_ids)):
             creation_time = datetime.datetime.now(datetime.timezone.utc).astimezone().isoformat()
-            pred_items = random.choices(list(self.known_items), k=min(n, len(self.known_items)))
-            pred_scores = [float(random.betavariate(1, 1)) for _ in range(len(pred_items))]
+            # Leave out the items the anchor has just interacted with
+            k = min(n + len(recent), len(self.known_items))
+            candidates = self.known_items[self.rng.integers(len(self.known_items), size=k)].tolist()
+            pred_items = [item for item in candidates if item not in recent][:n]
+            pred_scores = self.rng.beta(1, 1, size=len(pred_items)).tolist()
             recommendations.append(
                 {
                     "from_key": a,
@@ -0,0 +1,281 @@
+from __future__ import annotations
+
+import concurrent.futures
+import contextlib
+import datetime
+import os
+import typing
+
+import numpy
+import pandas
+
+from abstract_top_n_model import ModelTypeEnum, TopNModel, TopNOutputKeys
+
+if typing.TYPE_CHECKING:
+    import scipy.sparse
+
+
+class ImplicitALS(TopNModel):
+    """Matrix factorization of implicit feedback with alternating least squares.
+
+    The weighted interactions are read as confidences `1 + alpha * weight` that a
+    user prefers an item (Hu, Koren and Volinsky, 2008). Every half-iteration
+    solves the least squares problems of all users (or items) at once with a few
+    steps of conjugate gradient, warm-started from the previous factors. Each
+    step is one sparse and one dense matrix product per block of rows, and the
+    blocks are solved in parallel on `num_threads` threads.
+
+    The factors are stored as contiguous float32 arrays and the users as a sorted
+    string array, so `joblib.load(path, mmap_mode="r")` memory-maps them instead
+    of reading them into every serving process. Predictions score a batch of
+    anchors with a single matrix product followed by a partial sort, and leave
+    out the items seen during training and the recent items of the anchor.
+    Anchors that were not seen during training get no recommendations, use
+    `DecayedPopularity.predict_cold_start` to answer them.
+
+    Hyperparameters:
+        window_hours   : The number of hours of interactions to fit on (24)
+        factors        : The number of latent factors (64)
+        regularization : The L2 regularization of the factors (0.01)
+        alpha          : The scale of the confidence in an interaction (40)
+        iterations     : The number of alternating iterations (15)
+        cg_steps       : The number of conjugate gradient steps per half-iteration (3)
+        num_threads    : The number of threads to solve with (the number of CPUs)
+        batch_size     : The number of anchors scored per matrix product (4096)
+        exclude_seen   : Whether to leave out the items a user interacted with (True)
+        num_records    : Passed on to `load_interactions` (None)
+        seed           : Seed of the initial factors (0)
+
+    Example:
+    >>> from mock_loader import MockProfileLoader
+    >>> m = ImplicitALS(MockProfileLoader(max_datetime=datetime.datetime(2021,11,1,9,0)), {"window_hours": 2})
+    >>> m = m.fit()
+    >>> user = str(m.users[0])
+    >>> recs = m.predict(datetime.datetime.now(), from_ids=[user, 'unknown'], n=10)
+    >>> len(recs[0]['items']), len(recs[1]['items'])
+    (10, 0)
+    >>> recs[0]['scores'] == sorted(recs[0]['scores'], reverse=True)
+    True
+    """
+
+    model_type = ModelTypeEnum.USER_TO_ITEM
+    output_to_field = TopNOutputKeys.EPISODE_ID
+
+    def fit(self) -> TopNModel:
+        """Factorize the interactions of the training window."""
+        until_dt = self.data_loader.max_datetime or datetime.datetime.now()
+        from_dt = until_dt - datetime.timedelta(hours=self.hyperparameters.get("window_hours", 24))
+        interactions = self.data_loader.load_interactions(
+            from_dt=from_dt, until_dt=until_dt, num_records=self.hyperparameters.get("num_records")
+        )
+        assert not interactions.empty, ValueError(f"No interactions between {from_dt} and {until_dt}")
+        users, items, user_codes, item_codes = encode_interactions(interactions)
+        weights = interactions["weight"].to_numpy(dtype=numpy.float32)
+        return self.fit_matrix(users, items, interaction_matrix(user_codes, item_codes, weights, users, items))
+
+    def fit_matrix(
+        self, users: numpy.ndarray, items: numpy.ndarray, user_items: scipy.sparse.csr_matrix
+    ) -> ImplicitALS:
+        """Factorize an encoded user-item matrix, e.g. one cached by the training pipeline.
+
+        Args:
+            users: The sorted users of the rows
+            items: The items of the columns
+            user_items: The summed weight of every (user, item) pair, see `interaction_matrix`
+        """
+        # The confidence of an observed pair is 1 + alpha * weight, the 1 is implicit in the solver
+        user_items = (user_items * numpy.float32(self.hyperparameters.get("alpha", 40.0))).tocsr()
+        item_users = user_items.T.tocsr()
+
+        factors = self.hyperparameters.get("factors", 64)
+        random = numpy.random.default_rng(self.hyperparameters.get("seed", 0))
+        self.user_factors = (random.standard_normal((len(users), factors)) * 0.01).astype(numpy.float32)
+        self.item_factors = (random.standard_normal((len(items), factors)) * 0.01).astype(numpy.float32)
+
+        num_threads = self.hyperparameters.get("num_threads", os.cpu_count() or 1)
+        with _blas_threads(1 if num_threads > 1 else None), concurrent.futures.ThreadPoolExecutor(num_threads) as pool:
+            for _ in range(self.hyperparameters.get("iterations", 15)):
+                self._solve(user_items, self.user_factors, self.item_factors, pool, num_threads)
+                self._solve(item_users, self.item_factors, self.user_factors, pool, num_threads)
+
+        self.users = numpy.asarray(users, dtype=str)
+        self.items = numpy.asarray(items, dtype=str)
+        self.seen_indptr = user_items.indptr.astype(numpy.int64)
+        self.seen_indices = user_items.indices.astype(numpy.int32)
+        return self
+
+    def _solve(
+        self,
+        confidence: scipy.sparse.csr_matrix,
+        x: numpy.ndarray,
+        y: numpy.ndarray,
+        pool: concurrent.futures.Executor,
+        num_threads: int,
+    ) -> None:
+        """Update the factors `x` in place given the fixed factors `y`, in blocks of rows."""
+        gram = y.T @ y + self.hyperparameters.get("regularization", 0.01) * numpy.eye(y.shape[1], dtype=numpy.float32)
+        bounds = numpy.linspace(0, x.shape[0], num_threads + 1).astype(int)
+        futures = [
+            pool.submit(self._conjugate_gradient, confidence[start:end], x[start:end], y, gram)
+            for start, end in zip(bounds[:-1], bounds[1:])
+            if end > start
+        ]
+        for future in futures:
+            future.result()
+
+    def _conjugate_gradient(
+        self, confidence: scipy.sparse.csr_matrix, x: numpy.ndarray, y: numpy.ndarray, gram: numpy.ndarray
+    ) -> None:
+        """Run batched conjugate gradient on `(Y^T C_u Y + reg I) x_u = Y^T C_u p_u` for all rows u of `x`.
+
+        `confidence` holds `c_ui - 1` of the observed pairs, every row has its own step sizes.
+        """
+        import scipy.sparse
+
+        rows = numpy.repeat(numpy.arange(x.shape[0]), numpy.diff(confidence.indptr))
+        observed = y[confidence.indices]
+
+        def product(p: numpy.ndarray) -> numpy.ndarray:
+            # Y^T C_u Y p = Y^T Y p + sum over the observed items i of (c_ui - 1) (y_i . p) y_i
+            dots = numpy.einsum("ij,ij->i", p[rows], observed)
+            weighted = scipy.sparse.csr_matrix(
+                (confidence.data * dots, confidence.indices, confidence.indptr), shape=confidence.shape
+            )
+            return p @ gram + weighted @ y
+
+        # Y^T C_u p_u, where the preference p_ui is one for the observed pairs
+        preferred = scipy.sparse.csr_matrix(
+            (confidence.data + 1, confidence.indices, confidence.indptr), shape=confidence.shape
+        )
+        target = preferred @ y
+        residual = target - product(x)
+        direction = residual.copy()
+        norm = numpy.einsum("ij,ij->i", residual, residual)
+        for _ in range(self.hyperparameters.get("cg_steps", 3)):
+            projected = product(direction)
+            step = norm / numpy.maximum(numpy.einsum("ij,ij->i", direction, projected), 1e-20)
+            x += step[:, None] * direction
+            residual -= step[:, None] * projected
+            new_norm = numpy.einsum("ij,ij->i", residual, residual)
+            direction = residual + (new_norm / numpy.maximum(norm, 1e-20))[:, None] * direction
+            norm = new_norm
+
+    def _rows(self, from_ids: list[str]) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """Return the row of every anchor in the factors and whether it is known."""
+        anchors = numpy.asarray(from_ids, dtype=str)
+        rows = numpy.minimum(numpy.searchsorted(self.users, anchors), len(self.users) - 1)
+        return rows, self.users[rows] == anchors
+
+    def known_anchors(self, from_ids: list[str]) -> list[bool]:
+        """See base class, only the users seen during training have factors."""
+        return self._rows(from_ids)[1].tolist()
+
+    def _top_n(self, rows: numpy.ndarray, n: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """Score a batch of users against all items and return the indices and scores of the top n."""
+        scores = self.user_factors[rows] @ self.item_factors.T
+        if self.hyperparameters.get("exclude_seen", True):
+            starts, ends = self.seen_indptr[rows], self.seen_indptr[rows + 1]
+            lengths = ends - starts
+            positions = numpy.arange(lengths.sum()) + numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths)
+            scores[numpy.repeat(numpy.arange(len(rows)), lengths), self.seen_indices[positions]] = -numpy.inf
+
+        top = numpy.argpartition(-scores, n - 1, axis=1)[:, :n]
+        top_scores = numpy.take_along_axis(scores, top, axis=1)
+        order = numpy.argsort(-top_scores, axis=1, kind="stable")
+        return numpy.take_along_axis(top, order, axis=1), numpy.take_along_axis(top_scores, order, axis=1)
+
+    def predict(
+        self, timestamp: datetime.datetime, from_ids: list[str], n: int
+    ) -> list[dict[str, str | list[float] | list[str]]]:
+        """Score the known anchors in batches of `batch_size`.
+
+        See abstract class for interface information.
+        """
+        n = min(n, len(self.items))
+        rows, known = self._rows(from_ids)
+        known_rows = rows[known]
+        batch_size = self.hyperparameters.get("batch_size", 4096)
+
+        # Score extra candidates to make up for the recent items, which are left out
+        recent = self.recent_items([a for a, k in zip(from_ids, known.tolist()) if k])
+        depth = min(n + max(map(len, recent), default=0), len(self.items))
+
+        ranked: list[tuple[list[str], list[float]]] = []
+        for start in range(0, len(known_rows), batch_size):
+            indices, scores = self._top_n(known_rows[start : start + batch_size], depth)
+            # Seen items are excluded with a score of -inf, which only occur when a user saw almost everything
+            valid = numpy.isfinite(scores)
+            items = self.items[indices]
+            for anchor_items, anchor_scores, v, r in zip(items, scores, valid, recent[start : start + batch_size]):
+                excluded = set(r)
+                keep = [j for j, item in enumerate(anchor_items[v].tolist()) if item not in excluded][:n]
+                ranked.append((anchor_items[v][keep].tolist(), anchor_scores[v][keep].tolist()))
+
+        context = timestamp.isoformat()
+        creation_time = datetime.datetime.now(datetime.timezone.utc).astimezone().isoformat()
+        results = iter(ranked)
+        recommendations: list[dict[str, str | list[float] | list[str]]] = []
+        for a, k in zip(from_ids, known.tolist()):
+            items, scores = next(results) if k else ([], [])
+            recommendations.append(
+                {
+                    "from_key": a,
+                    "from_key_type": self.output_from_field.value,
+                    "to_key_type": self.output_to_field.value,
+                    "scores": scores,
+                    "items": items,
+                    "datetime_context": context,
+                    "datetime_created": creation_time,
+                    "recommender": self.name,
+                }
+            )
+        return recommendations
+
+
+def encode_interactions(
+    interactions: pandas.DataFrame,
+) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """Encode the users and items of interactions in either dtype profile as matrix rows and columns.
+
+    Users are sorted, which allows a vectorized, memory-mappable lookup with
+    searchsorted, items keep the order in which they first occur.
+
+    Returns:
+        The users, the items, the row of every interaction and the column of every interaction
+    """
+    if "users" in interactions.attrs:
+        users, rows = numpy.unique(interactions.attrs["users"], return_inverse=True)
+        item_codes = interactions["item"].to_numpy()
+        return users, interactions.attrs["items"], rows[interactions["user"].to_numpy()], item_codes
+    users, user_codes = numpy.unique(interactions["user"].astype(str).to_numpy(), return_inverse=True)
+    item_codes, items = pandas.factorize(interactions["item"].astype(str))
+    return users, numpy.asarray(items, dtype=str), user_codes, item_codes
+
+
+def interaction_matrix(
+    user_codes: numpy.ndarray,
+    item_codes: numpy.ndarray,
+    weights: numpy.ndarray,
+    users: numpy.ndarray,
+    items: numpy.ndarray,
+) -> scipy.sparse.csr_matrix:
+    """Return the user-item matrix of encoded interactions, the weights of duplicate pairs are summed."""
+    import scipy.sparse
+
+    return scipy.sparse.coo_matrix(
+        (weights.astype(numpy.float32, copy=False), (user_codes, item_codes)), shape=(len(users), len(items))
+    ).tocsr()
+
+
+def _blas_threads(limit: int | None) -> typing.ContextManager[typing.Any]:
+    """Limit the threads of the BLAS library, to not oversubscribe the CPUs when solving on a thread pool.
+
+    Does nothing when threadpoolctl is not installed.
+    """
+    if limit is None:
+        return contextlib.nullcontext()
+    try:
+        import threadpoolctl
+    except ImportError:
+        return contextlib.nullcontext()
+    return threadpoolctl.threadpool_limits(limits=limit, user_api="blas")
@@ -7,9 +7,11 @@ import enum
 import logging
 import typing
 
+import numpy
 import pandas
 
-from const import get_dataframe_dtypes
+from const import DTYPE_PROFILES, get_dataframe_dtypes
+from instrumentation import instrumented
 
 
 class LoaderType(str, enum.Enum):
@@ -51,12 +53,14 @@ class DataLoader(abc.ABC):
         logging.debug(f"Initializing dataloader up to {self.max_datetime}")
 
     @typing.final
+    @instrumented("DataLoader.load_interactions", rows=len)
     def load_interactions(
         self,
         from_dt: datetime.datetime | None = None,
         until_dt: datetime.datetime | None = None,
         from_offset: datetime.timedelta | None = None,
         num_records: typing.Optional[int] = 1000,
+        dtype_profile: str = "default",
     ) -> pandas.DataFrame:
         """Load the (user, item)-interactions from the underlying data source.
 
@@ -71,24 +75,23 @@ class DataLoader(abc.ABC):
                      `from_offset`.
             until_dt: The last date/time to collect the information of
             num_records: The maximum number of interactions to return, defaults to 1000
+            dtype_profile: The data types of the result, see `const.get_dataframe_dtypes`
 
         Returns:
             The interactions collected in a pandas dataframe
         """
+        assert dtype_profile in DTYPE_PROFILES, ValueError(f"Unknown dtype profile {dtype_profile}")
         if self.max_datetime and until_dt:
             until_dt = min(self.max_datetime, until_dt)
         else:
-            until_dt = self.max_datetime or datetime.datetime.now()
+            until_dt = until_dt or self.max_datetime or datetime.datetime.now()
 
         if from_dt is None:
             assert from_offset is not None, ValueError("Either `from_dt` or `from_offset` should be specified.")
             from_dt = until_dt - from_offset
 
-        i = self._load_interactions(from_dt, until_dt, num_records)
-        return i.astype(
-            get_dataframe_dtypes(),
-            copy=False,
-        )
+        i = self._load_interactions(from_dt, until_dt, num_records, dtype_profile=dtype_profile)
+        return to_dtype_profile(i, dtype_profile)
 
     @abc.abstractmethod
     def _load_interactions(
@@ -96,6 +99,7 @@ class DataLoader(abc.ABC):
         from_dt: datetime.datetime,
         until_dt: datetime.datetime,
         num_records: typing.Optional[int] = 1000,
+        dtype_profile: str = "default",
     ) -> pandas.DataFrame:
         """Load the (user, item)-interactions from the underlying data source.
 
@@ -107,6 +111,9 @@ class DataLoader(abc.ABC):
             from_dt The first date/time to collect the information of
             until_dt: The last date/time to collect the information of
             num_records: The maxium number of interactions to return
+            dtype_profile: The profile requested by the caller. Loaders may return the
+                           interactions in any form `to_dtype_profile` can convert, but
+                           can save memory by producing the requested profile directly.
 
         Returns:
             The interactions collected in a pandas dataframe
@@ -125,3 +132,40 @@ class DataLoader(abc.ABC):
         Yields:
             A sequence of genre strings for a content ID in order
         """
+
+
+def to_dtype_profile(interactions: pandas.DataFrame, profile: str = "default") -> pandas.DataFrame:
+    """Cast interactions to the data types of a profile, see `const.get_dataframe_dtypes`.
+
+    Columns which already have the data types of the profile are not copied. In
+    the compact profile, users and items which are not yet codes are encoded as
+    codes into new vocabularies in `attrs`, and naive timestamps are taken to be
+    UTC like in the default profile.
+    """
+    dtypes = get_dataframe_dtypes(profile)
+    if profile == "default":
+        return interactions.astype(dtypes, copy=False)
+
+    attrs = dict(interactions.attrs)
+    columns = {}
+    for column, vocabulary in (("user", "users"), ("item", "items")):
+        values = interactions[column]
+        if vocabulary not in attrs or not pandas.api.types.is_integer_dtype(values):
+            values = values.astype("category", copy=False)
+            attrs[vocabulary] = numpy.asarray(values.cat.categories, dtype=str)
+            values = values.cat.codes
+        columns[column] = values
+
+    timestamp = interactions["timestamp"]
+    if not pandas.api.types.is_integer_dtype(timestamp):
+        if not pandas.api.types.is_datetime64_any_dtype(timestamp):
+            timestamp = pandas.to_datetime(timestamp, utc=True, cache=False)
+        # Both naive and tz-aware datetimes are stored as nanoseconds since the epoch in UTC
+        timestamp = timestamp.astype("int64") // 1_000_000_000
+        assert timestamp.empty or timestamp.max() < 2**31, ValueError("Timestamps after 2038 do not fit the profile")
+    columns["timestamp"] = timestamp
+    columns["weight"] = interactions["weight"]
+
+    compact = pandas.DataFrame({c: columns[c] for c in dtypes}, index=interactions.index).astype(dtypes, copy=False)
+    compact.attrs = attrs
+    return compact
@@ -5,10 +5,18 @@ from __future__ import annotations
 import abc
 import dataclasses
 import datetime
+import copy
 import enum
+import logging
 import typing
 
+import pandas
+
 from abstract_loader import DataLoader, LoaderType
+from instrumentation import instrumented
+
+if typing.TYPE_CHECKING:
+    from recent_history import RecentHistory
 
 
 class TopNOutputKeys(str, enum.Enum):
@@ -85,6 +93,17 @@ class TopNModel(abc.ABC):
     output_from_field: LoaderType
     name: str
 
+    # set by the serving app, which ingests the events of the users in real time
+    recent_history: RecentHistory | None = None
+
+    def __init_subclass__(cls, **kwargs: typing.Any):
+        """Instrument the `fit` and `predict` hooks of every concrete model."""
+        super().__init_subclass__(**kwargs)
+        for hook, rows in (("fit", None), ("partial_fit", None), ("predict", len)):
+            method = cls.__dict__.get(hook)
+            if method is not None and not getattr(method, "__instrumented__", False):
+                setattr(cls, hook, instrumented(rows=rows)(method))
+
     @typing.final
     def __init__(self, data_loader: DataLoader, hyperparameters: dict[str, typing.Any] | None = None):
         """Initialize a top-n model with the dataloader.
@@ -110,6 +129,18 @@ class TopNModel(abc.ABC):
     def fit(self) -> TopNModel:
         """Fit to observations from the data_loader using data from the provided timeframe."""
 
+    def partial_fit(self, interactions: pandas.DataFrame) -> TopNModel:
+        """Update a fitted model with the interactions that arrived since it was trained.
+
+        Models which cannot be updated incrementally need not override this, in
+        which case the model is fit from scratch.
+
+        Args:
+            interactions: The interactions since the previous training, as returned
+                          by `DataLoader.load_interactions`.
+        """
+        return self.fit()
+
     @abc.abstractmethod
     def predict(
         self, timestamp: datetime.datetime, from_ids: list[str], n: int
@@ -145,14 +176,83 @@ class TopNModel(abc.ABC):
             - Do not forget to provide the timezone in the timestamps!
         """
 
+    def recent_items(self, from_ids: list[str]) -> list[list[str]]:
+        """Return the items every anchor interacted with most recently, the latest first.
+
+        The history is read from memory and is empty when no `recent_history` is
+        attached, e.g. during training and evaluation.
+        """
+        if self.recent_history is None:
+            return [[] for _ in from_ids]
+        return self.recent_history.recent_items(from_ids)
+
+    def __getstate__(self) -> dict[str, typing.Any]:
+        """Pickle the model without the recent history, which belongs to the serving process."""
+        state = self.__dict__.copy()
+        state.pop("recent_history", None)
+        return state
+
+    def known_anchors(self, from_ids: list[str]) -> list[bool]:
+        """Return for each anchor whether the model has seen it during training.
+
+        Models which can rank for any anchor need not override this. Unknown
+        anchors can be answered by a fallback, see `DecayedPopularity.predict_cold_start`.
+        """
+        return [True] * len(from_ids)
+
     @typing.final
-    def to_trained(self) -> TrainedTopNModel:
-        """Return the trained representation of the model."""
+    def warm_start(self, previous: TrainedTopNModel) -> TrainedTopNModel:
+        """Continue from a previously trained model using only the interactions since it was trained.
+
+        The interactions after `previous.timestamp` are passed to `partial_fit` of
+        a copy of the previous model, which is left as it is. Retraining is skipped
+        altogether when the data has not changed since the previous model, i.e.
+        there are no interactions after its timestamp; the windows of the updates
+        never overlap, so hashing their interactions would never match. The model
+        is fit from scratch when the previous model is of another type or was
+        trained with other hyperparameters.
+
+        Args:
+            previous: The trained model of the previous run
+
+        Returns:
+            The trained representation of the updated model, or `previous` itself
+            when retraining was skipped.
+        """
+        if type(previous.model) is not type(self) or previous.model.hyperparameters != self.hyperparameters:
+            logging.info("Previous model is incompatible, fitting from scratch")
+            return self.fit().to_trained()
+
+        until_dt = self.data_loader.max_datetime or datetime.datetime.now()
+        if previous.timestamp >= until_dt:
+            logging.info(f"No interactions after {previous.timestamp}, skipping retraining")
+            return previous
+
+        interactions = self.data_loader.load_interactions(
+            from_dt=previous.timestamp, until_dt=until_dt, num_records=None
+        )
+        if interactions.empty:
+            logging.info(f"No interactions since {previous.timestamp}, skipping retraining")
+            return previous
+
+        logging.info(f"Updating previous model with {len(interactions)} interactions since {previous.timestamp}")
+        # partial_fit may update arrays in place, which may be memory-mapped read-only from the previous artifact
+        model = copy.deepcopy(previous.model)
+        model.data_loader = self.data_loader
+        return model.partial_fit(interactions).to_trained(timestamp=until_dt)
+
+    @typing.final
+    def to_trained(self, timestamp: datetime.datetime | None = None) -> TrainedTopNModel:
+        """Return the trained representation of the model.
+
+        Args:
+            timestamp: The point in time up to which the model has seen data, defaults to now
+        """
         return TrainedTopNModel(
             name=self.name,
             model=self,
             model_type=self.model_type,
             input_type=self.output_from_field,
             output_type=self.output_to_field,
-            timestamp=datetime.datetime.now(),
+            timestamp=timestamp or datetime.datetime.now(),
         )
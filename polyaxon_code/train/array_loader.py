@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import collections.abc
+import datetime
+import pathlib
+import typing
+
+import numpy
+import pandas
+
+from abstract_loader import DataLoader, LoaderType
+
+
+class ArrayInteractionLoader(DataLoader):
+    """A data loader over interactions cached as memory-mapped arrays.
+
+    The interactions are stored sorted by time as one `.npy` file per column,
+    with the users and items encoded as codes into a vocabulary. Many processes
+    can open the same directory and share the pages of the operating system
+    cache, e.g. to fit many models on the same data without reloading it.
+
+    Use `from_frame` to cache interactions and `open` to load a cached directory.
+    """
+
+    loader_type = LoaderType.PROFILE_ID
+
+    directory: pathlib.Path
+    _arrays: dict[str, numpy.ndarray] | None = None
+
+    @classmethod
+    def open(cls, directory: pathlib.Path, max_datetime: datetime.datetime | None = None) -> ArrayInteractionLoader:
+        """Create a loader over the interactions cached in `directory`."""
+        loader = cls(max_datetime=max_datetime)
+        loader.directory = pathlib.Path(directory)
+        return loader
+
+    @classmethod
+    def from_frame(
+        cls, interactions: pandas.DataFrame, directory: pathlib.Path, max_datetime: datetime.datetime | None = None
+    ) -> ArrayInteractionLoader:
+        """Cache the interactions, as returned by `DataLoader.load_interactions`, in `directory`."""
+        directory = pathlib.Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        interactions = interactions.sort_values("timestamp", kind="stable")
+        user_codes, users = pandas.factorize(interactions["user"])
+        item_codes, items = pandas.factorize(interactions["item"])
+        columns = {
+            "timestamp": interactions["timestamp"].astype("int64").to_numpy(),
+            "user": user_codes.astype(numpy.int32),
+            "item": item_codes.astype(numpy.int32),
+            "weight": interactions["weight"].to_numpy(dtype=numpy.float64),
+            "users": numpy.asarray(users, dtype=str),
+            "items": numpy.asarray(items, dtype=str),
+        }
+        for name, values in columns.items():
+            numpy.save(directory / f"{name}.npy", values)
+        return cls.open(directory, max_datetime)
+
+    @property
+    def arrays(self) -> dict[str, numpy.ndarray]:
+        """The cached columns, memory-mapped on first access."""
+        if self._arrays is None:
+            self._arrays = {
+                name: numpy.load(self.directory / f"{name}.npy", mmap_mode="r")
+                for name in ("timestamp", "user", "item", "weight", "users", "items")
+            }
+        return self._arrays
+
+    def __getstate__(self) -> dict[str, typing.Any]:
+        """Pickle the location of the cache rather than its contents."""
+        state = self.__dict__.copy()
+        state.pop("_arrays", None)
+        return state
+
+    def _load_interactions(
+        self,
+        from_dt: datetime.datetime,
+        until_dt: datetime.datetime,
+        num_records: typing.Optional[int] = 1000,
+        dtype_profile: str = "default",
+    ) -> pandas.DataFrame:
+        """See base class, returns the most recent `num_records` interactions of the window.
+
+        The compact profile is read straight from the cached codes, with the vocabularies of the whole cache.
+        """
+        arrays = self.arrays
+        start, end = numpy.searchsorted(
+            arrays["timestamp"], [int(from_dt.timestamp() * 1e9), int(until_dt.timestamp() * 1e9)]
+        )
+        if num_records is not None:
+            start = max(start, end - num_records)
+
+        window = slice(start, end)
+        if dtype_profile == "compact":
+            interactions = pandas.DataFrame(
+                {
+                    "timestamp": (arrays["timestamp"][window] // 1_000_000_000).astype(numpy.int32),
+                    "user": arrays["user"][window],
+                    "item": arrays["item"][window],
+                    "weight": arrays["weight"][window].astype(numpy.float32),
+                }
+            )
+            interactions.attrs.update(users=arrays["users"], items=arrays["items"])
+            return interactions
+        return pandas.DataFrame(
+            {
+                "timestamp": pandas.to_datetime(arrays["timestamp"][window], utc=True),
+                "user": pandas.Categorical.from_codes(arrays["user"][window], categories=arrays["users"]),
+                "item": pandas.Categorical.from_codes(arrays["item"][window], categories=arrays["items"]),
+                "weight": arrays["weight"][window],
+            }
+        )
+
+    def load_genres(
+        self,
+        content_ids: collections.abc.Sequence[str],
+    ) -> collections.abc.Iterator[list[str]]:
+        """See base class, no genres are cached so every content ID has none."""
+        for _ in content_ids:
+            yield []
@@ -0,0 +1,312 @@
+"""A content-addressed artifact store for trained models.
+
+Files are split into chunks at content-defined boundaries, so an insertion or
+deletion early in a file only changes the chunks around it instead of shifting
+every fixed-size block after it. Each chunk is stored once under its SHA-256,
+and every pushed version of an artifact is a manifest listing its chunks. As
+consecutive retrains produce largely identical model files, a push only
+uploads the chunks that are not stored yet and a pull only downloads the chunks
+that are not present in the local copy. Chunks are transferred in parallel and
+verified by checksum.
+
+Functions:
+    chunk_boundaries: Content-defined chunk boundaries of a file
+    open_store: Open an artifact store on a local folder or a `gs://` path
+"""
+from __future__ import annotations
+
+import abc
+import concurrent.futures
+import dataclasses
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import typing
+
+import numpy
+
+if typing.TYPE_CHECKING:
+    import cloudpathlib
+
+#: Random gear table of the rolling hash, fixed so boundaries are stable across runs
+_GEAR = numpy.random.RandomState(0x70A9).randint(0, 2**32, size=256, dtype=numpy.uint64).astype(numpy.uint32)
+
+
+def chunk_boundaries(
+    path: pathlib.Path,
+    mask_bits: int = 20,
+    min_size: int = 2**18,
+    max_size: int = 2**22,
+    block_size: int = 2**24,
+) -> list[int]:
+    """Return the end offsets of the content-defined chunks of a file.
+
+    A gear rolling hash is computed over the file, and a chunk ends after a byte
+    where the lowest `mask_bits` bits of the hash are zero. With shifted gear
+    values these bits only depend on the last `mask_bits` bytes, so the hash is
+    computed vectorized with one pass per bit.
+
+    Args:
+        path: The file to chunk
+        mask_bits: Determines the average chunk size of about 2**mask_bits bytes
+        min_size: The minimum size of a chunk, except for the last one
+        max_size: The maximum size of a chunk
+        block_size: The number of bytes hashed at once, bounds the memory use
+
+    Returns:
+        The end offset of every chunk, the last one being the size of the file
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+
+    data = numpy.memmap(path, dtype=numpy.uint8, mode="r")
+    mask = numpy.uint32((1 << mask_bits) - 1)
+    candidates = []
+    for start in range(0, size, block_size):
+        # Include the bytes of the previous block which still affect the hash
+        lead = min(start, mask_bits - 1)
+        gear = _GEAR[data[start - lead : start + block_size]]
+        digest = gear.copy()
+        for shift in range(1, mask_bits):
+            digest[shift:] += gear[:-shift] << numpy.uint32(shift)
+        candidates.append(numpy.flatnonzero((digest[lead:] & mask) == 0) + start + 1)
+    cuts = numpy.concatenate(candidates)
+
+    boundaries = []
+    position = 0
+    while size - position > min_size:
+        # Cut at the first candidate after the minimum size, or at the maximum size
+        i = numpy.searchsorted(cuts, position + min_size)
+        if i < len(cuts) and cuts[i] <= position + max_size and cuts[i] < size:
+            position = int(cuts[i])
+        elif size - position > max_size:
+            position += max_size
+        else:
+            break
+        boundaries.append(position)
+    boundaries.append(size)
+    return boundaries
+
+
+class StorageBackend(abc.ABC):
+    """Stores opaque objects by key, e.g. on a local disk or in a bucket."""
+
+    @abc.abstractmethod
+    def exists(self, key: str) -> bool:
+        """Return whether an object is stored under the key."""
+
+    @abc.abstractmethod
+    def read(self, key: str) -> bytes:
+        """Return the object stored under the key."""
+
+    @abc.abstractmethod
+    def write(self, key: str, data: bytes) -> None:
+        """Store the object under the key, replacing any existing object."""
+
+
+class LocalBackend(StorageBackend):
+    """Stores objects as files under a local folder, e.g. `const.get_local_pipeline_folder()`."""
+
+    def __init__(self, root: pathlib.Path):
+        self.root = pathlib.Path(root)
+
+    def exists(self, key: str) -> bool:
+        """See base class."""
+        return (self.root / key).exists()
+
+    def read(self, key: str) -> bytes:
+        """See base class."""
+        return (self.root / key).read_bytes()
+
+    def write(self, key: str, data: bytes) -> None:
+        """See base class, writes are atomic."""
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(f".{path.name}.{os.getpid()}.partial")
+        partial.write_bytes(data)
+        partial.replace(path)
+
+
+class CloudBackend(StorageBackend):
+    """Stores objects under a cloud path, e.g. `const.get_remote_pipeline_folder()`."""
+
+    def __init__(self, root: cloudpathlib.CloudPath):
+        self.root = root
+
+    def exists(self, key: str) -> bool:
+        """See base class."""
+        return (self.root / key).exists()
+
+    def read(self, key: str) -> bytes:
+        """See base class."""
+        return (self.root / key).read_bytes()
+
+    def write(self, key: str, data: bytes) -> None:
+        """See base class, object uploads are atomic in GCS."""
+        (self.root / key).write_bytes(data)
+
+
+@dataclasses.dataclass
+class TransferStats:
+    """Statistics of a push or pull.
+
+    Attributes:
+        version     : The version of the artifact that was transferred
+        chunks      : The number of chunks of the artifact
+        transferred : The number of chunks that were uploaded or downloaded
+        size        : The size of the artifact in bytes
+        bytes       : The number of bytes that were uploaded or downloaded
+        seconds     : The duration of the transfer
+    """
+
+    version: str
+    chunks: int
+    transferred: int
+    size: int
+    bytes: int
+    seconds: float
+
+
+def _sha256(data: bytes | memoryview) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class ArtifactStore:
+    """Pushes and pulls versioned artifacts as content-addressed chunks.
+
+    Layout of the backend:
+        chunks/<sha256[:2]>/<sha256>     : the contents of a chunk
+        manifests/<name>/<version>.json  : the chunks of a version of an artifact
+        manifests/<name>/latest          : the most recently pushed version
+    """
+
+    def __init__(self, backend: StorageBackend, max_workers: int = 8):
+        self.backend = backend
+        self.max_workers = max_workers
+
+    @staticmethod
+    def _chunk_key(digest: str) -> str:
+        return f"chunks/{digest[:2]}/{digest}"
+
+    def push(self, path: pathlib.Path, name: str, version: str | None = None) -> TransferStats:
+        """Store a file as a new version of the artifact `name`, uploading only unknown chunks."""
+        started = datetime.datetime.now()
+        version = version or started.strftime("%Y%m%dT%H%M%S%f")
+        boundaries = chunk_boundaries(path)
+        data = numpy.memmap(path, dtype=numpy.uint8, mode="r") if boundaries else numpy.empty(0, numpy.uint8)
+        spans = list(zip([0] + boundaries[:-1], boundaries))
+
+        def upload(span: tuple[int, int]) -> tuple[str, int]:
+            chunk = memoryview(data[span[0] : span[1]])
+            digest = _sha256(chunk)
+            key = self._chunk_key(digest)
+            if self.backend.exists(key):
+                return digest, 0
+            self.backend.write(key, chunk.tobytes())
+            return digest, len(chunk)
+
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            uploaded = list(pool.map(upload, spans))
+
+        manifest = {
+            "name": name,
+            "version": version,
+            "size": boundaries[-1] if boundaries else 0,
+            "sha256": _sha256(memoryview(data)),
+            "chunks": [{"sha256": digest, "size": end - start} for (digest, _), (start, end) in zip(uploaded, spans)],
+        }
+        self.backend.write(f"manifests/{name}/{version}.json", json.dumps(manifest).encode())
+        self.backend.write(f"manifests/{name}/latest", version.encode())
+
+        return TransferStats(
+            version=version,
+            chunks=len(spans),
+            transferred=sum(1 for _, sent in uploaded if sent),
+            size=manifest["size"],
+            bytes=sum(sent for _, sent in uploaded),
+            seconds=(datetime.datetime.now() - started).total_seconds(),
+        )
+
+    def latest(self, name: str) -> str | None:
+        """Return the most recently pushed version of the artifact, None if there is none."""
+        key = f"manifests/{name}/latest"
+        return self.backend.read(key).decode() if self.backend.exists(key) else None
+
+    def pull(self, name: str, destination: pathlib.Path, version: str | None = None) -> TransferStats:
+        """Restore a version (default the latest) of an artifact, reusing the chunks of an existing local copy.
+
+        Raises:
+            FileNotFoundError: The artifact or version does not exist
+            ValueError: A chunk or the assembled file does not match its checksum
+        """
+        started = datetime.datetime.now()
+        version = version or self.latest(name)
+        key = f"manifests/{name}/{version}.json"
+        if version is None or not self.backend.exists(key):
+            raise FileNotFoundError(f"No version {version} of artifact {name}")
+        manifest = json.loads(self.backend.read(key))
+
+        # Index the chunks of the current local copy, if any, memory-mapped rather than read
+        destination = pathlib.Path(destination)
+        local: dict[str, tuple[int, int]] = {}
+        current = numpy.empty(0, numpy.uint8)
+        if destination.exists():
+            boundaries = chunk_boundaries(destination)
+            if boundaries:
+                current = numpy.memmap(destination, dtype=numpy.uint8, mode="r")
+            for start, end in zip([0] + boundaries[:-1], boundaries):
+                local[_sha256(memoryview(current[start:end]))] = (start, end)
+
+        def download(digest: str) -> bytes | memoryview:
+            if digest in local:
+                start, end = local[digest]
+                return memoryview(current[start:end])
+            chunk = self.backend.read(self._chunk_key(digest))
+            if _sha256(chunk) != digest:
+                raise ValueError(f"Chunk {digest} of {name} is corrupt")
+            return chunk
+
+        # Stream the chunks into a file next to the destination, a few per worker at a time to bound the memory
+        digests = [chunk["sha256"] for chunk in manifest["chunks"]]
+        window = 4 * self.max_workers
+        checksum = hashlib.sha256()
+        fetched = fetched_bytes = 0
+        partial = destination.with_name(f".{destination.name}.partial")
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool, open(partial, "wb") as out:
+                for i in range(0, len(digests), window):
+                    batch = digests[i : i + window]
+                    for digest, chunk in zip(batch, pool.map(download, batch)):
+                        out.write(chunk)
+                        checksum.update(chunk)
+                        if digest not in local:
+                            fetched += 1
+                            fetched_bytes += len(chunk)
+            if checksum.hexdigest() != manifest["sha256"]:
+                raise ValueError(f"Version {version} of {name} does not match its checksum")
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        del current
+        os.replace(partial, destination)
+
+        return TransferStats(
+            version=version,
+            chunks=len(digests),
+            transferred=fetched,
+            size=manifest["size"],
+            bytes=fetched_bytes,
+            seconds=(datetime.datetime.now() - started).total_seconds(),
+        )
+
+
+def open_store(uri: str, max_workers: int = 8) -> ArtifactStore:
+    """Open an artifact store on a `gs://` path or a local folder."""
+    if uri.startswith("gs://"):
+        import cloudpathlib
+
+        return ArtifactStore(CloudBackend(cloudpathlib.CloudPath(uri)), max_workers)
+    return ArtifactStore(LocalBackend(pathlib.Path(uri)), max_workers)
@@ -0,0 +1,191 @@
+"""Offline evaluation of top-n models on temporal train/test splits.
+
+A model is fit on a data loader limited to a cutoff (`DataLoader.max_datetime`)
+and evaluated on the interactions in the holdout window after the cutoff. All
+metrics are computed with array operations over all test users at once.
+
+Functions:
+    ranking_metrics: Compute recall, precision, NDCG and coverage at several k
+    evaluate: Fit a model up to a cutoff and evaluate it on the window after it
+    evaluate_rolling: Evaluate several cutoffs in parallel on a process pool
+"""
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import datetime
+import itertools
+import logging
+import typing
+
+import numpy
+import pandas
+
+from abstract_loader import DataLoader
+from abstract_top_n_model import TopNModel
+from mock_loader import MockProfileLoader
+
+
+def ranking_metrics(
+    recommended: numpy.ndarray,
+    relevant_users: numpy.ndarray,
+    relevant_items: numpy.ndarray,
+    n_items: int,
+    k_values: typing.Sequence[int],
+) -> dict[str, float]:
+    """Compute recall@k, precision@k, NDCG@k and catalog coverage@k.
+
+    Args:
+        recommended: (users, max k) item codes in ranked order, padded with -1
+        relevant_users: The user code of every relevant (user, item)-pair
+        relevant_items: The item code of every relevant (user, item)-pair
+        n_items: The number of items in the catalog, all item codes are below it
+        k_values: The cut-offs to compute the metrics at
+
+    Returns:
+        The metrics averaged over the users with at least one relevant item, e.g.
+        `{"recall_at_10": 0.1, ...}`. Coverage is the fraction of the catalog that
+        is recommended to at least one user.
+    """
+    n_users, max_k = recommended.shape
+    truth = numpy.unique(relevant_users.astype(numpy.int64) * n_items + relevant_items)
+    n_relevant = numpy.bincount(truth // n_items, minlength=n_users)
+
+    offsets = numpy.arange(n_users, dtype=numpy.int64)[:, None] * n_items
+    keys = numpy.where(recommended >= 0, offsets + recommended, -1)
+    hits = numpy.isin(keys, truth)
+    # A repeated recommendation of the same item only counts once
+    _, first = numpy.unique(keys.ravel(), return_index=True)
+    unique = numpy.zeros(keys.size, dtype=bool)
+    unique[first] = True
+    hits &= unique.reshape(keys.shape)
+
+    evaluated = n_relevant > 0
+    discounts = 1 / numpy.log2(numpy.arange(2, max_k + 2))
+    ideal = numpy.concatenate([[0.0], numpy.cumsum(discounts)])
+
+    metrics: dict[str, float] = {"users": int(evaluated.sum())}
+    for k in k_values:
+        assert k <= max_k, ValueError(f"Cannot evaluate at {k}, only {max_k} recommendations per user")
+        hits_at_k = hits[evaluated, :k]
+        found = hits_at_k.sum(axis=1)
+        metrics[f"recall_at_{k}"] = float(numpy.mean(found / n_relevant[evaluated]))
+        metrics[f"precision_at_{k}"] = float(numpy.mean(found / k))
+        dcg = hits_at_k @ discounts[:k]
+        metrics[f"ndcg_at_{k}"] = float(numpy.mean(dcg / ideal[numpy.minimum(n_relevant[evaluated], k)]))
+        top_k = recommended[:, :k]
+        metrics[f"coverage_at_{k}"] = len(numpy.unique(top_k[top_k >= 0])) / n_items
+    return metrics
+
+
+def _recommendation_matrix(
+    recommendations: list[dict[str, typing.Any]], items: pandas.Index, k: int
+) -> numpy.ndarray:
+    """Convert the output of `TopNModel.predict` into a matrix of item codes, padded with -1."""
+    lengths = numpy.fromiter((min(len(r["items"]), k) for r in recommendations), dtype=numpy.int64)
+    flat = list(itertools.chain.from_iterable(r["items"][:k] for r in recommendations))
+    rows = numpy.repeat(numpy.arange(len(recommendations)), lengths)
+    columns = numpy.arange(len(flat)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    matrix = numpy.full((len(recommendations), k), -1, dtype=numpy.int64)
+    matrix[rows, columns] = items.get_indexer(flat)
+    return matrix
+
+
+def evaluate(
+    model_class: type[TopNModel],
+    hyperparameters: dict[str, typing.Any],
+    cutoff: datetime.datetime,
+    holdout: datetime.timedelta,
+    k_values: typing.Sequence[int] = (5, 10, 20),
+    num_records: int | None = 1000,
+    loader_class: typing.Callable[..., DataLoader] = MockProfileLoader,
+) -> dict[str, float]:
+    """Fit a model on the data up to `cutoff` and evaluate it on the `holdout` window after it.
+
+    The catalog consists of the items interacted with in the holdout window, so
+    recommendations of other items never count as hits nor as coverage.
+
+    Args:
+        model_class: The model to evaluate
+        hyperparameters: The hyperparameters of the model
+        cutoff: The end of the training data and the start of the holdout window
+        holdout: The length of the holdout window
+        k_values: The cut-offs to compute the metrics at
+        num_records: Passed on to `load_interactions` of the holdout window
+        loader_class: Creates the data loader to train and evaluate with from a `max_datetime`
+
+    Returns:
+        The metrics, see `ranking_metrics`, and the time spent on fit and predict
+    """
+    started = datetime.datetime.now()
+    model = model_class(data_loader=loader_class(max_datetime=cutoff), hyperparameters=hyperparameters).fit()
+    fitted = datetime.datetime.now()
+
+    test = loader_class(max_datetime=cutoff + holdout).load_interactions(
+        from_dt=cutoff, until_dt=cutoff + holdout, num_records=num_records
+    )
+    user_codes, users = pandas.factorize(test["user"])
+    item_codes, items = pandas.factorize(test["item"])
+
+    max_k = max(k_values)
+    recommendations = model.predict(cutoff, [str(u) for u in users], max_k)
+    recommended = _recommendation_matrix(recommendations, pandas.Index(items.astype(str)), max_k)
+    predicted = datetime.datetime.now()
+
+    metrics = ranking_metrics(recommended, user_codes, item_codes, len(items), k_values)
+    metrics["fit_seconds"] = (fitted - started).total_seconds()
+    metrics["predict_seconds"] = (predicted - fitted).total_seconds()
+    logging.info(f"Evaluated {model_class.__name__} at {cutoff}: {metrics}")
+    return metrics
+
+
+def evaluate_rolling(
+    model_class: type[TopNModel],
+    hyperparameters: dict[str, typing.Any],
+    cutoffs: typing.Sequence[datetime.datetime],
+    holdout: datetime.timedelta,
+    k_values: typing.Sequence[int] = (5, 10, 20),
+    max_workers: int | None = None,
+) -> list[dict[str, float]]:
+    """Evaluate the model at several cutoffs in parallel, one process per cutoff.
+
+    Returns:
+        The metrics per cutoff, in the order of `cutoffs`
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+        futures = [
+            pool.submit(evaluate, model_class, hyperparameters, cutoff, holdout, k_values) for cutoff in cutoffs
+        ]
+        return [future.result() for future in futures]
+
+
+if __name__ == "__main__":
+    # Polyaxon
+    from polyaxon import tracking
+
+    import model
+
+    parser = argparse.ArgumentParser(description="Evaluate a model on rolling temporal train/test splits.")
+    parser.add_argument("--model", choices=sorted(model.MODELS), default="demo")
+    parser.add_argument("--cutoffs", type=datetime.datetime.fromisoformat, nargs="+", required=True)
+    parser.add_argument("--holdout-hours", type=float, default=6)
+    parser.add_argument("--k", type=int, nargs="+", default=[5, 10, 20])
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    # Polyaxon
+    tracking.init()
+
+    results = evaluate_rolling(
+        model.MODELS[args.model],
+        {},
+        sorted(args.cutoffs),
+        datetime.timedelta(hours=args.holdout_hours),
+        args.k,
+        args.workers,
+    )
+
+    # Logging metrics to Polyaxon, one step per cutoff
+    for step, metrics in enumerate(results):
+        print(f"Metrics at {sorted(args.cutoffs)[step]}: {metrics}")
+        tracking.log_metrics(step=step, **metrics)
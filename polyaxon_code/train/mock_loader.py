@@ -5,10 +5,8 @@ import datetime
 import random
 import typing
 
-import joblib
+import numpy
 import pandas
-import scipy.stats
-import tqdm
 
 from abstract_loader import DataLoader, LoaderType
 
@@ -25,48 +23,66 @@ class MockProfileLoader(DataLoader):
         from_dt: datetime.datetime,
         until_dt: datetime.datetime,
         n: typing.Optional[int] = 1000,
+        dtype_profile: str = "default",
     ) -> pandas.DataFrame:
-        """See base class."""
+        """See base class, the interactions are generated in the requested dtype profile directly."""
+        # Only needed to generate data, importing it takes a second
+        import scipy.stats
+
         # Convert the given time range
         start_time = from_dt.timestamp()
         end_time = until_dt.timestamp()
 
         hours_covered = (end_time - start_time) / 60 / 60
 
-        # Set some random parameters
-        n_items = 300 * round(hours_covered)
-        n_users = 800 * round(hours_covered) if n is None else n
+        # Set some random parameters, short windows (e.g. for warm starts) still
+        # draw from a catalog of at least an hour worth of items
+        n_items = 300 * max(round(hours_covered), 1)
+        n_users = round(800 * hours_covered) if n is None else n
         n_choices = 5
         n_types = 4
 
         # Generate some random preferences
-        prefs = {i: scipy.stats.nbinom.rvs(n=0.7, p=0.5, size=n_items) for i in range(n_types)}
+        prefs = numpy.stack([scipy.stats.nbinom.rvs(n=0.7, p=0.5, size=n_items) for _ in range(n_types)])
+
+        # Every user picks `n_choices` items, weighted by the preferences of its type
+        user_codes = numpy.repeat(numpy.arange(n_users), n_choices)
+        types = user_codes % n_types
+        cumulative = numpy.cumsum(prefs, axis=1)
+        draws = numpy.random.random_sample(len(user_codes)) * cumulative[types, -1]
+        item_ids = numpy.empty(len(user_codes), dtype=numpy.int64)
+        for t in range(n_types):
+            of_type = types == t
+            item_ids[of_type] = numpy.searchsorted(cumulative[t], draws[of_type], side="right")
+        seconds = numpy.random.randint(int(start_time), int(end_time), size=len(user_codes))
+        weights = prefs[types, item_ids] / prefs.max(axis=1)[types]
+
+        # Only the items that were picked are part of the vocabulary
+        picked, item_codes = numpy.unique(item_ids, return_inverse=True)
+        users = numpy.char.add("user_", numpy.arange(n_users).astype(str))
+        items = numpy.char.add("item_", picked.astype(str))
 
-        # Construct the new Pandas dataframe
-        items = []
-
-        def generate_interactions(
-            user_id: int, start_time: float, end_time: float, n_types: int, n_choices: int
-        ) -> list[dict[str, typing.Any]]:
-            item_ids = random.choices(range(n_items), prefs[user_id % n_types], k=n_choices)
-            return [
+        # Return the results back to the caller
+        if dtype_profile == "compact":
+            interactions = pandas.DataFrame(
                 {
-                    "timestamp": datetime.datetime.fromtimestamp(random.randrange(int(start_time), int(end_time))),
-                    "user": f"user_{user_id}",
-                    "item": f"item_{item_id}",
-                    "weight": prefs[user_id % n_types][item_id] / max(prefs[user_id % n_types]),
+                    "timestamp": seconds.astype(numpy.int32),
+                    "user": user_codes.astype(numpy.int32),
+                    "item": item_codes.astype(numpy.int32),
+                    "weight": weights.astype(numpy.float32),
                 }
-                for item_id in item_ids
-            ]
-
-        items = joblib.Parallel(-1)(
-            joblib.delayed(generate_interactions)(user_id, start_time, end_time, n_types, n_choices)
-            for user_id in tqdm.tqdm(range(n_users), desc="generating mock data", total=n_users)
+            )
+            interactions.attrs.update(users=users, items=items)
+            return interactions
+        return pandas.DataFrame(
+            {
+                "timestamp": pandas.to_datetime(seconds, unit="s", utc=True),
+                "user": pandas.Categorical.from_codes(user_codes, categories=users),
+                "item": pandas.Categorical.from_codes(item_codes, categories=items),
+                "weight": weights.astype(numpy.float64),
+            }
         )
 
-        # Return the results back to the caller
-        return pandas.DataFrame([item for sublist in items for item in sublist])
-
     def load_genres(
         self,
         content_ids: collections.abc.Sequence[str],
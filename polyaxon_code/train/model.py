@@ -8,17 +8,32 @@ from __future__ import annotations
 
 import datetime
 import logging
+import os
 from typing import Any
 
 import joblib
 from mock_loader import MockProfileLoader
+from abstract_top_n_model import TopNModel
+from DecayedPopularity import DecayedPopularity
 from DemoUserEpisodes import DemoUserEpisodes
+from ImplicitALS import ImplicitALS
+from TwoStageRanker import TwoStageRanker
+
+#: The models that can be trained, by name
+MODELS: dict[str, type[TopNModel]] = {
+    "demo": DemoUserEpisodes,
+    "popularity": DecayedPopularity,
+    "als": ImplicitALS,
+    "two_stage": TwoStageRanker,
+}
 
 
 def train(
     max_train_timestamp: datetime.datetime | None,
     hyperparameters: dict[str, Any],
-    model_path: str
+    model_path: str,
+    warm_start: bool = False,
+    model_name: str = "demo",
 ) -> None:
     # Start keeping track of the running time
     start_dt = datetime.datetime.now()
@@ -26,9 +41,18 @@ def train(
     # Create a new data loader
     data_loader = MockProfileLoader(max_datetime=max_train_timestamp)
 
-    m = DemoUserEpisodes(data_loader=data_loader, hyperparameters=hyperparameters.copy())
-    m.fit()
-    model = m.to_trained()
+    m = MODELS[model_name](data_loader=data_loader, hyperparameters=hyperparameters.copy())
+    if warm_start and model_path and os.path.exists(model_path):
+        # Only use the interactions since the previous model was trained
+        previous = joblib.load(model_path)
+        model = m.warm_start(previous)
+        skipped = model is previous
+    else:
+        if warm_start:
+            logging.warning(f"No previous model at {model_path}, fitting from scratch")
+        m.fit()
+        model = m.to_trained()
+        skipped = False
 
     # Stop the clock
     end_dt = datetime.datetime.now()
@@ -37,12 +61,13 @@ def train(
     logging.info("--- report ---")
     logging.info(f"model written to : {model_path}")
 
-    if model_path:
+    if model_path and not skipped:
         joblib.dump(model, model_path)
 
     results = {
         "started": start_dt,
         "ended": end_dt,
         "elapsed": end_dt - start_dt,
+        "retrain_skipped": skipped,
     }
     return results
\ No newline at end of file
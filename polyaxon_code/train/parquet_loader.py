@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import collections.abc
+import concurrent.futures
+import datetime
+import pathlib
+import typing
+
+import numpy
+import pandas
+
+from abstract_loader import DataLoader, LoaderType
+
+if typing.TYPE_CHECKING:
+    import pyarrow
+
+#: The columns read from the dataset, any other columns are left on disk
+COLUMNS = ["timestamp", "user", "item", "weight"]
+
+#: The time span of a partition per partitioning scheme
+PARTITION_SPANS = {"hour": datetime.timedelta(hours=1), "day": datetime.timedelta(days=1)}
+
+
+def _utc(dt: datetime.datetime) -> pandas.Timestamp:
+    """Convert a (naive or aware) datetime to UTC the way `datetime.timestamp` interprets it."""
+    return pandas.Timestamp(dt.timestamp(), unit="s", tz="UTC")
+
+
+class ParquetInteractionLoader(DataLoader):
+    """A data loader over a directory of time-partitioned Parquet files.
+
+    The interactions are partitioned by UTC date and optionally hour, in hive
+    style directories such as `date=2021-11-01/hour=09/part-0.parquet`. A load
+    only opens the partitions that overlap the window, pushes the timestamp
+    filter down to the row groups, reads only the interaction columns and reads
+    the files in parallel on a thread pool. With a `num_records` limit the
+    partitions are read from the most recent backwards, and reading stops once
+    enough interactions were found.
+
+    Use `write_dataset` to create such a dataset, e.g. from `MockProfileLoader`,
+    and `open` to load one. Reading requires pyarrow.
+    """
+
+    loader_type = LoaderType.PROFILE_ID
+
+    root: pathlib.Path
+    max_workers: int = 8
+
+    @classmethod
+    def open(
+        cls, root: pathlib.Path, max_datetime: datetime.datetime | None = None, max_workers: int = 8
+    ) -> ParquetInteractionLoader:
+        """Create a loader over the dataset in `root`."""
+        loader = cls(max_datetime=max_datetime)
+        loader.root = pathlib.Path(root)
+        loader.max_workers = max_workers
+        return loader
+
+    def partitions(self, from_dt: datetime.datetime, until_dt: datetime.datetime) -> list[pathlib.Path]:
+        """Return the files of the partitions that overlap `[from_dt, until_dt)`, the most recent first."""
+        start, end = _utc(from_dt).tz_localize(None), _utc(until_dt).tz_localize(None)
+        selected = []
+        for date_dir in self.root.glob("date=*"):
+            date = pandas.Timestamp(date_dir.name.split("=", 1)[1])
+            if not (date < end and date + PARTITION_SPANS["day"] > start):
+                continue
+            hour_dirs = list(date_dir.glob("hour=*"))
+            if not hour_dirs:
+                selected.append((date, date_dir))
+            for hour_dir in hour_dirs:
+                hour = date + pandas.Timedelta(hours=int(hour_dir.name.split("=", 1)[1]))
+                if hour < end and hour + PARTITION_SPANS["hour"] > start:
+                    selected.append((hour, hour_dir))
+        selected.sort(key=lambda partition: partition[0], reverse=True)
+        return [file for _, directory in selected for file in sorted(directory.glob("*.parquet"))]
+
+    def _read(self, file: pathlib.Path, start: pandas.Timestamp, end: pandas.Timestamp) -> pyarrow.Table:
+        import pyarrow.parquet
+
+        return pyarrow.parquet.read_table(
+            file,
+            columns=COLUMNS,
+            filters=[("timestamp", ">=", start), ("timestamp", "<", end)],
+            read_dictionary=["user", "item"],
+            # Partitions are single files, do not infer partition columns from the directory names
+            partitioning=None,
+        )
+
+    def _load_interactions(
+        self,
+        from_dt: datetime.datetime,
+        until_dt: datetime.datetime,
+        num_records: typing.Optional[int] = 1000,
+        dtype_profile: str = "default",
+    ) -> pandas.DataFrame:
+        """See base class, returns the most recent `num_records` interactions of the window.
+
+        The compact profile is converted from the Arrow dictionary indices, without materializing the strings.
+        """
+        import pyarrow
+
+        start, end = _utc(from_dt), _utc(until_dt)
+        files = self.partitions(from_dt, until_dt)
+        tables: list[pyarrow.Table] = []
+        rows = 0
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            # Read a wave of partitions at a time, so a limit stops reading older partitions
+            wave = self.max_workers if num_records is not None else max(len(files), 1)
+            for i in range(0, len(files), wave):
+                for table in pool.map(lambda file: self._read(file, start, end), files[i : i + wave]):
+                    tables.append(table)
+                    rows += table.num_rows
+                if num_records is not None and rows >= num_records:
+                    break
+
+        if not tables:
+            return pandas.DataFrame(columns=COLUMNS)
+        table = pyarrow.concat_tables(tables).unify_dictionaries()
+        if dtype_profile == "compact":
+            interactions = _compact_frame(table)
+        else:
+            interactions = table.to_pandas()
+        interactions = interactions.sort_values("timestamp", kind="stable", ignore_index=True)
+        if num_records is not None:
+            interactions = interactions.iloc[-num_records:].reset_index(drop=True) if num_records else interactions[:0]
+        return interactions
+
+    def load_genres(
+        self,
+        content_ids: collections.abc.Sequence[str],
+    ) -> collections.abc.Iterator[list[str]]:
+        """See base class, the dataset has no genres so every content ID has none."""
+        for _ in content_ids:
+            yield []
+
+
+def _compact_frame(table: pyarrow.Table) -> pandas.DataFrame:
+    """Convert a table to the compact dtype profile, see `const.get_dataframe_dtypes`."""
+    import pyarrow.compute
+
+    columns: dict[str, typing.Any] = {}
+    vocabularies = {}
+    for column, vocabulary in (("user", "users"), ("item", "items")):
+        # The dictionaries of all chunks are the same after `unify_dictionaries`
+        chunks = table.column(column).chunks
+        dictionary = chunks[0].dictionary if chunks else pyarrow.array([], pyarrow.string())
+        vocabularies[vocabulary] = numpy.asarray(dictionary.to_pylist(), dtype=str)
+        indices = [chunk.indices.to_numpy(zero_copy_only=False) for chunk in chunks]
+        columns[column] = numpy.concatenate(indices).astype(numpy.int32) if indices else numpy.empty(0, numpy.int32)
+    scale = {"s": 1, "ms": 1_000, "us": 1_000_000, "ns": 1_000_000_000}[table.schema.field("timestamp").type.unit]
+    seconds = pyarrow.compute.divide(table.column("timestamp").cast(pyarrow.int64()), scale)
+    columns["timestamp"] = seconds.to_numpy().astype(numpy.int32)
+    columns["weight"] = table.column("weight").to_numpy().astype(numpy.float32)
+
+    interactions = pandas.DataFrame({column: columns[column] for column in COLUMNS})
+    interactions.attrs.update(vocabularies)
+    return interactions
+
+
+def write_dataset(
+    loader: DataLoader,
+    root: pathlib.Path,
+    from_dt: datetime.datetime,
+    until_dt: datetime.datetime,
+    partitioning: str = "hour",
+    num_records: int | None = None,
+) -> ParquetInteractionLoader:
+    """Write the interactions of another loader, e.g. `MockProfileLoader`, as a partitioned dataset.
+
+    Every partition is loaded from `loader` separately and written sorted by
+    time, so the timestamp statistics of the row groups are tight.
+
+    Args:
+        loader: The loader to copy the interactions from
+        root: The directory to write the dataset to
+        from_dt: The start of the interactions to write
+        until_dt: The end of the interactions to write
+        partitioning: "hour" or "day"
+        num_records: Passed on to `load_interactions` per partition
+
+    Returns:
+        A loader over the written dataset
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    assert partitioning in PARTITION_SPANS, ValueError(f"Unknown partitioning {partitioning}")
+    span = PARTITION_SPANS[partitioning]
+    root = pathlib.Path(root)
+
+    def bound(timestamp: pandas.Timestamp) -> datetime.datetime:
+        # Naive datetimes are local time, like everywhere else
+        return timestamp.to_pydatetime() if from_dt.tzinfo else datetime.datetime.fromtimestamp(timestamp.timestamp())
+
+    # Align the partitions to whole UTC hours or days
+    start = _utc(from_dt).floor("D" if partitioning == "day" else "H")
+    while start < _utc(until_dt):
+        end = start + span
+        interactions = loader.load_interactions(
+            from_dt=bound(max(start, _utc(from_dt))),
+            until_dt=bound(min(end, _utc(until_dt))),
+            num_records=num_records,
+        )
+        if not interactions.empty:
+            directory = root / f"date={start:%Y-%m-%d}"
+            if partitioning == "hour":
+                directory = directory / f"hour={start:%H}"
+            directory.mkdir(parents=True, exist_ok=True)
+            interactions = interactions.sort_values("timestamp", kind="stable")
+            table = pyarrow.Table.from_pandas(
+                interactions.assign(
+                    timestamp=interactions["timestamp"].dt.tz_convert("UTC"),
+                    user=interactions["user"].astype(str),
+                    item=interactions["item"].astype(str),
+                )[COLUMNS],
+                preserve_index=False,
+            )
+            pyarrow.parquet.write_table(table, directory / "part-0.parquet", row_group_size=64 * 1024)
+        start = end
+
+    return ParquetInteractionLoader.open(root, loader.max_datetime)
@@ -0,0 +1,459 @@
+"""A cached, resumable training pipeline.
+
+Training is split into stages which each cache their output:
+
+    load       : cache the interactions of the training window as memory-mapped arrays
+    encode     : encode the users and items as matrix rows and columns
+    matrix     : build the sparse user-item matrix
+    fit        : fit the model, from the matrix when the model has a `fit_matrix` method
+    export     : write the trained model
+    precompute : predict for the most active users, to seed the cache of the serving app
+
+Every stage is keyed by a hash of its code, its parameters and the content
+digests of the outputs it depends on, and its output is written under that key
+once it completes. A run skips the stages whose key is cached, and a cached
+output is only read when a stage that still has to run needs it. So a run that
+failed during `fit` resumes from the matrix, and a run with other fit
+hyperparameters reuses the cached interactions and matrix. Only the stages the
+requested targets depend on run, models without `fit_matrix` are fit on the
+cached interactions and skip `encode` and `matrix`.
+
+Stages run on a thread pool as soon as their inputs are available, so
+independent stages, such as `export` and `precompute`, run concurrently. The
+time and memory of every stage are returned with the outputs, see
+`stage_metrics`.
+
+Functions:
+    training_pipeline: Create the pipeline which trains, exports and precomputes a model
+    train: Train a model with a cached pipeline, like `model.train`
+    stage_metrics: Flat metrics of the stages of a run, e.g. for `polyaxon.tracking.log_metrics`
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import dataclasses
+import datetime
+import graphlib
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pathlib
+import shutil
+import threading
+import time
+import typing
+
+import joblib
+import numpy
+
+from abstract_loader import DataLoader
+from abstract_top_n_model import TopNModel
+from array_loader import ArrayInteractionLoader
+from instrumentation import peak_rss_bytes, rss_bytes
+from ImplicitALS import ImplicitALS, encode_interactions, interaction_matrix
+from mock_loader import MockProfileLoader
+from model import MODELS
+
+
+@dataclasses.dataclass
+class Stage:
+    """A step of a pipeline, called as `func(directory, *outputs of inputs, **params)`.
+
+    The stage may write files to `directory`, which is kept with its cached
+    output. The source of `func` and of the objects in `code`, e.g. the module of
+    a model, and the parameters are part of the key of the stage, so changing
+    either reruns it.
+
+    Attributes:
+        name   : The name of the stage, unique within the pipeline
+        func   : The function which computes the output of the stage
+        inputs : The names of the stages whose outputs are passed to `func`
+        params : Keyword arguments of `func`, hashed with `joblib.hash`
+        code   : Further functions, classes or modules the output depends on
+    """
+
+    name: str
+    func: typing.Callable[..., typing.Any]
+    inputs: tuple[str, ...] = ()
+    params: dict[str, typing.Any] = dataclasses.field(default_factory=dict)
+    code: tuple[typing.Any, ...] = ()
+
+    def key(self, digests: list[str]) -> str:
+        """Return the cache key of the stage given the content digests of its inputs."""
+        sources = [inspect.getsource(obj) for obj in (self.func, *self.code)]
+        return hashlib.sha256(
+            json.dumps([self.name, sources, joblib.hash(self.params), digests]).encode()
+        ).hexdigest()[:16]
+
+
+@dataclasses.dataclass
+class StageResult:
+    """The outcome of a stage in a run.
+
+    Attributes:
+        name             : The name of the stage
+        key              : The cache key of the stage
+        digest           : The content digest of the output
+        cached           : Whether the output was cached, in which case the stage did not run
+        seconds          : The time the stage took in this run
+        rss_bytes        : The resident set size of the process after the stage
+        rss_growth_bytes : The growth of the resident set size during the stage
+        peak_rss_bytes   : The peak resident set size of the process after the stage
+    """
+
+    name: str
+    key: str
+    digest: str
+    cached: bool = False
+    seconds: float = 0.0
+    rss_bytes: int = 0
+    rss_growth_bytes: int = 0
+    peak_rss_bytes: int = 0
+
+
+class Pipeline:
+    """A directed acyclic graph of stages with a content-hashed cache of their outputs.
+
+    Outputs are stored with joblib in `cache_dir/<stage>/<key>/` and read back
+    memory-mapped. A stage only counts as cached once its manifest is written,
+    which happens after its output is, so a stage interrupted halfway reruns.
+    Stages that run concurrently share the process, so their memory measurements
+    overlap.
+
+    Attributes:
+        stages      : The stages by name
+        cache_dir   : The directory of the cached outputs
+        max_workers : The number of stages that can run at once
+    """
+
+    def __init__(self, stages: list[Stage], cache_dir: pathlib.Path, max_workers: int = 4):
+        self.stages = {stage.name: stage for stage in stages}
+        assert len(self.stages) == len(stages), ValueError("The names of the stages should be unique")
+        for stage in stages:
+            missing = set(stage.inputs) - set(self.stages)
+            assert not missing, ValueError(f"Stage {stage.name} depends on unknown stages {sorted(missing)}")
+        # Raises a graphlib.CycleError for cyclic pipelines
+        tuple(graphlib.TopologicalSorter({s.name: s.inputs for s in stages}).static_order())
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_workers = max_workers
+        self._outputs: dict[str, typing.Any] = {}
+        self._results: dict[str, StageResult] = {}
+        self._lock = threading.Lock()
+
+    def _directory(self, name: str, key: str) -> pathlib.Path:
+        return self.cache_dir / name / key
+
+    def _cached(self, stage: Stage, key: str) -> StageResult | None:
+        """Return the result of a cached stage, None when its output is not complete."""
+        directory = self._directory(stage.name, key)
+        try:
+            manifest = json.loads((directory / "manifest.json").read_text())
+        except (OSError, ValueError):
+            return None
+        if not (directory / "output.joblib").exists():
+            return None
+        return StageResult(name=stage.name, key=key, digest=manifest["digest"], cached=True)
+
+    def _output(self, name: str) -> typing.Any:
+        """Return the output of a completed stage, reading it from the cache on first use."""
+        with self._lock:
+            if name not in self._outputs:
+                path = self._directory(name, self._results[name].key) / "output.joblib"
+                self._outputs[name] = joblib.load(path, mmap_mode="r")
+            return self._outputs[name]
+
+    def _run_stage(self, stage: Stage, key: str) -> StageResult:
+        """Run a stage and write its output and manifest to the cache."""
+        inputs = [self._output(name) for name in stage.inputs]
+        directory = self._directory(stage.name, key)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        rss = rss_bytes()
+        started = time.perf_counter()
+        output = stage.func(directory, *inputs, **stage.params)
+        seconds = time.perf_counter() - started
+        result = StageResult(
+            name=stage.name,
+            key=key,
+            digest=joblib.hash(output),
+            seconds=seconds,
+            rss_bytes=rss_bytes(),
+            peak_rss_bytes=peak_rss_bytes(),
+        )
+        result.rss_growth_bytes = max(result.rss_bytes - rss, 0)
+
+        # Write the output before the manifest, which marks the stage as complete
+        joblib.dump(output, directory / "output.joblib.tmp")
+        os.replace(directory / "output.joblib.tmp", directory / "output.joblib")
+        (directory / "manifest.json.tmp").write_text(json.dumps(dataclasses.asdict(result)))
+        os.replace(directory / "manifest.json.tmp", directory / "manifest.json")
+        with self._lock:
+            self._outputs[stage.name] = output
+        growth = result.rss_growth_bytes / 2**20
+        logging.info(f"Stage {stage.name} ({key}) took {seconds:.2f}s, the resident set grew by {growth:.1f}MB")
+        return result
+
+    def run(self, targets: list[str] | None = None) -> tuple[dict[str, typing.Any], dict[str, StageResult]]:
+        """Run the stages the targets depend on, skipping the cached ones.
+
+        Args:
+            targets: The stages whose outputs are returned, defaults to all stages
+
+        Returns:
+            The outputs of the targets and the result of every stage that was needed
+        """
+        targets = list(self.stages) if targets is None else targets
+        needed: set[str] = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in needed:
+                needed.add(name)
+                pending.extend(self.stages[name].inputs)
+
+        sorter = graphlib.TopologicalSorter({name: self.stages[name].inputs for name in needed})
+        sorter.prepare()
+        self._outputs, self._results = {}, {}
+        running: dict[concurrent.futures.Future[StageResult], str] = {}
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            while sorter.is_active():
+                for name in sorter.get_ready():
+                    stage = self.stages[name]
+                    key = stage.key([self._results[i].digest for i in stage.inputs])
+                    cached = self._cached(stage, key)
+                    if cached is not None:
+                        logging.info(f"Stage {name} ({key}) is cached")
+                        self._results[name] = cached
+                        sorter.done(name)
+                    else:
+                        running[pool.submit(self._run_stage, stage, key)] = name
+                if not running:
+                    # Cached stages may have made other stages ready
+                    continue
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    # Stages that are still running complete and are cached before the error is raised
+                    self._results[name] = future.result()
+                    sorter.done(name)
+
+        return {name: self._output(name) for name in targets}, dict(self._results)
+
+
+def _load(
+    directory: pathlib.Path,
+    loader: DataLoader,
+    from_dt: datetime.datetime,
+    until_dt: datetime.datetime,
+    num_records: int | None,
+) -> ArrayInteractionLoader:
+    """Cache the interactions of the training window as memory-mapped arrays."""
+    interactions = loader.load_interactions(from_dt=from_dt, until_dt=until_dt, num_records=num_records)
+    assert not interactions.empty, ValueError(f"No interactions between {from_dt} and {until_dt}")
+    return ArrayInteractionLoader.from_frame(interactions, directory / "interactions", max_datetime=until_dt)
+
+
+def _encode(
+    directory: pathlib.Path,
+    interactions: ArrayInteractionLoader,
+    from_dt: datetime.datetime,
+    until_dt: datetime.datetime,
+) -> dict[str, numpy.ndarray]:
+    """Encode the cached interactions as matrix rows and columns."""
+    frame = interactions.load_interactions(
+        from_dt=from_dt, until_dt=until_dt, num_records=None, dtype_profile="compact"
+    )
+    users, items, user_codes, item_codes = encode_interactions(frame)
+    return {
+        "users": users,
+        "items": items,
+        "user_codes": user_codes,
+        "item_codes": item_codes,
+        "weights": frame["weight"].to_numpy(),
+    }
+
+
+def _matrix(directory: pathlib.Path, encoded: dict[str, numpy.ndarray]) -> dict[str, typing.Any]:
+    """Build the sparse user-item matrix of the encoded interactions."""
+    user_items = interaction_matrix(
+        encoded["user_codes"], encoded["item_codes"], encoded["weights"], encoded["users"], encoded["items"]
+    )
+    return {"users": encoded["users"], "items": encoded["items"], "user_items": user_items}
+
+
+def _fit(
+    directory: pathlib.Path,
+    interactions: ArrayInteractionLoader,
+    model_name: str,
+    hyperparameters: dict[str, typing.Any],
+) -> TopNModel:
+    """Fit a model on the cached interactions."""
+    return MODELS[model_name](data_loader=interactions, hyperparameters=hyperparameters.copy()).fit()
+
+
+def _fit_matrix(
+    directory: pathlib.Path,
+    interactions: ArrayInteractionLoader,
+    matrix: dict[str, typing.Any],
+    model_name: str,
+    hyperparameters: dict[str, typing.Any],
+) -> TopNModel:
+    """Fit a model on the cached user-item matrix."""
+    m = MODELS[model_name](data_loader=interactions, hyperparameters=hyperparameters.copy())
+    return m.fit_matrix(matrix["users"], matrix["items"], matrix["user_items"])
+
+
+def _export(directory: pathlib.Path, model: TopNModel, until_dt: datetime.datetime) -> pathlib.Path:
+    """Write the trained model, as served by the flask app."""
+    path = directory / "model.joblib"
+    joblib.dump(model.to_trained(timestamp=until_dt), path)
+    return path
+
+
+def _precompute(
+    directory: pathlib.Path,
+    interactions: ArrayInteractionLoader,
+    model: TopNModel,
+    from_dt: datetime.datetime,
+    until_dt: datetime.datetime,
+    num_anchors: int,
+    n: int,
+) -> pathlib.Path:
+    """Write the recommendations of the users with the most interactions in the training window."""
+    frame = interactions.load_interactions(
+        from_dt=from_dt, until_dt=until_dt, num_records=None, dtype_profile="compact"
+    )
+    users = frame.attrs["users"]
+    counts = numpy.bincount(frame["user"].to_numpy(), minlength=len(users))
+    anchors = users[numpy.argsort(-counts, kind="stable")[:num_anchors]].tolist()
+    recommendations = [r for r in model.predict(until_dt, anchors, n) if r["items"]]
+    path = directory / "precomputed.joblib"
+    joblib.dump(recommendations, path)
+    return path
+
+
+def training_pipeline(
+    model_name: str,
+    hyperparameters: dict[str, typing.Any],
+    cache_dir: pathlib.Path,
+    loader: DataLoader,
+    until_dt: datetime.datetime,
+    precompute_anchors: int = 1000,
+    precompute_n: int = 50,
+    max_workers: int = 4,
+) -> Pipeline:
+    """Create the pipeline which trains, exports and precomputes a model.
+
+    Args:
+        model_name: The name of the model in `model.MODELS`
+        hyperparameters: The hyperparameters of the model, `window_hours` and `num_records` also apply to the load
+        cache_dir: The directory of the cached outputs
+        loader: The loader to read the interactions from, its attributes and module are part of the key of the load
+        until_dt: The end of the training window
+        precompute_anchors: The number of most active users to precompute recommendations for
+        precompute_n: The number of recommendations to precompute per user
+        max_workers: The number of stages that can run at once
+
+    Returns:
+        The pipeline, run it with `Pipeline.run`
+    """
+    model_class = MODELS[model_name]
+    from_dt = until_dt - datetime.timedelta(hours=hyperparameters.get("window_hours", 24))
+    window = {"from_dt": from_dt, "until_dt": until_dt}
+    model = {"model_name": model_name, "hyperparameters": hyperparameters}
+    code = (inspect.getmodule(model_class), inspect.getmodule(ImplicitALS))
+    if hasattr(model_class, "fit_matrix"):
+        fit = Stage("fit", _fit_matrix, ("load", "matrix"), model, code)
+    else:
+        fit = Stage("fit", _fit, ("load",), model, code)
+
+    return Pipeline(
+        [
+            Stage(
+                "load",
+                _load,
+                (),
+                {"loader": loader, **window, "num_records": hyperparameters.get("num_records")},
+                (inspect.getmodule(type(loader)),),
+            ),
+            Stage("encode", _encode, ("load",), window, (encode_interactions,)),
+            Stage("matrix", _matrix, ("encode",), {}, (interaction_matrix,)),
+            fit,
+            Stage("export", _export, ("fit",), {"until_dt": until_dt}),
+            Stage(
+                "precompute",
+                _precompute,
+                ("load", "fit"),
+                {**window, "num_anchors": precompute_anchors, "n": precompute_n},
+            ),
+        ],
+        cache_dir,
+        max_workers,
+    )
+
+
+def stage_metrics(results: dict[str, StageResult]) -> dict[str, float]:
+    """Return the time and memory of every stage as flat metrics, e.g. for `polyaxon.tracking.log_metrics`."""
+    metrics: dict[str, float] = {}
+    for name, result in results.items():
+        metrics[f"pipeline_{name}_cached"] = int(result.cached)
+        metrics[f"pipeline_{name}_seconds"] = result.seconds
+        if not result.cached:
+            metrics[f"pipeline_{name}_rss_mb"] = result.rss_bytes / 2**20
+            metrics[f"pipeline_{name}_rss_growth_mb"] = result.rss_growth_bytes / 2**20
+            metrics[f"pipeline_{name}_peak_rss_mb"] = result.peak_rss_bytes / 2**20
+    return metrics
+
+
+def train(
+    max_train_timestamp: datetime.datetime | None,
+    hyperparameters: dict[str, typing.Any],
+    model_path: str,
+    model_name: str = "demo",
+    cache_dir: str = "pipeline-cache",
+    precomputed_path: str | None = None,
+    max_workers: int = 4,
+    loader: DataLoader | None = None,
+) -> dict[str, typing.Any]:
+    """Train a model with the cached pipeline and copy it to `model_path`, see `model.train`.
+
+    Without `max_train_timestamp` the training window ends at the start of the
+    current hour, so a run retried within the hour resumes where it failed. The
+    cache only helps when `cache_dir` outlives the run, e.g. on a mounted volume.
+    Without a `loader` the interactions are read from a `MockProfileLoader`.
+
+    Returns:
+        The start, end and duration of the run and the `StageResult` of every stage under "stages"
+    """
+    start_dt = datetime.datetime.now()
+    until_dt = max_train_timestamp or start_dt.replace(minute=0, second=0, microsecond=0)
+
+    pipeline = training_pipeline(
+        model_name,
+        hyperparameters,
+        pathlib.Path(cache_dir),
+        loader or MockProfileLoader(max_datetime=until_dt),
+        until_dt,
+        max_workers=max_workers,
+    )
+    targets = ["export", "precompute"] if precomputed_path else ["export"]
+    outputs, results = pipeline.run(targets)
+    shutil.copyfile(outputs["export"], model_path)
+    if precomputed_path:
+        shutil.copyfile(outputs["precompute"], precomputed_path)
+
+    end_dt = datetime.datetime.now()
+    logging.info("--- report ---")
+    logging.info(f"model written to : {model_path}")
+    if precomputed_path:
+        logging.info(f"precomputed recommendations written to : {precomputed_path}")
+    logging.info(f"cached stages : {[name for name, result in results.items() if result.cached]}")
+    return {
+        "started": start_dt,
+        "ended": end_dt,
+        "elapsed": end_dt - start_dt,
+        "retrain_skipped": all(result.cached for result in results.values()),
+        "stages": results,
+    }
@@ -1,27 +1,96 @@
 import argparse
+import os
+import pathlib
 
 # Polyaxon
 from polyaxon import tracking
 
+import artifact_store
+import instrumentation
 import model
+import pipeline
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--warm-start",
+        "--warm_start",
+        action="store_true",
+        help="update the model at model.joblib with the interactions since it was trained",
+    )
+    parser.add_argument("--model", choices=sorted(model.MODELS), default="demo", help="the model to train")
+    parser.add_argument(
+        "--artifact-store",
+        "--artifact_store",
+        help="local folder or gs:// path to push the model to (and pull the previous model from on warm starts)",
+    )
+    parser.add_argument(
+        "--pipeline-cache",
+        "--pipeline_cache",
+        help="train with the cached pipeline, which resumes from the stages cached in this folder, one that outlives "
+        "the run (not on warm starts from a previous model)",
+    )
+    args = parser.parse_args()
 
     # Polyaxon
     tracking.init()
 
+    # Record latency, throughput and memory of the load/fit/predict hooks
+    instrumentation.enable()
+
     # Train and eval the model with given parameters.
     # Polyaxon
     model_path = "model.joblib"
-    metrics = model.train(max_train_timestamp=None, hyperparameters={}, model_path=model_path)
+    store = artifact_store.open_store(args.artifact_store) if args.artifact_store else None
+    if store and args.warm_start and store.latest("useritem-model"):
+        pulled = store.pull("useritem-model", pathlib.Path(model_path))
+        print(f"Pulled {pulled.bytes} of {pulled.size} bytes of version {pulled.version}")
+    elif args.warm_start and not os.path.exists(model_path):
+        # Each Polyaxon run starts in a fresh artifacts path, only the store holds the previous model
+        where = f"in {args.artifact_store}" if store else "locally, pass --artifact-store to pull it from a store"
+        print(f"WARNING: warm start without a previous model {where}, fitting from scratch")
+
+    # Next to the model, so it is logged with it
+    precomputed_path = os.path.join(os.path.dirname(model_path), "precomputed.joblib")
+    if args.pipeline_cache and not (args.warm_start and os.path.exists(model_path)):
+        if not os.path.isabs(args.pipeline_cache):
+            print(f"WARNING: the pipeline cache {args.pipeline_cache} is relative, later runs will not reuse it")
+        metrics = pipeline.train(
+            max_train_timestamp=None,
+            hyperparameters={},
+            model_path=model_path,
+            model_name=args.model,
+            cache_dir=args.pipeline_cache,
+            precomputed_path=precomputed_path,
+        )
+        # Time and memory of every stage, cached stages report no time
+        tracking.log_metrics(**pipeline.stage_metrics(metrics.pop("stages")))
+    else:
+        metrics = model.train(
+            max_train_timestamp=None,
+            hyperparameters={},
+            model_path=model_path,
+            warm_start=args.warm_start,
+            model_name=args.model,
+        )
 
     # Logging metrics to Polyaxon
     print(f"Testing metrics: {metrics}")
 
     # Polyaxon
     tracking.log_metrics(metrics)
+    tracking.log_metrics(**instrumentation.get_registry().as_metrics())
+
+    # Only upload the chunks which changed since the previous model
+    if store and os.path.exists(model_path):
+        pushed = store.push(pathlib.Path(model_path), "useritem-model")
+        print(f"Pushed {pushed.bytes} of {pushed.size} bytes as version {pushed.version}")
+        tracking.log_metrics(artifact_bytes=pushed.size, artifact_bytes_uploaded=pushed.bytes)
 
     # Logging the model
     tracking.log_model(
         model_path, name="useritem-model", versioned=False
     )
+    # The recommendations of the most active profiles, to seed the cache of the serving app (PRECOMPUTED_PATH)
+    if os.path.exists(precomputed_path):
+        tracking.log_artifact(precomputed_path, name="precomputed", versioned=False)
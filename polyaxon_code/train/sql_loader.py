@@ -0,0 +1,283 @@
+from __future__ import annotations
+
+import collections.abc
+import contextlib
+import datetime
+import os
+import pathlib
+import queue
+import sqlite3
+import threading
+import typing
+
+import numpy
+import pandas
+
+from abstract_loader import DataLoader, LoaderType
+
+#: The schema of the interactions and genres, timestamps are seconds since the epoch
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS interactions (timestamp INTEGER NOT NULL, user TEXT NOT NULL, item TEXT NOT NULL, "
+    "weight REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS genres (item TEXT NOT NULL, position INTEGER NOT NULL, genre TEXT NOT NULL, "
+    "PRIMARY KEY (item, position))",
+)
+
+#: Keeps window queries to a range scan, created after a bulk load
+TIMESTAMP_INDEX = "CREATE INDEX IF NOT EXISTS interactions_timestamp ON interactions (timestamp)"
+
+#: The columns of a fetched chunk, fetched rows are copied straight into a structured array of this type
+ROW_DTYPE = numpy.dtype([("timestamp", numpy.int64), ("user", object), ("item", object), ("weight", numpy.float64)])
+
+
+class ConnectionPool:
+    """A bounded pool of DB-API connections, opened on first use.
+
+    Connections are handed out one thread at a time and returned to the pool
+    afterwards, so callers reuse connections instead of opening one per query.
+    When all `size` connections are in use, callers wait for one to return. A
+    pool used after a fork starts over, connections cannot be shared between
+    processes.
+
+    Example:
+    >>> pool = ConnectionPool(lambda: sqlite3.connect(":memory:", check_same_thread=False), size=2)
+    >>> with pool.connection() as connection:
+    ...     connection.execute("SELECT 1").fetchone()
+    (1,)
+    >>> pool.close()
+    """
+
+    def __init__(self, connect: typing.Callable[[], typing.Any], size: int = 4):
+        assert size > 0, ValueError("The pool should hold at least one connection")
+        self.connect = connect
+        self.size = size
+        self._idle: queue.LifoQueue[typing.Any] = queue.LifoQueue()
+        self._opened = 0
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> typing.Any:
+        with self._lock:
+            if self._pid != os.getpid():
+                # The connections belong to the parent process, leave them to it
+                self._idle, self._opened, self._pid = queue.LifoQueue(), 0, os.getpid()
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                if self._opened < self.size:
+                    self._opened += 1
+                    opening = True
+                else:
+                    opening = False
+        if opening:
+            try:
+                return self.connect()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        return self._idle.get()
+
+    @contextlib.contextmanager
+    def connection(self) -> typing.Iterator[typing.Any]:
+        """Borrow a connection, rolling back what the caller did not commit when it raises."""
+        connection = self._acquire()
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            self._idle.put(connection)
+
+    def close(self) -> None:
+        """Close the idle connections."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+            with self._lock:
+                self._opened -= 1
+
+
+class SQLInteractionLoader(DataLoader):
+    """A data loader over a relational database, by default a SQLite file.
+
+    Window queries are answered from the timestamp index, newest first when the
+    number of records is limited. Rows are fetched in chunks of `chunk_size`
+    through a single cursor and every chunk is copied straight into a structured
+    numpy array, so no more than one chunk of row tuples is alive at a time.
+    Genres are fetched with one `IN (...)` query per batch of content IDs.
+
+    Connections come from a `ConnectionPool`, which is not pickled: a loader
+    sent to another process opens its own connections. Other databases can be
+    used by overriding `connect` and `placeholder`.
+
+    Use `write_database` to fill a database from another loader and `open` to
+    load one.
+    """
+
+    loader_type = LoaderType.PROFILE_ID
+
+    #: The parameter placeholder of the DB-API driver
+    placeholder = "?"
+
+    database: pathlib.Path
+    pool_size: int = 4
+    chunk_size: int = 65_536
+    #: The number of content IDs per genre query, SQLite allows 999 parameters per query before version 3.32
+    genre_batch_size: int = 500
+    _pool: ConnectionPool | None = None
+
+    @classmethod
+    def open(
+        cls,
+        database: pathlib.Path,
+        max_datetime: datetime.datetime | None = None,
+        pool_size: int = 4,
+        chunk_size: int = 65_536,
+    ) -> SQLInteractionLoader:
+        """Create a loader over the interactions in `database`."""
+        loader = cls(max_datetime=max_datetime)
+        loader.database = pathlib.Path(database)
+        loader.pool_size = pool_size
+        loader.chunk_size = chunk_size
+        return loader
+
+    def connect(self) -> sqlite3.Connection:
+        """Open a new connection, pooled connections are handed between threads."""
+        return sqlite3.connect(self.database, check_same_thread=False)
+
+    @property
+    def pool(self) -> ConnectionPool:
+        """The pool of connections, created on first use."""
+        if self._pool is None:
+            self._pool = ConnectionPool(self.connect, self.pool_size)
+        return self._pool
+
+    def __getstate__(self) -> dict[str, typing.Any]:
+        """Pickle the location of the database rather than its connections."""
+        state = self.__dict__.copy()
+        state.pop("_pool", None)
+        return state
+
+    def _fetch(self, query: str, parameters: collections.abc.Sequence[typing.Any]) -> numpy.ndarray:
+        """Run a query for interactions and collect the rows in a structured array of `ROW_DTYPE`."""
+        chunks = []
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(query, parameters)
+                while rows := cursor.fetchmany(self.chunk_size):
+                    chunks.append(numpy.fromiter(rows, dtype=ROW_DTYPE, count=len(rows)))
+            finally:
+                cursor.close()
+        return numpy.concatenate(chunks) if chunks else numpy.empty(0, dtype=ROW_DTYPE)
+
+    def _load_interactions(
+        self,
+        from_dt: datetime.datetime,
+        until_dt: datetime.datetime,
+        num_records: typing.Optional[int] = 1000,
+        dtype_profile: str = "default",
+    ) -> pandas.DataFrame:
+        """See base class, returns the most recent `num_records` interactions of the window."""
+        p = self.placeholder
+        query = f"SELECT timestamp, user, item, weight FROM interactions WHERE timestamp >= {p} AND timestamp < {p}"
+        parameters: list[typing.Any] = [int(from_dt.timestamp()), int(until_dt.timestamp())]
+        if num_records is not None:
+            # Walk the index backwards, then restore the chronological order
+            rows = self._fetch(f"{query} ORDER BY timestamp DESC LIMIT {p}", [*parameters, num_records])[::-1]
+        else:
+            rows = self._fetch(f"{query} ORDER BY timestamp", parameters)
+
+        user_codes, users = pandas.factorize(rows["user"])
+        item_codes, items = pandas.factorize(rows["item"])
+        if dtype_profile == "compact":
+            interactions = pandas.DataFrame(
+                {
+                    "timestamp": rows["timestamp"].astype(numpy.int32),
+                    "user": user_codes.astype(numpy.int32),
+                    "item": item_codes.astype(numpy.int32),
+                    "weight": rows["weight"].astype(numpy.float32),
+                }
+            )
+            interactions.attrs.update(users=numpy.asarray(users, dtype=str), items=numpy.asarray(items, dtype=str))
+            return interactions
+        return pandas.DataFrame(
+            {
+                "timestamp": pandas.to_datetime(rows["timestamp"], unit="s", utc=True),
+                "user": pandas.Categorical.from_codes(user_codes, categories=users),
+                "item": pandas.Categorical.from_codes(item_codes, categories=items),
+                "weight": rows["weight"],
+            }
+        )
+
+    def load_genres(
+        self,
+        content_ids: collections.abc.Sequence[str],
+    ) -> collections.abc.Iterator[list[str]]:
+        """See base class, content IDs without genres have none."""
+        for start in range(0, len(content_ids), self.genre_batch_size):
+            batch = list(content_ids[start : start + self.genre_batch_size])
+            unique = list(dict.fromkeys(batch))
+            genres: dict[str, list[str]] = {content_id: [] for content_id in unique}
+            query = (
+                f"SELECT item, genre FROM genres WHERE item IN ({', '.join([self.placeholder] * len(unique))}) "
+                "ORDER BY item, position"
+            )
+            with self.pool.connection() as connection:
+                for item, genre in connection.execute(query, unique):
+                    genres[item].append(genre)
+            for content_id in batch:
+                yield list(genres[content_id])
+
+
+def write_database(
+    loader: DataLoader,
+    database: pathlib.Path,
+    from_dt: datetime.datetime,
+    until_dt: datetime.datetime,
+    num_records: int | None = None,
+) -> SQLInteractionLoader:
+    """Write the interactions and genres of another loader, e.g. `MockProfileLoader`, to a SQLite database.
+
+    The timestamp index is created after the rows are inserted, which is faster
+    than maintaining it during the bulk load.
+
+    Args:
+        loader: The loader to copy the interactions from
+        database: The SQLite file to write to, created when it does not exist
+        from_dt: The start of the interactions to write
+        until_dt: The end of the interactions to write
+        num_records: Passed on to `load_interactions`
+
+    Returns:
+        A loader over the written database
+    """
+    interactions = loader.load_interactions(
+        from_dt=from_dt, until_dt=until_dt, num_records=num_records, dtype_profile="compact"
+    )
+    users, items = interactions.attrs["users"], interactions.attrs["items"]
+    rows = zip(
+        interactions["timestamp"].tolist(),
+        users[interactions["user"].to_numpy()].tolist(),
+        items[interactions["item"].to_numpy()].tolist(),
+        interactions["weight"].astype(numpy.float64).tolist(),
+    )
+    used_items = items[numpy.unique(interactions["item"].to_numpy())].tolist()
+    genres = (
+        (item, position, genre)
+        for item, item_genres in zip(used_items, loader.load_genres(used_items))
+        for position, genre in enumerate(item_genres)
+    )
+
+    with contextlib.closing(sqlite3.connect(database)) as connection, connection:
+        for statement in SCHEMA:
+            connection.execute(statement)
+        connection.executemany("INSERT INTO interactions VALUES (?, ?, ?, ?)", rows)
+        connection.executemany("INSERT OR REPLACE INTO genres VALUES (?, ?, ?)", genres)
+        connection.execute(TIMESTAMP_INDEX)
+
+    return SQLInteractionLoader.open(database, loader.max_datetime)
@@ -0,0 +1,185 @@
+"""A local, parallel hyperparameter sweep with early stopping of poor trials.
+
+The interactions of the whole sweep are loaded once and cached as memory-mapped
+arrays (see `ArrayInteractionLoader`), which every worker process opens
+without copying. Trials are fit in parallel on a process pool and pruned with
+successive halving: all configurations are first fit on a short training
+window, and only the best `1 / eta` of them continue to the next rung, which
+uses an `eta` times longer window. Models read the length of their training
+window from the `window_hours` hyperparameter.
+
+Functions:
+    expand_grid: Expand a grid of hyperparameters into configurations
+    run_sweep: Run a successive-halving sweep and return all trials
+"""
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import dataclasses
+import datetime
+import functools
+import itertools
+import json
+import logging
+import math
+import pathlib
+import tempfile
+import time
+import typing
+
+from abstract_top_n_model import TopNModel
+from array_loader import ArrayInteractionLoader
+from evaluate import evaluate
+from mock_loader import MockProfileLoader
+
+
+@dataclasses.dataclass
+class Trial:
+    """A single hyperparameter configuration and its results.
+
+    Attributes:
+        hyperparameters : The configuration of the trial
+        scores          : The evaluation metric per completed rung
+        seconds         : The time spent on fit and evaluation per completed rung
+        stopped         : The rung after which the trial was stopped, None if it completed
+    """
+
+    hyperparameters: dict[str, typing.Any]
+    scores: list[float] = dataclasses.field(default_factory=list)
+    seconds: list[float] = dataclasses.field(default_factory=list)
+    stopped: int | None = None
+
+
+def expand_grid(grid: dict[str, list[typing.Any]]) -> list[dict[str, typing.Any]]:
+    """Expand `{"a": [1, 2], "b": [3]}` into `[{"a": 1, "b": 3}, {"a": 2, "b": 3}]`."""
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+def _run_trial(
+    model_class: type[TopNModel],
+    hyperparameters: dict[str, typing.Any],
+    directory: pathlib.Path,
+    cutoff: datetime.datetime,
+    holdout: datetime.timedelta,
+    k: int,
+) -> tuple[dict[str, float], float]:
+    started = time.perf_counter()
+    loader = functools.partial(ArrayInteractionLoader.open, directory)
+    metrics = evaluate(model_class, hyperparameters, cutoff, holdout, [k], num_records=None, loader_class=loader)
+    return metrics, time.perf_counter() - started
+
+
+def run_sweep(
+    model_class: type[TopNModel],
+    configurations: list[dict[str, typing.Any]],
+    cutoff: datetime.datetime,
+    window: datetime.timedelta,
+    holdout: datetime.timedelta,
+    k: int = 10,
+    metric: str = "ndcg",
+    eta: int = 3,
+    rungs: int = 3,
+    num_records: int | None = None,
+    max_workers: int | None = None,
+) -> list[Trial]:
+    """Run a successive-halving sweep over the configurations.
+
+    Args:
+        model_class: The model to sweep
+        configurations: The hyperparameter configurations to try
+        cutoff: The end of the training data and the start of the holdout window
+        window: The longest training window, used by the last rung
+        holdout: The length of the holdout window to evaluate on
+        k: The cut-off of the evaluation metric
+        metric: The metric to maximize, one of recall, precision, ndcg or coverage
+        eta: The factor by which the number of trials shrinks and the window grows per rung
+        rungs: The number of rungs
+        num_records: Passed on to `load_interactions` when loading the data once
+        max_workers: The number of processes, defaults to the number of CPUs
+
+    Returns:
+        All trials, the best first
+    """
+    # Removed with the cached interactions once the trials are done, also when one fails
+    with tempfile.TemporaryDirectory(prefix="topn-sweep-") as tmp:
+        directory = pathlib.Path(tmp)
+        interactions = MockProfileLoader(max_datetime=cutoff + holdout).load_interactions(
+            from_dt=cutoff - window, until_dt=cutoff + holdout, num_records=num_records
+        )
+        ArrayInteractionLoader.from_frame(interactions, directory)
+        logging.info(f"Cached {len(interactions)} interactions in {directory}")
+        del interactions
+
+        trials = [Trial(hyperparameters=dict(c)) for c in configurations]
+        alive = list(trials)
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+            for rung in range(rungs):
+                hours = window.total_seconds() / 3600 / eta ** (rungs - 1 - rung)
+                futures = {
+                    pool.submit(
+                        _run_trial,
+                        model_class,
+                        {**trial.hyperparameters, "window_hours": hours},
+                        directory,
+                        cutoff,
+                        holdout,
+                        k,
+                    ): trial
+                    for trial in alive
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    metrics, seconds = future.result()
+                    futures[future].scores.append(metrics[f"{metric}_at_{k}"])
+                    futures[future].seconds.append(seconds)
+
+                alive.sort(key=lambda trial: trial.scores[-1], reverse=True)
+                if rung < rungs - 1:
+                    survivors = max(1, math.ceil(len(alive) / eta))
+                    for trial in alive[survivors:]:
+                        trial.stopped = rung
+                    alive = alive[:survivors]
+                logging.info(f"Rung {rung} ({hours:.2f}h window): best {metric}@{k} {alive[0].scores[-1]:.4f}")
+
+    return sorted(trials, key=lambda trial: (len(trial.scores), trial.scores[-1]), reverse=True)
+
+
+if __name__ == "__main__":
+    import model
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", choices=sorted(model.MODELS), default="popularity")
+    parser.add_argument("--grid", type=json.loads, required=True, help='e.g. \'{"half_life_hours": [1, 6, 24]}\'')
+    parser.add_argument("--cutoff", type=datetime.datetime.fromisoformat, required=True)
+    parser.add_argument("--window-hours", type=float, default=24)
+    parser.add_argument("--holdout-hours", type=float, default=6)
+    parser.add_argument("--metric", choices=["recall", "precision", "ndcg", "coverage"], default="ndcg")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--rungs", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", type=pathlib.Path, help="where to store all trials as JSON")
+    args = parser.parse_args()
+
+    results = run_sweep(
+        model.MODELS[args.model],
+        expand_grid(args.grid),
+        args.cutoff,
+        datetime.timedelta(hours=args.window_hours),
+        datetime.timedelta(hours=args.holdout_hours),
+        k=args.k,
+        metric=args.metric,
+        eta=args.eta,
+        rungs=args.rungs,
+        max_workers=args.workers,
+    )
+
+    print(f"{'score':>8} {'seconds':>8} {'rungs':>5}  hyperparameters")
+    for trial in results:
+        print(f"{trial.scores[-1]:8.4f} {sum(trial.seconds):8.2f} {len(trial.scores):5d}  {trial.hyperparameters}")
+    print(f"Best configuration: {results[0].hyperparameters}")
+
+    if args.output:
+        args.output.write_text(json.dumps([dataclasses.asdict(trial) for trial in results], indent=2))